@@ -0,0 +1,185 @@
+import math
+import os
+from datetime import datetime
+
+# ============================================================
+# Anomaly: สถิติ EWMA ต่อผู้ใช้ อัปเดตทีละแถวตอน simulate (O(1) ไม่สแกน energy_daily ย้อนหลัง)
+# ============================================================
+EWMA_ALPHA = float(os.environ.get("ENERGY_LIFE_ANOMALY_ALPHA", 0.2))
+ANOMALY_Z = float(os.environ.get("ENERGY_LIFE_ANOMALY_Z", 4.0))
+ANOMALY_WARMUP = 5  # ต้องมีข้อมูลกี่วันก่อนเริ่มเตือนแบบ z-score
+# กันเตือนถี่เมื่อ variance ต่ำมาก (บ้านที่ใช้ไฟคงที่): ต้องเพิ่มขึ้นอย่างน้อยเท่านี้ และ ≥ ×ratio
+ANOMALY_MIN_JUMP_KWH = 3.0
+ANOMALY_MIN_JUMP_THB = 15.0
+ANOMALY_MIN_JUMP_RATIO = 1.5
+
+# ค่าที่เป็นไปไม่ได้สำหรับบ้านหนึ่งหลัง ไม่ต้องรอ warmup
+PLAUSIBLE_MAX_KWH_DAY = 300.0
+PLAUSIBLE_MAX_COST_DAY = 3000.0
+PLAUSIBLE_THB_PER_KWH = (0.5, 20.0)
+
+ALERT_KINDS = {
+    "kwh_spike": "ใช้ไฟพุ่งผิดปกติ",
+    "cost_spike": "ค่าไฟพุ่งผิดปกติ",
+    "implausible_bill": "ค่าไฟ/หน่วยไฟไม่สมเหตุสมผล",
+}
+
+ANOMALY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_stats (
+    user_id INTEGER PRIMARY KEY,
+    n INTEGER NOT NULL,
+    kwh_mean REAL NOT NULL,
+    kwh_var REAL NOT NULL,
+    cost_mean REAL NOT NULL,
+    cost_var REAL NOT NULL,
+    last_date TEXT,
+    updated_at TEXT NOT NULL,
+    prev_n INTEGER,
+    prev_kwh_mean REAL,
+    prev_kwh_var REAL,
+    prev_cost_mean REAL,
+    prev_cost_var REAL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS usage_alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value REAL NOT NULL,
+    expected REAL,
+    zscore REAL,
+    status TEXT NOT NULL DEFAULT 'open',
+    created_at TEXT NOT NULL,
+    resolved_by INTEGER,
+    resolved_at TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_usage_alerts_status ON usage_alerts(status, id);
+CREATE INDEX IF NOT EXISTS idx_usage_alerts_user ON usage_alerts(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_usage_alerts_day ON usage_alerts(user_id, date, kind);
+"""
+# สถิติก่อนรวมค่าของ last_date: จำลองซ้ำในวันเดียวกัน = แทนค่าของวันนั้น ไม่นับเป็นวันใหม่
+PREV_STATS_COLUMNS = ("prev_n", "prev_kwh_mean", "prev_kwh_var", "prev_cost_mean", "prev_cost_var")
+
+
+def ensure_anomaly_schema(db):
+    """ฐานข้อมูลเดิม: เพิ่มคอลัมน์ prev_* (ว่าง = แถวถัดไปนับเป็นวันใหม่ตามปกติ)"""
+    cols = {r[1] for r in db.execute("PRAGMA table_info(usage_stats)")}
+    for col in PREV_STATS_COLUMNS:
+        if col not in cols:
+            db.execute(f"ALTER TABLE usage_stats ADD COLUMN {col} {'INTEGER' if col == 'prev_n' else 'REAL'}")
+
+
+def ewma_update(mean, var, x, alpha=EWMA_ALPHA):
+    """EWMA mean/variance แบบ incremental — คืน (mean, var) ใหม่"""
+    diff = x - mean
+    incr = alpha * diff
+    return mean + incr, (1.0 - alpha) * (var + diff * incr)
+
+
+def _spike(x, mean, var, min_jump):
+    """คืน z-score ถ้าเป็น spike (ขาขึ้นเท่านั้น) มิฉะนั้น None"""
+    sd = math.sqrt(max(var, 0.0))
+    if x - mean < min_jump or x < mean * ANOMALY_MIN_JUMP_RATIO:
+        return None
+    z = (x - mean) / sd if sd > 1e-9 else math.inf
+    return z if z >= ANOMALY_Z else None
+
+
+def observe_daily(db, user_id, date, kwh_total, cost_thb):
+    """อัปเดตสถิติของผู้ใช้ + บันทึก alert ที่เจอ (ไม่ commit — ให้ผู้เรียก commit พร้อมแถว energy_daily)"""
+    now = datetime.utcnow().isoformat()
+    kwh_total, cost_thb = float(kwh_total), float(cost_thb)
+    found = []
+
+    if kwh_total > PLAUSIBLE_MAX_KWH_DAY or cost_thb > PLAUSIBLE_MAX_COST_DAY:
+        found.append(("implausible_bill", cost_thb, None, None))
+    elif kwh_total > 0:
+        lo, hi = PLAUSIBLE_THB_PER_KWH
+        per_kwh = cost_thb / kwh_total
+        if not (lo <= per_kwh <= hi):
+            found.append(("implausible_bill", round(per_kwh, 3), None, None))
+
+    row = db.execute(f"""
+        SELECT n, kwh_mean, kwh_var, cost_mean, cost_var, last_date, {", ".join(PREV_STATS_COLUMNS)}
+        FROM usage_stats WHERE user_id=?
+    """, (user_id,)).fetchone()
+    if row is not None and row[5] == date and row[6] is not None:
+        # วันเดิม (แถว energy_daily ถูกเขียนทับ): เริ่มจากสถิติก่อนรวมค่าของวันนี้ แล้วใส่ค่าใหม่แทน
+        n, kwh_mean, kwh_var, cost_mean, cost_var = row[6:11]
+    elif row is not None:
+        n, kwh_mean, kwh_var, cost_mean, cost_var = row[:5]
+    else:
+        n = 0
+    if n == 0:
+        kwh_mean, kwh_var, cost_mean, cost_var = kwh_total, 0.0, cost_thb, 0.0
+    prev = (n, kwh_mean, kwh_var, cost_mean, cost_var)
+
+    if n >= ANOMALY_WARMUP:
+        z = _spike(kwh_total, kwh_mean, kwh_var, ANOMALY_MIN_JUMP_KWH)
+        if z is not None:
+            found.append(("kwh_spike", kwh_total, kwh_mean, z))
+        else:
+            # ค่าไฟพุ่งทั้งที่หน่วยไฟปกติ = อัตราค่าไฟ/มิเตอร์เปลี่ยน
+            z = _spike(cost_thb, cost_mean, cost_var, ANOMALY_MIN_JUMP_THB)
+            if z is not None:
+                found.append(("cost_spike", cost_thb, cost_mean, z))
+
+    if n > 0:
+        kwh_mean, kwh_var = ewma_update(kwh_mean, kwh_var, kwh_total)
+        cost_mean, cost_var = ewma_update(cost_mean, cost_var, cost_thb)
+    db.execute(f"""
+        INSERT INTO usage_stats(user_id,n,kwh_mean,kwh_var,cost_mean,cost_var,last_date,updated_at,
+                                {",".join(PREV_STATS_COLUMNS)})
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            n=excluded.n, kwh_mean=excluded.kwh_mean, kwh_var=excluded.kwh_var,
+            cost_mean=excluded.cost_mean, cost_var=excluded.cost_var,
+            last_date=excluded.last_date, updated_at=excluded.updated_at,
+            prev_n=excluded.prev_n, prev_kwh_mean=excluded.prev_kwh_mean, prev_kwh_var=excluded.prev_kwh_var,
+            prev_cost_mean=excluded.prev_cost_mean, prev_cost_var=excluded.prev_cost_var
+    """, (user_id, n + 1, kwh_mean, kwh_var, cost_mean, cost_var, date, now, *prev))
+
+    alerts = []
+    for kind, value, expected, z in found:
+        zscore = None if z is None or math.isinf(z) else round(z, 2)
+        # alert เดียวต่อ (ผู้ใช้, วัน, ชนิด): จำลองซ้ำ = อัปเดตค่าของ alert ที่ยังเปิดอยู่
+        hit = db.execute("SELECT id, status FROM usage_alerts WHERE user_id=? AND date=? AND kind=? LIMIT 1",
+                         (user_id, date, kind)).fetchone()
+        if hit is None:
+            db.execute("""
+                INSERT INTO usage_alerts(user_id,date,kind,value,expected,zscore,created_at)
+                VALUES(?,?,?,?,?,?,?)
+            """, (user_id, date, kind, value, expected, zscore, now))
+        elif hit[1] == "open":
+            db.execute("UPDATE usage_alerts SET value=?, expected=?, zscore=? WHERE id=?",
+                       (value, expected, zscore, hit[0]))
+        alerts.append(kind)
+    return alerts
+
+
+def list_alerts(db, status="open", before_id=None, limit=50):
+    """รายการ alert ใหม่สุดก่อน (keyset ด้วย id ผ่าน idx_usage_alerts_status)"""
+    sql = """
+        SELECT a.*, u.username FROM usage_alerts a JOIN users u ON u.id = a.user_id
+        WHERE a.status=?
+    """
+    args = [status]
+    if before_id is not None:
+        sql += " AND a.id < ?"
+        args.append(int(before_id))
+    sql += " ORDER BY a.id DESC LIMIT ?"
+    args.append(int(limit))
+    return db.execute(sql, args).fetchall()
+
+
+def resolve_alert(db, alert_id, resolved_by):
+    cur = db.execute("""
+        UPDATE usage_alerts SET status='resolved', resolved_by=?, resolved_at=?
+        WHERE id=? AND status='open'
+    """, (resolved_by, datetime.utcnow().isoformat(), alert_id))
+    db.commit()
+    return cur.rowcount > 0
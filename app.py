@@ -1,27 +1,72 @@
 import os
 import sqlite3
+import threading
 import random
 import json
 import math
-from datetime import datetime, date
-from functools import wraps
-
-from flask import Flask, g, render_template, request, redirect, url_for, session, jsonify, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+import csv
+import io
+import time
+import bisect
+import gzip
+import hashlib
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, wraps
+
+import click
+from flask import Blueprint, Flask, Response, current_app, g, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory
+from werkzeug.security import generate_password_hash
 
 # ===== V4 Database =====
-from v4_db import init_v4_db, increment_visitor, get_visitor_count
+from v4_db import configure as configure_v4_db, init_v4_db, increment_visitor, get_visitor_count
+from static_assets import init_static_assets
+from state_codec import encode_blob, decode_blob
+from retention import (
+    RETENTION_SCHEMA, ENERGY_ARCHIVE_FIELDS, read_archived_energy, run_retention, auto_vacuum_mode,
+    enable_incremental_vacuum,
+)
+from cohorts import COHORT_SCHEMA, build_cohort_tables, cohort_of, cohort_percentile, load_cohort_tables
+from anomaly import ANOMALY_SCHEMA, ALERT_KINDS, ensure_anomaly_schema, observe_daily, list_alerts, resolve_alert
+from meter_store import MeterImportError, ingest_csv, meter_days
+from tariff_preview import (
+    PREVIEW_SCHEMA, peak_key, usage_version, save_usage_rows, stratified_sample, summarize_changes,
+)
+from tariffs import (
+    TARIFF_SCHEMA, TARIFF_EPOCH, load_tariff_versions, tariff_at, tariff_boundaries, save_tariff_version,
+    list_tariff_versions,
+)
+from jobs import (
+    JOBS_SCHEMA, JOB_LEASE_SECONDS, JOB_STATUSES, enqueue as enqueue_job, enqueue_once, lease_next, extend_leases, set_progress,
+    complete as complete_job, fail as fail_job, retry as retry_job, job_stats, list_jobs, worker_name, idle_sleep,
+)
+from thermal import REGIONS, DEFAULT_REGION, ac_window_factor, outdoor_profile
+from calibration import (
+    CALIBRATION_SCHEMA, DEFAULT_MODEL_COEFFS, FRIDGE_SIZE_BANDS, ac_temp_mult, fridge_band_kwh, fridge_open_factor, house_size_factor,
+    resident_factor as model_resident_factor, fit_coefficients, month_days, save_actual_bill, import_bills_csv,
+    publish_coefficients, activate_coefficients, load_active_coefficients,
+)
+from idempotency import (
+    IDEMPOTENCY_SCHEMA, IDEMPOTENCY_KEY_RE, IDEMPOTENCY_WAIT_SECONDS, IDEMPOTENCY_POLL_SECONDS,
+    IDEMPOTENCY_POLL_MAX_SECONDS, InflightGroup, request_fingerprint, claim_key, peek_key, store_response, release_key,
+)
+from login_audit import LOGIN_AUDIT_SCHEMA, LoginAuditBuffer, migrate_legacy_login_log
+from snapshots import SNAPSHOT_EVERY_MINUTES, list_snapshots, latest_snapshot, take_snapshot, open_snapshot
+from password_pool import (
+    PASSWORD_HASH_METHOD, PasswordPoolBusy, hash_password, verify_password, needs_rehash, rehash_password, hash_metrics
+)
 
 APP_NAME = "ENERGY LIFE V3"
-DATABASE = os.environ.get("ENERGY_LIFE_DB", "energy_life.db")
-SECRET_KEY = os.environ.get("ENERGY_LIFE_SECRET", None) or os.urandom(24).hex()
+# รูปแบบเก็บ user_state: "compact" (ไบนารี, ดู state_codec.py) หรือ "json" (แบบเดิม)
+STATE_CODEC = os.environ.get("ENERGY_LIFE_STATE_CODEC", "compact")
 
 # ===== โหมดใช้งานจริง: ปิดระบบเกมก่อน =====
 ENABLE_GAME = False  # <- ถ้าจะเปิดเกมทีหลัง เปลี่ยนเป็น True
 
-# init v4 database on app start
-init_v4_db()
-
 
 def make_token(n=20):
     alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
@@ -149,13 +194,18 @@ HOUSE_LEVELS = [
 
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
+        g.db = sqlite3.connect(current_app.config["DATABASE"])
         g.db.row_factory = sqlite3.Row
     return g.db
 
 
 def init_db():
     db = get_db()
+    if not db.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        # ฐานข้อมูลใหม่ (ยังไม่มีตาราง): ตั้ง INCREMENTAL ได้เลยโดยไม่ต้อง VACUUM — retention คืนพื้นที่ทีละน้อย
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL: ผู้อ่าน (รายงาน, snapshot) กับผู้เขียนไม่รอกัน — ค่านี้บันทึกอยู่ในไฟล์ฐานข้อมูล
+    db.execute("PRAGMA journal_mode=WAL")
     db.executescript("""
     PRAGMA foreign_keys = ON;
 
@@ -178,9 +228,10 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
     );
 
+    -- time-series: 1 แถว/ผู้ใช้/วัน เรียงต่อกันบน PK (user_id, date) -> query ช่วงวันที่ = อ่าน index ช่วงเดียว
     CREATE TABLE IF NOT EXISTS energy_daily (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
         day TEXT NOT NULL,
         kwh_total REAL NOT NULL,
         cost_thb REAL NOT NULL,
@@ -190,8 +241,9 @@ def init_db():
         kwh_ev REAL NOT NULL,
         notes_json TEXT,
         created_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, date),
         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-    );
+    ) WITHOUT ROWID;
 
     CREATE TABLE IF NOT EXISTS purchases (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -240,6 +292,7 @@ def init_db():
         week_id TEXT NOT NULL,
         score INTEGER NOT NULL DEFAULT 0,
         updated_at TEXT NOT NULL,
+        listed INTEGER NOT NULL DEFAULT 1,
         PRIMARY KEY (user_id, week_id),
         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
     );
@@ -251,15 +304,6 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
     );
 
-    CREATE TABLE IF NOT EXISTS login_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        ip TEXT,
-        user_agent TEXT,
-        created_at TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-    );
-
     CREATE TABLE IF NOT EXISTS settings (
         key TEXT PRIMARY KEY,
         value TEXT NOT NULL
@@ -274,8 +318,30 @@ def init_db():
     for k, v in DEFAULT_BILLING_SETTINGS.items():
         db.execute("INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)", (k, str(v)))
 
+    db.executescript(RETENTION_SCHEMA)
+    db.executescript(COHORT_SCHEMA)
+    db.executescript(ANOMALY_SCHEMA)
+    ensure_anomaly_schema(db)
+    db.executescript(CALIBRATION_SCHEMA)
+    db.executescript(PREVIEW_SCHEMA)
+    db.executescript(TARIFF_SCHEMA)
+    db.executescript(JOBS_SCHEMA)
+    db.executescript(IDEMPOTENCY_SCHEMA)
+    db.executescript(LOGIN_AUDIT_SCHEMA)
     db.commit()
     ensure_user_schema()
+    migrate_legacy_login_log(db)
+    ensure_energy_daily_schema()
+    ensure_tariff_history()
+
+
+def ensure_tariff_history():
+    """ครั้งแรก: ย้ายอัตราใน settings มาเป็นเวอร์ชันแรก (ใช้ย้อนหลังได้ทุกวัน)"""
+    db = get_db()
+    if db.execute("SELECT 1 FROM tariff_versions LIMIT 1").fetchone():
+        return
+    snapshot = {k: load_setting(k, dv) for k, dv in DEFAULT_BILLING_SETTINGS.items()}
+    save_tariff_version(db, snapshot, TARIFF_EPOCH)
 
 
 def ensure_user_schema():
@@ -285,13 +351,103 @@ def ensure_user_schema():
         db.execute("ALTER TABLE users ADD COLUMN display_name TEXT")
     if "share_token" not in cols:
         db.execute("ALTER TABLE users ADD COLUMN share_token TEXT")
+    if "show_on_leaderboard" not in cols:
+        # สำเนาของ prefs.privacy.show_on_leaderboard ไว้ใน users เพื่อไม่ต้อง decode JSON ตอนจัดอันดับ
+        db.execute("ALTER TABLE users ADD COLUMN show_on_leaderboard INTEGER NOT NULL DEFAULT 1")
+        db.execute("""
+            UPDATE users SET show_on_leaderboard = COALESCE((
+                SELECT json_extract(p.prefs_json, '$.privacy.show_on_leaderboard') FROM user_prefs p WHERE p.user_id = users.id
+            ), 1)
+        """)
+    if "share_house" not in cols:
+        db.execute("ALTER TABLE users ADD COLUMN share_house INTEGER NOT NULL DEFAULT 1")
+        db.execute("""
+            UPDATE users SET share_house = COALESCE((
+                SELECT json_extract(p.prefs_json, '$.privacy.share_house') FROM user_prefs p WHERE p.user_id = users.id
+            ), 1)
+        """)
+
+    if "last_login_at" not in cols:
+        # "active ใน N วัน" = นับ users ตาม index นี้ แทน COUNT(DISTINCT) บน log การเข้าสู่ระบบ
+        db.execute("ALTER TABLE users ADD COLUMN last_login_at TEXT")
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='login_log'").fetchone():
+            db.execute("""
+                UPDATE users SET last_login_at = (SELECT MAX(l.created_at) FROM login_log l WHERE l.user_id = users.id)
+            """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_login ON users(last_login_at)")
+
+    ws_cols = [r["name"] for r in db.execute("PRAGMA table_info(weekly_scores)").fetchall()]
+    if "listed" not in ws_cols:
+        # สำเนาของ users.show_on_leaderboard: อันดับ = COUNT บน index อย่างเดียว ไม่ต้อง JOIN users
+        db.execute("ALTER TABLE weekly_scores ADD COLUMN listed INTEGER NOT NULL DEFAULT 1")
+        db.execute("""
+            UPDATE weekly_scores SET listed = (SELECT u.show_on_leaderboard FROM users u WHERE u.id = weekly_scores.user_id)
+            WHERE user_id IN (SELECT id FROM users WHERE show_on_leaderboard = 0)
+        """)
+    db.execute("DROP INDEX IF EXISTS idx_weekly_scores_rank")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_weekly_scores_listed ON weekly_scores(week_id, listed, score, user_id)")
 
     db.execute("UPDATE users SET display_name = COALESCE(display_name, username)")
-    db.execute("UPDATE users SET share_token = COALESCE(share_token, '')")
 
     rows = db.execute("SELECT id FROM users WHERE share_token = '' OR share_token IS NULL").fetchall()
     for r in rows:
         db.execute("UPDATE users SET share_token=? WHERE id=?", (make_token(24), r["id"]))
+
+    # /share/<token> ค้นด้วย index (unique) แทน full scan
+    has_index = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_users_share_token'"
+    ).fetchone()
+    if not has_index:
+        dupes = db.execute("""
+            SELECT id FROM users WHERE share_token IN (
+                SELECT share_token FROM users GROUP BY share_token HAVING COUNT(*) > 1
+            )
+        """).fetchall()
+        for r in dupes:
+            db.execute("UPDATE users SET share_token=? WHERE id=?", (make_token(24), r["id"]))
+        db.execute("CREATE UNIQUE INDEX idx_users_share_token ON users(share_token)")
+    db.commit()
+
+
+ENERGY_DAILY_COLUMNS = "day,kwh_total,cost_thb,kwh_on,kwh_off,kwh_solar_used,kwh_ev,notes_json,created_at"
+
+
+def ensure_energy_daily_schema():
+    """ย้าย energy_daily แบบเดิม (id + "Day N") ไปเป็น time-series (user_id, date)"""
+    db = get_db()
+    cols = [r["name"] for r in db.execute("PRAGMA table_info(energy_daily)").fetchall()]
+    if "date" in cols:
+        return
+
+    rows = db.execute(f"SELECT user_id,{ENERGY_DAILY_COLUMNS} FROM energy_daily ORDER BY user_id, created_at").fetchall()
+
+    db.execute("ALTER TABLE energy_daily RENAME TO energy_daily_legacy")
+    db.execute("""
+        CREATE TABLE energy_daily (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            day TEXT NOT NULL,
+            kwh_total REAL NOT NULL,
+            cost_thb REAL NOT NULL,
+            kwh_on REAL NOT NULL,
+            kwh_off REAL NOT NULL,
+            kwh_solar_used REAL NOT NULL,
+            kwh_ev REAL NOT NULL,
+            notes_json TEXT,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, date),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    """)
+    for r in rows:
+        # วันที่ = วันที่บันทึกจริง (ไม่คำนวณจาก Day N) — กดจำลองหลายครั้งในวันเดียวกัน = แถวที่บันทึกทีหลังชนะ
+        # กติกาเดียวกับ /api/simulate_day ที่ upsert แถวของวันนี้
+        d = datetime.fromisoformat(r["created_at"]).date()
+        db.execute(f"""
+            INSERT OR REPLACE INTO energy_daily(user_id,date,{ENERGY_DAILY_COLUMNS})
+            VALUES(?,?,?,?,?,?,?,?,?,?,?)
+        """, (r["user_id"], d.isoformat(), *tuple(r)[1:]))
+    db.execute("DROP TABLE energy_daily_legacy")
     db.commit()
 
 
@@ -333,23 +489,118 @@ def save_setting(key, value):
     db.commit()
 
 
+# ============================================================
+# ✅ ตัวตนผู้ใช้: โหลดครั้งเดียวต่อ request (decorator/handler/get_user_display ใช้แถวเดียวกัน)
+# ============================================================
+# ไม่เก็บ password_hash ไว้ใน g / ไม่ cache ข้าม request: ถอดสิทธิ์แล้วต้องมีผลใน request ถัดไปทุก worker
+USER_IDENTITY_COLUMNS = "id, username, email, created_at, display_name, share_token, role"
+
+
+def _load_user_identity(user_id):
+    cache = g.setdefault("user_identity", {})
+    if user_id not in cache:
+        row = get_db().execute(f"SELECT {USER_IDENTITY_COLUMNS} FROM users WHERE id=?", (user_id,)).fetchone()
+        cache[user_id] = dict(row) if row else None
+    return cache[user_id]
+
+
+def invalidate_user_cache(user_id):
+    g.get("user_identity", {}).pop(user_id, None)
+    g.get("user_prefs", {}).pop(user_id, None)
+
+
 def current_user():
     uid = session.get("user_id")
-    if not uid:
-        return None
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE id=?", (uid,)).fetchone()
+    return _load_user_identity(uid) if uid else None
 
 
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         if not session.get("user_id"):
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         return f(*args, **kwargs)
     return wrapper
 
 
+# คำขอที่เหมือนกันทุกไบต์จากผู้ใช้เดียวกันที่กำลังทำอยู่ใน process นี้
+_inflight = InflightGroup()
+
+
+def _replayed_response(status_code, mimetype, body):
+    resp = Response(body, status=status_code, mimetype=mimetype)
+    resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+
+def _run_with_idempotency_key(f, user_id, key, fingerprint, args, kwargs):
+    db = get_db()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    outcome, row = claim_key(db, user_id, key, fingerprint)
+    poll = IDEMPOTENCY_POLL_SECONDS
+    while outcome == "pending" and time.monotonic() < deadline:
+        # คำขอแรกอยู่ใน worker อื่น: รอด้วย SELECT อย่างเดียว ห่างขึ้นเรื่อยๆ
+        time.sleep(min(poll, max(0.0, deadline - time.monotonic())))
+        poll = min(poll * 2, IDEMPOTENCY_POLL_MAX_SECONDS)
+        outcome, row = peek_key(db, user_id, key, fingerprint)
+        if outcome is None:  # คำขอแรกล้ม/ตาย: จองใหม่แล้วทำเอง
+            outcome, row = claim_key(db, user_id, key, fingerprint, purge=False)
+    if outcome == "replay":
+        return _replayed_response(row["status_code"], row["mimetype"], row["body"])
+    if outcome == "mismatch":
+        return current_app.make_response((jsonify({"ok": False, "error": "Idempotency-Key นี้ใช้กับคำขออื่นไปแล้ว"}), 422))
+    if outcome == "pending":
+        resp = current_app.make_response((jsonify({"ok": False, "error": "คำขอเดียวกันยังประมวลผลอยู่ ลองใหม่อีกครั้ง"}), 409))
+        resp.headers["Retry-After"] = "1"
+        return resp
+
+    try:
+        resp = current_app.make_response(f(*args, **kwargs))
+    except Exception:
+        db.rollback()
+        release_key(db, user_id, key)
+        raise
+    if resp.status_code >= 500:
+        release_key(db, user_id, key)
+    else:
+        store_response(db, user_id, key, resp.status_code, resp.mimetype, resp.get_data())
+    return resp
+
+
+def idempotent(f):
+    """POST ซ้ำ: Idempotency-Key เดิม = ได้คำตอบเดิม / คำขอเหมือนกันที่มาพร้อมกัน = คำนวณครั้งเดียว (ใช้หลัง login_required)"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.method == "GET":
+            return f(*args, **kwargs)
+        key = request.headers.get("Idempotency-Key")
+        if key is not None and not IDEMPOTENCY_KEY_RE.fullmatch(key):
+            return jsonify({"ok": False, "error": "Idempotency-Key ไม่ถูกต้อง (8-128 ตัว: A-Z a-z 0-9 _ . : -)"}), 400
+        user_id = session["user_id"]
+        fingerprint = request_fingerprint(request.method, request.path, request.get_data())
+        flight_key = (user_id, key, fingerprint)
+        leader, flight = _inflight.join(flight_key)
+        if not leader:
+            flight.done.wait(IDEMPOTENCY_WAIT_SECONDS)
+            if flight.response is not None:
+                return _replayed_response(*flight.response)
+            # คำขอแรกล้มหรือช้าเกิน: ทำเอง (ถ้ามีคีย์ ตาราง idempotency_keys กันซ้ำอีกชั้น)
+
+        captured = None
+        try:
+            if key:
+                resp = _run_with_idempotency_key(f, user_id, key, fingerprint, args, kwargs)
+            else:
+                resp = current_app.make_response(f(*args, **kwargs))
+            if resp.status_code < 500:
+                captured = (resp.status_code, resp.mimetype, resp.get_data())
+            return resp
+        finally:
+            if leader:
+                _inflight.leave(flight_key, flight, captured)
+    return wrapper
+
+
 def role_required(*roles):
     def deco(f):
         @wraps(f)
@@ -357,7 +608,7 @@ def role_required(*roles):
             user = current_user()
             if not user or user["role"] not in roles:
                 flash("ไม่มีสิทธิ์เข้าถึงหน้านี้", "error")
-                return redirect(url_for("home"))
+                return redirect(url_for("main.home"))
             return f(*args, **kwargs)
         return wrapper
     return deco
@@ -446,12 +697,18 @@ def _infer_room_configured(room: dict) -> bool:
         return False
 
 
+def dump_state_blob(obj):
+    if STATE_CODEC == "json":
+        return json.dumps(obj)
+    return encode_blob(obj)
+
+
 def get_or_create_user_state(user_id):
     db = get_db()
     row = db.execute("SELECT * FROM user_state WHERE user_id=?", (user_id,)).fetchone()
     if row:
-        profile = json.loads(row["profile_json"])
-        state = json.loads(row["state_json"])
+        profile = decode_blob(row["profile_json"])
+        state = decode_blob(row["state_json"])
 
         changed = False
         rooms = (state.get("rooms") or {})
@@ -467,14 +724,15 @@ def get_or_create_user_state(user_id):
                 db.execute("""
                     UPDATE user_state SET state_json=?, updated_at=?
                     WHERE user_id=?
-                """, (json.dumps(state), now, user_id))
+                """, (dump_state_blob(state), now, user_id))
                 db.commit()
 
         return {
             "profile": profile,
             "state": state,
             "points": row["points"],
-            "house_level": row["house_level"]
+            "house_level": row["house_level"],
+            "updated_at": now if changed else row["updated_at"],
         }
 
     prof = default_profile()
@@ -482,10 +740,27 @@ def get_or_create_user_state(user_id):
     now = datetime.utcnow().isoformat()
     db.execute(
         "INSERT INTO user_state(user_id,profile_json,state_json,points,house_level,updated_at) VALUES(?,?,?,?,?,?)",
-        (user_id, json.dumps(prof), json.dumps(st), 0, 1, now)
+        (user_id, dump_state_blob(prof), dump_state_blob(st), 0, 1, now)
     )
     db.commit()
-    return {"profile": prof, "state": st, "points": 0, "house_level": 1}
+    return {"profile": prof, "state": st, "points": 0, "house_level": 1, "updated_at": now}
+
+
+def peek_user_state(user_id):
+    """อ่าน state แบบไม่เขียนอะไรลงฐานข้อมูล (ยังไม่มีแถว = ค่า default)"""
+    row = get_db().execute(
+        "SELECT profile_json, state_json, points, house_level, updated_at FROM user_state WHERE user_id=?", (user_id,)
+    ).fetchone()
+    if not row:
+        return {"profile": default_profile(), "state": default_state(), "points": 0, "house_level": 1,
+                "updated_at": None}
+    return {
+        "profile": decode_blob(row["profile_json"]),
+        "state": decode_blob(row["state_json"]),
+        "points": row["points"],
+        "house_level": row["house_level"],
+        "updated_at": row["updated_at"],
+    }
 
 
 def save_user_state(user_id, profile, state, points, house_level):
@@ -500,21 +775,95 @@ def save_user_state(user_id, profile, state, points, house_level):
             points=excluded.points,
             house_level=excluded.house_level,
             updated_at=excluded.updated_at
-    """, (user_id, json.dumps(profile), json.dumps(state), int(points), int(house_level), now))
+    """, (user_id, dump_state_blob(profile), dump_state_blob(state), int(points), int(house_level), now))
     db.commit()
 
 
+# ============================================================
+# ✅ energy_daily: แถวละวันจริง + query ช่วงวันที่
+# ============================================================
+def energy_range(user_id, start=None, end=None, limit=None, newest_first=False, db=None):
+    """แถวรายวันในช่วง [start, end) — อ่านจาก PK (user_id, date) ตรงๆ"""
+    sql = f"SELECT date,{ENERGY_DAILY_COLUMNS} FROM energy_daily WHERE user_id=?"
+    args = [user_id]
+    if start is not None:
+        sql += " AND date >= ?"
+        args.append(str(start))
+    if end is not None:
+        sql += " AND date < ?"
+        args.append(str(end))
+    sql += " ORDER BY date DESC" if newest_first else " ORDER BY date"
+    if limit:
+        sql += " LIMIT ?"
+        args.append(int(limit))
+    return (db or get_db()).execute(sql, args).fetchall()
+
+
+ENERGY_BUCKETS = {
+    "day": "date",
+    "week": "date(date, '-6 days', 'weekday 1')",  # วันจันทร์ของสัปดาห์
+    "month": "substr(date, 1, 7)",
+}
+
+
+def energy_aggregate(user_id, start=None, end=None, bucket="month"):
+    """รวมรายวัน/สัปดาห์/เดือน ในช่วง [start, end)
+
+    bucket="month" รวมสรุปรายเดือนที่ retention ย้ายออกไปแล้ว (energy_monthly) ด้วย
+    """
+    key = ENERGY_BUCKETS[bucket]
+    where = ""
+    args = [user_id]
+    if start is not None:
+        where += " AND date >= ?"
+        args.append(str(start))
+    if end is not None:
+        where += " AND date < ?"
+        args.append(str(end))
+
+    live = f"""
+        SELECT {key} AS bucket, 1 AS days, kwh_total, cost_thb, kwh_on, kwh_off, kwh_solar_used, kwh_ev,
+               date AS first_date, date AS last_date
+        FROM energy_daily WHERE user_id=?{where}
+    """
+    if bucket == "month":
+        live += f"""
+        UNION ALL
+        SELECT month, days, kwh_total, cost_thb, kwh_on, kwh_off, kwh_solar_used, kwh_ev, first_date, last_date
+        FROM energy_monthly WHERE user_id=?{where.replace("date", "first_date")}
+        """
+        args = args + args
+
+    sql = f"""
+        SELECT bucket, SUM(days) AS days,
+               SUM(kwh_total) AS kwh_total, SUM(cost_thb) AS cost_thb,
+               SUM(kwh_on) AS kwh_on, SUM(kwh_off) AS kwh_off,
+               SUM(kwh_solar_used) AS kwh_solar_used, SUM(kwh_ev) AS kwh_ev,
+               MIN(first_date) AS first_date, MAX(last_date) AS last_date
+        FROM ({live}) GROUP BY bucket ORDER BY bucket
+    """
+    return get_db().execute(sql, args).fetchall()
+
+
+# ค่าสัมประสิทธิ์ของโมเดล: ค่าเริ่มต้นใน calibration.py หรือเวอร์ชันที่ publish ไว้ (โหลดครั้งแรกที่มี request)
+MODEL_COEFFS = dict(DEFAULT_MODEL_COEFFS)
+_model_coeffs_state = {"loaded": False, "version": None}
+
+
+def load_model_coefficients():
+    version, coeffs = load_active_coefficients(get_db())
+    MODEL_COEFFS.clear()
+    MODEL_COEFFS.update(coeffs)
+    _room_calc_cache.clear()
+    _model_coeffs_state.update(loaded=True, version=version)
+    return version
+
+
 def calc_ac_kwh(btu, set_temp, hours, inverter=True):
     if hours <= 0:
         return 0.0
-    base_kw = (btu / 12000.0) * (1.0 if inverter else 1.15)
-    if set_temp < 26:
-        mult = 1.0 + (26 - set_temp) * 0.06
-    elif set_temp > 26:
-        mult = max(0.70, 1.0 - (set_temp - 26) * 0.03)
-    else:
-        mult = 1.0
-    return base_kw * mult * hours
+    base_kw = (btu / 12000.0) * (1.0 if inverter else MODEL_COEFFS["ac_non_inverter"])
+    return base_kw * ac_temp_mult(MODEL_COEFFS, set_temp) * hours
 
 
 def calc_generic_kwh(watts, hours):
@@ -594,11 +943,33 @@ def _to_int_safe(v, default=0):
         return int(default)
 
 
+# อัตราค่าไฟตามวันที่: โหลดทุกเวอร์ชันเก็บไว้ต่อ worker แล้วหาแบบ bisect (ไม่แตะฐานข้อมูลบน hot path)
+TARIFF_CACHE_TTL = float(os.environ.get("ENERGY_LIFE_TARIFF_CACHE_TTL", 60))
+
+_tariff_cache = {"expires": 0.0, "dates": [], "snapshots": []}
+
+
+def _tariff_versions():
+    now = time.monotonic()
+    if _tariff_cache["expires"] <= now:
+        dates, snapshots = load_tariff_versions(get_db())
+        _tariff_cache.update(dates=dates, snapshots=[{**DEFAULT_BILLING_SETTINGS, **s} for s in snapshots],
+                             expires=now + TARIFF_CACHE_TTL)
+    return _tariff_cache["dates"], _tariff_cache["snapshots"]
+
+
+def invalidate_tariff_cache():
+    _tariff_cache["expires"] = 0.0
+
+
+def billing_settings_at(day):
+    """อัตราค่าไฟที่มีผลในวัน day (สำเนา — แก้ได้โดยไม่กระทบ cache)"""
+    snapshot = tariff_at(*_tariff_versions(), day)
+    return dict(snapshot if snapshot is not None else DEFAULT_BILLING_SETTINGS)
+
+
 def _load_billing_settings():
-    s = {}
-    for k, dv in DEFAULT_BILLING_SETTINGS.items():
-        s[k] = load_setting(k, dv)
-    return s
+    return billing_settings_at(datetime.utcnow().date())
 
 
 def bill_non_tou_month(kwh_month: float, settings: dict):
@@ -680,16 +1051,8 @@ def bill_day_from_month_obj(month_obj: dict):
 # ✅ เฟส 1: ตู้เย็น (แผน A)
 # =========================
 def fridge_base_kwh_per_day_by_band(size_band: str) -> float:
-    # ค่าเฉลี่ยฐาน/เครื่อง (kWh ต่อวัน)
-    # 6–9: 0.8 | 10–14: 1.0 | 15–18: 1.2 | 19–25: 1.5
-    band = str(size_band or "").strip()
-    mapping = {
-        "6_9": 0.8,
-        "10_14": 1.0,
-        "15_18": 1.2,
-        "19_25": 1.5,
-    }
-    return float(mapping.get(band, 1.0))
+    # ค่าเฉลี่ยฐาน/เครื่อง (kWh ต่อวัน) — ค่าเริ่มต้น 6–9: 0.8 | 10–14: 1.0 | 15–18: 1.2 | 19–25: 1.5
+    return fridge_band_kwh(MODEL_COEFFS, size_band)
 
 
 def fridge_open_mult(open_times: int) -> float:
@@ -700,26 +1063,79 @@ def fridge_open_mult(open_times: int) -> float:
     except Exception:
         ot = 20
     ot = max(0, min(200, ot))
-    mult = 1.0 + (ot - 20) * 0.01
-    # กันหลุด: ไม่ให้ต่ำหรือสูงเกินจริง
-    return max(0.6, min(1.8, float(mult)))
+    return fridge_open_factor(MODEL_COEFFS, ot)
+
+
+def _ev_month_kwh(ev_cfg: dict):
+    if not isinstance(ev_cfg, dict) or not ev_cfg.get("enabled", False):
+        return 0.0, 0.0
+    batt = ev_cfg.get("battery_kwh", 60.0)
+    soc_from = ev_cfg.get("soc_from", 30)
+    soc_to = ev_cfg.get("soc_to", 80)
+    eff = ev_cfg.get("efficiency", 0.9)
+    charges_per_week = ev_cfg.get("charges_per_week", 2)
+
+    try:
+        charges_per_week = float(charges_per_week or 0)
+    except Exception:
+        charges_per_week = 0.0
+    charges_per_week = max(0.0, min(14.0, charges_per_week))
 
+    kwh_per_charge = calc_ev_kwh_per_charge(batt, soc_from, soc_to, eff)
+    kwh_month = kwh_per_charge * charges_per_week * 4.0
+    return kwh_per_charge, kwh_month
 
-def compute_daily_energy(profile, state):
+
+def sim_day(state=None) -> date:
+    """วันที่ของการจำลอง = วันนี้จริง (UTC) — ไม่เดินล้ำไปอนาคตตาม day_counter
+
+    จำลองหลายครั้งในวันเดียวกัน = แถวของวันนี้แถวเดียว (upsert) อัตรา/มิเตอร์/retention อิงวันจริงเสมอ
+    """
+    return datetime.utcnow().date()
+
+
+def sim_month(state) -> int:
+    return sim_day(state).month
+
+
+def _ac_window(cfg) -> list:
+    return window_hours(cfg.get("start_hour", 20), cfg.get("end_hour", 2))
+
+
+# ผลคำนวณรายห้องของ compute_daily_energy() ต่อ process: key = (room id, ลายเซ็น config ของห้อง, บริบท)
+# แก้ห้องเดียว = คำนวณใหม่ห้องเดียว / ห้องที่ config เหมือนกัน (หอพัก, คอนโดทั้งตึก) ใช้ผลร่วมกัน
+ROOM_CALC_CACHE_MAX = 50000
+_room_calc_cache = {}
+
+
+def _room_signature(room) -> bytes:
+    # repr เร็วกว่า json.dumps ~2 เท่า — ลำดับ key ต่างกัน = แค่ cache miss ไม่ใช่ผลผิด
+    return hashlib.blake2b(repr(room).encode(), digest_size=16).digest()
+
+
+def compute_daily_energy(profile, state, billing=None):
+    # billing: ส่งค่าที่โหลดไว้แล้วมาได้ (เช่นคำนวณหลาย scenario) เพื่อไม่ต้องอ่าน settings ซ้ำ
+    if billing is None:
+        billing = billing_settings_at(sim_day(state))
     tariff_mode = state.get("tariff_mode", "non_tou")
     solar_kw = float(state.get("solar_kw", 0) or 0)
 
-    size_factor = {"small": 0.9, "medium": 1.0, "large": 1.15}.get(profile.get("house_size", "medium"), 1.0)
+    size_factor = house_size_factor(MODEL_COEFFS, profile.get("house_size", "medium"))
     residents = max(1, int(profile.get("residents", 3)))
-    resident_factor = 0.85 + min(0.6, (residents - 1) * 0.08)
+    resident_factor = model_resident_factor(MODEL_COEFFS, residents)
 
     warnings = []
     insights = []
     points = 0
 
     # ✅ ช่วง On/Off (ยังใช้จาก settings)
-    on_start = int(load_setting("on_peak_start", 9))
-    on_end = int(load_setting("on_peak_end", 22))
+    on_start = _to_int_safe(billing.get("on_peak_start", 9), 9)
+    on_end = _to_int_safe(billing.get("on_peak_end", 22), 22)
+    on_set = frozenset(window_hours(on_start, on_end))
+
+    # ✅ แอร์: น้ำหนักรายชั่วโมงตามอุณหภูมิภายนอกของภาค/เดือน (thermal.py)
+    region = profile.get("region") or DEFAULT_REGION
+    month = sim_month(state)
 
     def _room_calc_breakdown(appliances_dict: dict):
         kwh_breakdown = {}
@@ -736,7 +1152,8 @@ def compute_daily_energy(profile, state):
                 set_temp = float(cfg.get("set_temp", 26))
                 hours = float(cfg.get("hours", 6))
                 inverter = bool(cfg.get("inverter", True))
-                kwh_breakdown[key] = calc_ac_kwh(btu, set_temp, hours, inverter=inverter)
+                factor, _ = ac_window_factor(region, month, set_temp, _ac_window(cfg))
+                kwh_breakdown[key] = calc_ac_kwh(btu, set_temp, hours, inverter=inverter) * factor
 
             elif key == "fridge":
                 # ✅ เฟส 1 (แผน A)
@@ -779,25 +1196,6 @@ def compute_daily_energy(profile, state):
 
         return kwh_breakdown
 
-    def _ev_month_kwh_from_cfg(ev_cfg: dict):
-        if not isinstance(ev_cfg, dict) or not ev_cfg.get("enabled", False):
-            return 0.0, 0.0
-        batt = ev_cfg.get("battery_kwh", 60.0)
-        soc_from = ev_cfg.get("soc_from", 30)
-        soc_to = ev_cfg.get("soc_to", 80)
-        eff = ev_cfg.get("efficiency", 0.9)
-        charges_per_week = ev_cfg.get("charges_per_week", 2)
-
-        try:
-            charges_per_week = float(charges_per_week or 0)
-        except Exception:
-            charges_per_week = 0.0
-        charges_per_week = max(0.0, min(14.0, charges_per_week))
-
-        kwh_per_charge = calc_ev_kwh_per_charge(batt, soc_from, soc_to, eff)
-        kwh_month = kwh_per_charge * charges_per_week * 4.0
-        return kwh_per_charge, kwh_month
-
     def _tou_split_from_room_breakdown(room_breakdown_scaled: dict, room_cfg: dict):
         kwh_on = 0.0
         kwh_off = 0.0
@@ -805,14 +1203,12 @@ def compute_daily_energy(profile, state):
         ac_cfg = (room_cfg.get("appliances") or {}).get("ac", {})
         if isinstance(ac_cfg, dict) and ac_cfg.get("enabled", False):
             ac_kwh = float(room_breakdown_scaled.get("ac", 0.0))
-            ac_on, ac_off = split_kwh_by_tou(
-                ac_kwh,
-                ac_cfg.get("start_hour", 20),
-                ac_cfg.get("end_hour", 2),
-                on_start, on_end
-            )
-            kwh_on += ac_on
-            kwh_off += ac_off
+            hrs = _ac_window(ac_cfg)
+            if hrs:
+                # แบ่งตามน้ำหนักรายชั่วโมง (ช่วงบ่ายร้อน = กินไฟมากกว่าช่วงดึก)
+                _, on_frac = ac_window_factor(region, month, float(ac_cfg.get("set_temp", 26)), hrs, on_set)
+                kwh_on += ac_kwh * on_frac
+                kwh_off += ac_kwh * (1.0 - on_frac)
 
         ev_cfg = (room_cfg.get("appliances") or {}).get("ev_charger", {})
         if isinstance(ev_cfg, dict) and ev_cfg.get("enabled", False):
@@ -831,6 +1227,44 @@ def compute_daily_energy(profile, state):
 
         return kwh_on, kwh_off
 
+    # ผลของห้องขึ้นกับ config ของห้อง + ค่าเหล่านี้เท่านั้น (ช่วง On-Peak มาจากเวอร์ชันอัตราค่าไฟ)
+    room_context = (region, month, on_start, on_end, size_factor, resident_factor)
+
+    def _room_parts(rid, room):
+        """(kWh/วัน, kWh/เดือน, EV/วัน, EV/เดือน, rooms_breakdown ของห้อง, kWh On, kWh Off) — ใช้ cache ถ้าห้องไม่เปลี่ยน"""
+        key = (rid, _room_signature(room), room_context)
+        parts = _room_calc_cache.get(key)
+        if parts is not None:
+            return parts
+
+        appl = room.get("appliances") or {}
+        bd = _room_calc_breakdown(appl)
+        room_kwh = sum(bd.values())
+        room_kwh_scaled = room_kwh * size_factor * resident_factor
+
+        ev_cfg = (appl or {}).get("ev_charger", {})
+        ev_day, ev_month = _ev_month_kwh(ev_cfg)
+        ev_day_scaled = ev_day * size_factor * resident_factor
+        ev_month_scaled = ev_month * size_factor * resident_factor
+
+        non_ev_day_scaled = max(0.0, room_kwh_scaled - ev_day_scaled)
+        room_month_scaled = non_ev_day_scaled * 30.0 + ev_month_scaled
+
+        entry = {
+            "type": room.get("type", ""),
+            "label": room.get("label", rid),
+            "kwh_total": round(room_kwh_scaled, 3),
+            "kwh_month_total": round(room_month_scaled, 3),
+            "kwh_ev_month": round(ev_month_scaled, 3),
+            "breakdown": {k: round(v * size_factor * resident_factor, 3) for k, v in bd.items()}
+        }
+        room_on, room_off = _tou_split_from_room_breakdown(entry["breakdown"], room)
+        parts = (room_kwh_scaled, room_month_scaled, ev_day_scaled, ev_month_scaled, entry, room_on, room_off)
+        if len(_room_calc_cache) >= ROOM_CALC_CACHE_MAX:
+            _room_calc_cache.clear()
+        _room_calc_cache[key] = parts
+        return parts
+
     rooms = (state.get("rooms") or {})
     use_rooms = isinstance(rooms, dict) and len(rooms) > 0
 
@@ -842,40 +1276,23 @@ def compute_daily_energy(profile, state):
     kwh_month_by_room = {}
     kwh_ev_by_room = {}
     kwh_ev_month_by_room = {}
+    room_parts = []
 
     if use_rooms:
         for rid, room in rooms.items():
             if not isinstance(room, dict):
                 continue
 
-            appl = room.get("appliances") or {}
-            bd = _room_calc_breakdown(appl)
-            room_kwh = sum(bd.values())
-
-            room_kwh_scaled = room_kwh * size_factor * resident_factor
+            parts = _room_parts(rid, room)
+            room_kwh_scaled, room_month_scaled, ev_day_scaled, ev_month_scaled, entry = parts[:5]
+            room_parts.append(parts)
             kwh_total_raw += room_kwh_scaled
 
-            ev_cfg = (appl or {}).get("ev_charger", {})
-            ev_day, ev_month = _ev_month_kwh_from_cfg(ev_cfg)
-            ev_day_scaled = ev_day * size_factor * resident_factor
-            ev_month_scaled = ev_month * size_factor * resident_factor
-
-            non_ev_day_scaled = max(0.0, room_kwh_scaled - ev_day_scaled)
-            room_month_scaled = non_ev_day_scaled * 30.0 + ev_month_scaled
-
             kwh_by_room[rid] = round(room_kwh_scaled, 3)
             kwh_month_by_room[rid] = round(room_month_scaled, 3)
             kwh_ev_by_room[rid] = round(ev_day_scaled, 3)
             kwh_ev_month_by_room[rid] = round(ev_month_scaled, 3)
-
-            rooms_breakdown[rid] = {
-                "type": room.get("type", ""),
-                "label": room.get("label", rid),
-                "kwh_total": round(room_kwh_scaled, 3),
-                "kwh_month_total": round(room_month_scaled, 3),
-                "kwh_ev_month": round(ev_month_scaled, 3),
-                "breakdown": {k: round(v * size_factor * resident_factor, 3) for k, v in bd.items()}
-            }
+            rooms_breakdown[rid] = entry
     else:
         bd = _room_calc_breakdown(state.get("appliances") or {})
         kwh_total_raw = sum(bd.values()) * size_factor * resident_factor
@@ -905,11 +1322,9 @@ def compute_daily_energy(profile, state):
             temp_on = 0.0
             temp_off = 0.0
 
-            for rid, room in rooms.items():
-                rb_scaled = rooms_breakdown.get(rid, {}).get("breakdown", {})
-                room_on, room_off = _tou_split_from_room_breakdown(rb_scaled, room)
-                temp_on += room_on
-                temp_off += room_off
+            for parts in room_parts:
+                temp_on += parts[5]
+                temp_off += parts[6]
 
             known = temp_on + temp_off
             other = max(0.0, kwh_net - known)
@@ -941,8 +1356,6 @@ def compute_daily_energy(profile, state):
     # ============================================================
     # ✅ คิดเงินจริง: คำนวณ “รายเดือน” ทั้ง Non-TOU และ TOU เพื่อ Compare
     # ============================================================
-    billing = _load_billing_settings()
-
     # kWh/เดือน (ถ้าตั้งค่าแยกห้อง เรามี monthly จริงต่อห้องอยู่แล้ว)
     if use_rooms and kwh_month_by_room:
         kwh_month_total = sum(float(v or 0) for v in kwh_month_by_room.values())
@@ -1009,6 +1422,9 @@ def compute_daily_energy(profile, state):
             "tou_month": round(float(bill_t["total"]), 2),
             "diff_month": round(float(diff_month), 2),
             "recommend": recommend,
+            "kwh_month": round(kwh_month_total, 3),
+            "kwh_on_month": round(kwh_on_month, 3),
+            "kwh_off_month": round(kwh_off_month, 3),
             "meta": {
                 "ft_satang_per_kwh": float(billing.get("ft_rate", 0.0)),
                 "vat_rate": float(billing.get("vat_rate", 0.07)),
@@ -1018,6 +1434,57 @@ def compute_daily_energy(profile, state):
     }
 
 
+def household_features(profile, state):
+    """แยกบ้านเป็นส่วนที่ขึ้นกับค่าสัมประสิทธิ์ (แอร์/ตู้เย็น/ตัวคูณบ้าน) กับส่วนคงที่
+
+    calibration.model_month_kwh(MODEL_COEFFS, features) ต้องได้ kWh/เดือนเท่ากับ compute_daily_energy()
+    """
+    feats = {
+        "house_size": profile.get("house_size", "medium"),
+        "residents": max(1, int(profile.get("residents", 3))),
+        "ac": [], "fridge": [], "other_day": 0.0, "other_month": 0.0,
+    }
+    region = profile.get("region") or DEFAULT_REGION
+    month = sim_month(state)
+    rooms = state.get("rooms") or {}
+    use_rooms = isinstance(rooms, dict) and len(rooms) > 0
+    groups = [(r.get("appliances") or {}) for r in rooms.values() if isinstance(r, dict)] if use_rooms \
+        else [state.get("appliances") or {}]
+
+    for appl in groups:
+        for key, cfg in appl.items():
+            if not isinstance(cfg, dict) or not cfg.get("enabled", False):
+                continue
+            if key == "ac":
+                hours = float(cfg.get("hours", 6))
+                if hours > 0:
+                    set_temp = float(cfg.get("set_temp", 26))
+                    factor, _ = ac_window_factor(region, month, set_temp, _ac_window(cfg))
+                    feats["ac"].append((float(cfg.get("btu", 12000)) / 12000.0 * hours * factor,
+                                        set_temp, bool(cfg.get("inverter", True))))
+            elif key == "fridge":
+                qty = max(1, min(10, int(cfg.get("qty", 1) or 1)))
+                if cfg.get("kwh_per_day") is not None:
+                    try:
+                        feats["other_day"] += max(0.0, float(cfg.get("kwh_per_day", 1.2) or 1.2)) * qty
+                    except Exception:
+                        feats["other_day"] += 1.2 * qty
+                else:
+                    open_times = max(0, min(200, int(cfg.get("open_times", 20) or 20)))
+                    feats["fridge"].append((cfg.get("size_band", "10_14"), open_times, qty))
+            elif key == "ev_charger":
+                # แบบแยกห้อง: EV คิดรายเดือนจากจำนวนครั้งที่ชาร์จ/สัปดาห์ / แบบเดิม: 1 ครั้งต่อวัน
+                per_charge, per_month = _ev_month_kwh(cfg)
+                if use_rooms:
+                    feats["other_month"] += per_month
+                else:
+                    feats["other_day"] += per_charge
+            else:
+                feats["other_day"] += calc_generic_kwh(float(cfg.get("watts", 30 if key == "lights" else 0)),
+                                                       float(cfg.get("hours", 5 if key == "lights" else 0)))
+    return feats
+
+
 def recompute_level(points):
     lvl = 1
     for item in HOUSE_LEVELS:
@@ -1036,37 +1503,156 @@ def ensure_admin_seed():
     email = os.environ.get("ENERGY_LIFE_ADMIN_EMAIL", "admin@example.com")
     db.execute(
         "INSERT OR IGNORE INTO users(username,email,password_hash,role,created_at) VALUES(?,?,?,?,?)",
-        (username, email, generate_password_hash(password), "admin", datetime.utcnow().isoformat())
+        (username, email, generate_password_hash(password, PASSWORD_HASH_METHOD), "admin", datetime.utcnow().isoformat())
     )
     db.commit()
 
 
 # =========================
-# Flask App
+# Flask App (application factory)
 # =========================
-app = Flask(__name__)
-app.config["SECRET_KEY"] = SECRET_KEY
+# import app.py ไม่มี I/O: route ทั้งหมดอยู่ใน blueprint แล้วค่อยผูกกับ Flask app ตอน create_app()
+#   gunicorn:  ENERGY_LIFE_PRELOAD=1 gunicorn --preload "app:create_app()"
+#   CLI:       flask --app app <command>   (Flask เรียก create_app() ให้เอง)
+bp = Blueprint("main", __name__, cli_group=None)
+
+_warmup_lock = threading.Lock()
+
+
+def default_config():
+    return {
+        "DATABASE": os.environ.get("ENERGY_LIFE_DB", "energy_life.db"),
+        "V4_DATABASE": os.environ.get("ENERGY_LIFE_V4_DB", "v4_data.db"),
+        # ไม่ตั้ง = ใช้ค่าสุ่มจาก SECRET_KEY_FILE (ทุก worker / ทุกครั้งที่รีสตาร์ทได้ค่าเดียวกัน)
+        "SECRET_KEY": os.environ.get("ENERGY_LIFE_SECRET") or None,
+        "SECRET_KEY_FILE": os.environ.get("ENERGY_LIFE_SECRET_FILE") or None,  # None = <DATABASE>.secret
+        "PRELOAD": os.environ.get("ENERGY_LIFE_PRELOAD", "0") == "1",
+        "SNAPSHOT_DIR": os.environ.get("ENERGY_LIFE_SNAPSHOT_DIR", "snapshots"),
+        # 1 = หน้าสถิติ admin/officer และ export ทุกบ้านอ่านจาก snapshot ล่าสุดแทนฐานข้อมูลหลัก
+        "ANALYTICS_FROM_SNAPSHOT": os.environ.get("ENERGY_LIFE_ANALYTICS_SNAPSHOT", "0") == "1",
+    }
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.extensions["energy_life"] = {"ready": False, "warmup_ms": None,
+                                     "login_audit": LoginAuditBuffer(app.config["DATABASE"])}
+
+    app.register_blueprint(bp)
+    app.before_request(before_request)
+    app.teardown_appcontext(close_db)
+    init_static_assets(app)
+    configure_v4_db(app.config["V4_DATABASE"])
+
+    if not app.config["SECRET_KEY"]:
+        with app.app_context():
+            app.config["SECRET_KEY"] = _shared_secret_key(
+                app.config["SECRET_KEY_FILE"] or app.config["DATABASE"] + ".secret")
+    if app.config["PRELOAD"]:
+        warmup(app)
+    return app
+
+
+def _shared_secret_key(path):
+    """ค่าสุ่มในไฟล์ 0600 นอกฐานข้อมูล (ไม่ติดไปกับ snapshot/backup) — ทุก worker อ่านไฟล์เดียวกัน"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    # ติดตั้งเดิมเก็บไว้ใน settings: ย้ายออกมา (session เดิมยังใช้ได้) แล้วลบทิ้งจากฐานข้อมูล
+    db = get_db()
+    row = None
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='settings'").fetchone():
+        row = db.execute("SELECT value FROM settings WHERE key='session_secret'").fetchone()
+    secret = row[0] if row else os.urandom(24).hex()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secret)
+    try:
+        # worker ที่เริ่มพร้อมกัน: link ตัวแรกชนะ (ไม่ทับไฟล์ที่มีอยู่) ทุกตัวอ่านค่าเดียวกัน
+        os.link(tmp, path)
+    except FileExistsError:
+        with open(path) as f:
+            secret = f.read().strip()
+    finally:
+        os.remove(tmp)
+    if row:
+        db.execute("DELETE FROM settings WHERE key='session_secret'")
+        db.commit()
+    return secret
+
+
+def warmup(app):
+    """เตรียมทุกอย่างที่ request แรกต้องใช้ — เรียกก่อน fork (preload) หรืออัตโนมัติตอน request แรกของ worker"""
+    state = app.extensions["energy_life"]
+    with _warmup_lock:
+        if state["ready"]:
+            return
+        t0 = time.perf_counter()
+        with app.app_context():
+            init_v4_db()
+            init_db()
+            ensure_admin_seed()
+            load_model_coefficients()
+            _tariff_versions()
+            _cohort_cache["tables"] = load_cohort_tables(get_db())
+            _cohort_cache["expires"] = time.monotonic() + COHORT_CACHE_TTL
+        _catalog_by_key()
+        for region in REGIONS:
+            for month in range(1, 13):
+                outdoor_profile(region, month)
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        state.update(ready=True, warmup_ms=round((time.perf_counter() - t0) * 1000, 1))
 
 
-@app.before_request
 def before_request():
-    init_db()
-    ensure_admin_seed()
+    if not current_app.extensions["energy_life"]["ready"]:
+        warmup(current_app._get_current_object())
+
+
+def get_analytics_db():
+    """ฐานข้อมูลของรายงาน: snapshot ล่าสุด (อ่านอย่างเดียว) ถ้าเปิด ANALYTICS_FROM_SNAPSHOT และยังไม่เก่าเกิน
+    ไม่เช่นนั้นใช้ฐานข้อมูลหลัก — g.analytics_snapshot บอกว่าใช้อันไหน"""
+    if "analytics_db" not in g:
+        snap = None
+        if current_app.config["ANALYTICS_FROM_SNAPSHOT"]:
+            snap = latest_snapshot(current_app.config["SNAPSHOT_DIR"])
+        g.analytics_snapshot = snap
+        g.analytics_db = open_snapshot(snap["path"]) if snap else get_db()
+    return g.analytics_db
 
 
-@app.teardown_appcontext
 def close_db(exception):
+    analytics = g.pop("analytics_db", None)
     db = g.pop("db", None)
+    if analytics is not None and analytics is not db:
+        analytics.close()
     if db is not None:
         db.close()
 
 
-@app.route("/landing")
+@bp.route("/readyz")
+def readyz():
+    """readiness probe: 200 เมื่อ warmup เสร็จและเปิดฐานข้อมูลได้"""
+    state = current_app.extensions["energy_life"]
+    try:
+        get_db().execute("SELECT 1 FROM users LIMIT 1")
+    except sqlite3.Error as e:
+        return jsonify({"ok": False, "error": str(e)}), 503
+    return jsonify({"ok": state["ready"], "warmup_ms": state["warmup_ms"], "model_version": _model_coeffs_state["version"]})
+
+
+@bp.route("/landing")
 def landing():
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
 
 
-@app.route("/")
+@bp.route("/")
 def index():
     increment_visitor()
     visitor_count = get_visitor_count()
@@ -1076,7 +1662,7 @@ def index():
 # ============================================================
 # A) HOME
 # ============================================================
-@app.route("/home")
+@bp.route("/home")
 @login_required
 def home():
     user = current_user()
@@ -1089,12 +1675,13 @@ def home():
         points=st["points"],
         house_level=st["house_level"],
         levels=HOUSE_LEVELS,
+        upgrades=recommend_upgrades(user["id"], st["profile"], st["state"], version=st["updated_at"]),
         appliances_catalog=APPLIANCES_CATALOG,
         app_name=APP_NAME
     )
 
 
-@app.route("/house-setup", methods=["GET", "POST"])
+@bp.route("/house-setup", methods=["GET", "POST"])
 @login_required
 def house_setup():
     user = current_user()
@@ -1110,6 +1697,11 @@ def house_setup():
 
     if request.method == "POST":
         house_type = request.form.get("house_type", "condo")
+        if house_type not in HOUSE_TYPES:
+            house_type = "condo"
+        region = request.form.get("region", DEFAULT_REGION)
+        if region in REGIONS:
+            st["profile"]["region"] = region
 
         bedroom  = to_int("bedroom", 1, 0, 10)
         bathroom = to_int("bathroom", 1, 0, 10)
@@ -1135,12 +1727,12 @@ def house_setup():
 
         save_user_state(user["id"], st["profile"], state, st["points"], st["house_level"])
         flash("บันทึกโครงสร้างบ้านแล้ว ✅ ต่อไปตั้งค่าอุปกรณ์ตามห้องได้เลย", "success")
-        return redirect(url_for("home"))
+        return redirect(url_for("main.home"))
 
     return render_template("house_setup.html", user=user, st=st, app_name=APP_NAME)
 
 
-@app.route("/rooms-setup", methods=["GET"])
+@bp.route("/rooms-setup", methods=["GET"])
 @login_required
 def rooms_setup():
     user = current_user()
@@ -1156,8 +1748,70 @@ def rooms_setup():
     )
 
 
+_catalog_index = {}
+
+
 def _catalog_by_key():
-    return {a["key"]: a for a in APPLIANCES_CATALOG}
+    # สร้างครั้งเดียวต่อ process (warmup() สร้างไว้ก่อน fork) — ห้ามแก้ค่าที่ได้
+    if not _catalog_index:
+        _catalog_index.update((a["key"], a) for a in APPLIANCES_CATALOG)
+    return _catalog_index
+
+
+# ตัวเลือกของฟอร์ม (room_detail.html / house_setup.html)
+LIGHT_MODES = ("LED", "Normal")
+HOUSE_TYPES = ("condo", "single_1", "single_2", "single_3")
+
+# ✅ ช่วงค่าที่ยอมรับต่อฟิลด์ของอุปกรณ์ (ใช้ร่วมกันระหว่าง room_detail() และ PATCH /api/state)
+# (kind, min, max) — kind: "int" | "float" | "bool" | "choice" (min = ตัวเลือก)
+APPLIANCE_FIELD_RULES = {
+    "ac": {
+        "btu": ("int", 6000, 60000),
+        "set_temp": ("int", 16, 30),
+        "hours": ("float", 0, 24),
+        "inverter": ("bool", None, None),
+        "start_hour": ("int", 0, 23),
+        "end_hour": ("int", 0, 23),
+    },
+    "lights": {
+        "mode": ("choice", LIGHT_MODES, None),
+        "watts": ("float", 0, 5000),
+        "hours": ("float", 0, 24),
+    },
+    "fridge": {
+        "size_band": ("choice", FRIDGE_SIZE_BANDS, None),
+        "qty": ("int", 1, 10),
+        "open_times": ("int", 0, 200),
+    },
+    "ev_charger": {
+        "battery_kwh": ("float", 10, 200),
+        "charger_kw": ("float", 0.1, 50),
+        "efficiency": ("float", 0.5, 1.0),
+        "soc_from": ("int", 0, 100),
+        "soc_to": ("int", 0, 100),
+        "charges_per_week": ("int", 0, 14),
+        "start_hour": ("int", 0, 23),
+    },
+    "generic": {
+        "watts": ("float", 0, 100000),
+        "hours": ("float", 0, 24),
+    },
+}
+
+
+def appliance_field_rules(appliance_type: str) -> dict:
+    return APPLIANCE_FIELD_RULES.get(appliance_type) or APPLIANCE_FIELD_RULES["generic"]
+
+
+def derive_ev_charger_fields(cfg: dict) -> dict:
+    # ชั่วโมงชาร์จ/เวลาสิ้นสุด คำนวณจากแบต + SOC + กำลังชาร์จ (ผู้ใช้ไม่ได้กรอกเอง)
+    kwh_per_charge = calc_ev_kwh_per_charge(cfg["battery_kwh"], cfg["soc_from"], cfg["soc_to"], cfg["efficiency"])
+    hours = calc_ev_hours(kwh_per_charge, cfg["charger_kw"])
+    cfg["hours"] = round(hours, 2)
+
+    dur = int(max(1, math.ceil(hours))) if hours > 0 else 1
+    cfg["end_hour"] = (normalize_hour(cfg["start_hour"]) + dur) % 24
+    return cfg
 
 
 def _to_bool(v):
@@ -1188,7 +1842,18 @@ def _to_float_form(name, default=0.0, min_v=None, max_v=None):
     return v
 
 
-@app.route("/room/<rid>", methods=["GET", "POST"])
+def room_saved_event(rid, room, first_time):
+    ac = (room.get("appliances") or {}).get("ac") or {}
+    return {
+        "room_id": rid,
+        "room_type": room.get("type", ""),
+        "first_time": bool(first_time),
+        "ac_enabled": bool(ac.get("enabled", False)),
+        "ac_set_temp": _to_float_safe(ac.get("set_temp", 26), 26),
+    }
+
+
+@bp.route("/room/<rid>", methods=["GET", "POST"])
 @login_required
 def room_detail(rid):
     user = current_user()
@@ -1198,7 +1863,7 @@ def room_detail(rid):
 
     if rid not in rooms:
         flash("ไม่พบห้องนี้ (ลองกลับไปหน้า Rooms Setup)", "error")
-        return redirect(url_for("rooms_setup"))
+        return redirect(url_for("main.rooms_setup"))
 
     room = rooms[rid]
     catalog = _catalog_by_key()
@@ -1227,58 +1892,34 @@ def room_detail(rid):
 
             t = c.get("type")
 
-            if t == "ac":
-                cfg["btu"] = _to_int_form(f"{key}__btu", cfg.get("btu", 12000), 6000, 60000)
-                cfg["set_temp"] = _to_int_form(f"{key}__set_temp", cfg.get("set_temp", 26), 16, 30)
-                cfg["hours"] = _to_float_form(f"{key}__hours", cfg.get("hours", 6), 0, 24)
-                cfg["inverter"] = _to_bool(request.form.get(f"{key}__inverter", "off"))
-                cfg["start_hour"] = _to_int_form(f"{key}__start_hour", cfg.get("start_hour", 20), 0, 23)
-                cfg["end_hour"] = _to_int_form(f"{key}__end_hour", cfg.get("end_hour", 2), 0, 23)
-
-            elif t == "lights":
-                cfg["mode"] = request.form.get(f"{key}__mode", cfg.get("mode", "LED"))
-                cfg["watts"] = _to_float_form(f"{key}__watts", cfg.get("watts", 30), 0, 5000)
-                cfg["hours"] = _to_float_form(f"{key}__hours", cfg.get("hours", 5), 0, 24)
-
-            elif t == "fridge":
-                # ✅ เฟส 1 (แผน A): บันทึกแบบเลือกกี่คิว + จำนวน + เปิด/วัน
-                cfg["size_band"] = request.form.get(f"{key}__size_band", cfg.get("size_band", "10_14"))
-                cfg["qty"] = _to_int_form(f"{key}__qty", cfg.get("qty", 1), 1, 10)
-                cfg["open_times"] = _to_int_form(f"{key}__open_times", cfg.get("open_times", 20), 0, 200)
-
-                # ✅ กันกรณี state เก่ามี kwh_per_day: ไม่ต้องลบทิ้งก็ได้ แต่ไม่ใช้ใน UI แล้ว
-                # (ถ้าคุณอยาก “ล้างทิ้ง” ให้ uncomment บรรทัดนี้)
-                # cfg.pop("kwh_per_day", None)
-
-            elif t == "ev_charger":
-                cfg["battery_kwh"] = _to_float_form(f"{key}__battery_kwh", cfg.get("battery_kwh", 60.0), 10, 200)
-                cfg["charger_kw"] = _to_float_form(f"{key}__charger_kw", cfg.get("charger_kw", 7.4), 0.1, 50)
-                cfg["efficiency"] = _to_float_form(f"{key}__efficiency", cfg.get("efficiency", 0.9), 0.5, 1.0)
-                cfg["soc_from"] = _to_int_form(f"{key}__soc_from", cfg.get("soc_from", 30), 0, 100)
-                cfg["soc_to"] = _to_int_form(f"{key}__soc_to", cfg.get("soc_to", 80), 0, 100)
-                cfg["charges_per_week"] = _to_int_form(f"{key}__charges_per_week", cfg.get("charges_per_week", 2), 0, 14)
-                cfg["start_hour"] = _to_int_form(f"{key}__start_hour", cfg.get("start_hour", 22), 0, 23)
-
-                kwh_per_charge = calc_ev_kwh_per_charge(cfg["battery_kwh"], cfg["soc_from"], cfg["soc_to"], cfg["efficiency"])
-                hours = calc_ev_hours(kwh_per_charge, cfg["charger_kw"])
-                cfg["hours"] = round(hours, 2)
-
-                dur = int(max(1, math.ceil(hours))) if hours > 0 else 1
-                cfg["end_hour"] = (normalize_hour(cfg["start_hour"]) + dur) % 24
-
-            else:
-                cfg["watts"] = _to_float_form(f"{key}__watts", cfg.get("watts", 100), 0, 100000)
-                cfg["hours"] = _to_float_form(f"{key}__hours", cfg.get("hours", 1), 0, 24)
+            for field, (kind, min_v, max_v) in appliance_field_rules(t).items():
+                name = f"{key}__{field}"
+                if kind == "bool":
+                    cfg[field] = _to_bool(request.form.get(name, "off"))
+                elif kind == "int":
+                    cfg[field] = _to_int_form(name, cfg.get(field, min_v), min_v, max_v)
+                elif kind == "float":
+                    cfg[field] = _to_float_form(name, cfg.get(field, min_v), min_v, max_v)
+                elif kind == "choice":
+                    value = request.form.get(name)
+                    if value in min_v:
+                        cfg[field] = value
+
+            # ✅ ตู้เย็น: state เก่าอาจมี kwh_per_day — ไม่ต้องลบทิ้งก็ได้ แต่ไม่ใช้ใน UI แล้ว
+            if t == "ev_charger":
+                derive_ev_charger_fields(cfg)
 
             appl[key] = cfg
 
+        first_time = not rooms[rid].get("configured", False)
         rooms[rid]["appliances"] = appl
         rooms[rid]["configured"] = True
 
         state["rooms"] = rooms
+        emit_mission_event(user["id"], "room_saved", room_saved_event(rid, rooms[rid], first_time))
         save_user_state(user["id"], st["profile"], state, st["points"], st["house_level"])
         flash("บันทึกอุปกรณ์ในห้องแล้ว ✅", "success")
-        return redirect(url_for("home"))
+        return redirect(url_for("main.home"))
 
     return render_template(
         "room_detail.html",
@@ -1291,27 +1932,45 @@ def room_detail(rid):
     )
 
 
-@app.route("/login", methods=["GET", "POST"])
+AUTH_BUSY_RETRY_AFTER = 2
+
+
+def _auth_busy(template):
+    flash("ระบบกำลังมีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้งในไม่กี่วินาที", "error")
+    return render_template(template, app_name=APP_NAME), 429, {"Retry-After": str(AUTH_BUSY_RETRY_AFTER)}
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
         db = get_db()
         user = db.execute("SELECT * FROM users WHERE username=? OR email=?", (username, username)).fetchone()
-        if user and check_password_hash(user["password_hash"], password):
+        try:
+            ok = bool(user) and verify_password(user["password_hash"], password)
+        except PasswordPoolBusy:
+            return _auth_busy("login.html")
+        if ok and needs_rehash(user["password_hash"]):
+            # พารามิเตอร์ KDF เปลี่ยน: hash ใหม่ตอนที่รู้รหัสผ่านจริง
+            # ทำได้ก็ทำ — คิวเต็มไม่ทำให้ล็อกอินไม่ผ่าน (ได้ hash ใหม่ในการล็อกอินครั้งถัดไป)
+            try:
+                db.execute("UPDATE users SET password_hash=? WHERE id=?", (rehash_password(password), user["id"]))
+                db.commit()
+            except PasswordPoolBusy:
+                pass
+        if ok:
             session["user_id"] = user["id"]
             ensure_user_prefs(user["id"])
-            db.execute(
-                "INSERT INTO login_log(user_id,ip,user_agent,created_at) VALUES(?,?,?,?)",
-                (user["id"], request.remote_addr, request.headers.get("User-Agent", ""), datetime.utcnow().isoformat())
-            )
-            db.commit()
-            return redirect(url_for("home"))
+            # ไม่ commit ใน request: buffer เขียน log + last_login_at ทีละชุด
+            current_app.extensions["energy_life"]["login_audit"].record(
+                user["id"], request.remote_addr, request.headers.get("User-Agent", ""))
+            return redirect(url_for("main.home"))
         flash("ชื่อผู้ใช้/รหัสผ่านไม่ถูกต้อง", "error")
     return render_template("login.html", app_name=APP_NAME)
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
         username = request.form.get("username", "").strip()
@@ -1321,35 +1980,39 @@ def register():
             flash("ชื่อผู้ใช้ต้อง ≥ 3 ตัวอักษร และรหัสผ่านต้อง ≥ 6 ตัวอักษร", "error")
             return render_template("register.html", app_name=APP_NAME)
 
+        try:
+            pwhash = hash_password(password)
+        except PasswordPoolBusy:
+            return _auth_busy("register.html")
+
         db = get_db()
         try:
-            db.execute(
-                "INSERT INTO users(username,email,password_hash,role,created_at) VALUES(?,?,?,?,?)",
-                (username, email, generate_password_hash(password), "player", datetime.utcnow().isoformat())
+            cur = db.execute(
+                "INSERT INTO users(username,email,password_hash,role,created_at,display_name,share_token) VALUES(?,?,?,?,?,?,?)",
+                (username, email, pwhash, "player", datetime.utcnow().isoformat(), username, make_token(24))
             )
             db.commit()
-            uid = db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()["id"]
-            db.execute("UPDATE users SET display_name=?, share_token=? WHERE id=?", (username, make_token(24), uid))
-            db.commit()
+            uid = cur.lastrowid
             ensure_user_prefs(uid)
         except sqlite3.IntegrityError:
             flash("ชื่อผู้ใช้หรืออีเมลนี้ถูกใช้แล้ว", "error")
             return render_template("register.html", app_name=APP_NAME)
 
         flash("สมัครสมาชิกสำเร็จ! กรุณาเข้าสู่ระบบ", "success")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     return render_template("register.html", app_name=APP_NAME)
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
 
 
-@app.route("/api/state", methods=["GET", "POST"])
+@bp.route("/api/state", methods=["GET", "POST"])
 @login_required
+@idempotent
 def api_state():
     user = current_user()
     st = get_or_create_user_state(user["id"])
@@ -1378,14 +2041,428 @@ def api_state():
     return jsonify({"profile": st["profile"], "state": st["state"], "points": st["points"], "house_level": st["house_level"]})
 
 
-@app.route("/api/simulate_day", methods=["POST"])
+# ============================================================
+# ✅ PATCH /api/state — แก้ไขบางฟิลด์ (RFC 6902 JSON Patch)
+# ============================================================
+STATE_FIELD_RULES = {
+    "tariff_mode": ("choice", ("non_tou", "tou"), None),
+    "solar_mode": ("choice", ("manual", "advisor"), None),
+    "solar_kw": ("float", 0, 10),
+    "ev_enabled": ("bool", None, None),
+}
+
+PROFILE_FIELD_RULES = {
+    "display_name": ("str", 3, 16),  # กติกาเดียวกับฟอร์ม /profile
+    "player_type": ("choice", ("family", "adult", "kid"), None),
+    "house_type": ("choice", HOUSE_TYPES, None),
+    "house_size": ("choice", ("small", "medium", "large"), None),
+    "residents": ("int", 1, 20),
+    "region": ("choice", REGIONS, None),
+}
+
+SIM_DELTA_KEYS = ["kwh_total", "kwh_net", "kwh_on", "kwh_off", "kwh_solar_used", "kwh_ev", "cost_thb"]
+SIM_COMPARE_DELTA_KEYS = ["non_tou_month", "tou_month", "diff_month"]
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _json_pointer_parts(path):
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"path ไม่ถูกต้อง: {path!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+
+def _coerce_patch_value(value, rule, path):
+    kind, a, b = rule
+    if kind == "bool":
+        if not isinstance(value, bool):
+            raise PatchError(f"{path}: ต้องเป็น true/false")
+        return value
+    if kind == "choice":
+        if value not in a:
+            raise PatchError(f"{path}: ต้องเป็นหนึ่งใน {', '.join(a)}")
+        return value
+    if kind == "str":
+        if not isinstance(value, str):
+            raise PatchError(f"{path}: ต้องเป็นข้อความ")
+        value = value.strip()
+        if not a <= len(value) <= b:
+            raise PatchError(f"{path}: ต้องยาว {a}–{b} ตัวอักษร")
+        return value
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise PatchError(f"{path}: ต้องเป็นตัวเลข")
+    if kind == "int":
+        if value != int(value):
+            raise PatchError(f"{path}: ต้องเป็นจำนวนเต็ม")
+        value = int(value)
+    else:
+        value = float(value)
+    if value < a or value > b:
+        raise PatchError(f"{path}: ต้องอยู่ในช่วง {a}–{b}")
+    return value
+
+
+def _patch_target(profile, state, parts, catalog):
+    """คืน (dict เป้าหมาย, ชื่อฟิลด์, rule, catalog item หรือ None, room id หรือ None)"""
+    if len(parts) == 2 and parts[0] == "profile" and parts[1] in PROFILE_FIELD_RULES:
+        return profile, parts[1], PROFILE_FIELD_RULES[parts[1]], None, None
+
+    if len(parts) == 1 and parts[0] in STATE_FIELD_RULES:
+        return state, parts[0], STATE_FIELD_RULES[parts[0]], None, None
+
+    rid = None
+    if len(parts) == 5 and parts[0] == "rooms" and parts[2] == "appliances":
+        rid, key, field = parts[1], parts[3], parts[4]
+        room = (state.get("rooms") or {}).get(rid)
+        if not isinstance(room, dict):
+            raise PatchError(f"ไม่พบห้อง {rid}")
+        appl = room.setdefault("appliances", {})
+    elif len(parts) == 3 and parts[0] == "appliances":
+        key, field = parts[1], parts[2]
+        appl = state.setdefault("appliances", {})
+    else:
+        raise PatchError(f"ไม่รองรับ path: /{'/'.join(parts)}")
+
+    c = catalog.get(key)
+    if not c or key not in appl:
+        raise PatchError(f"ไม่พบอุปกรณ์ {key}")
+
+    # เติมค่า default แบบเดียวกับ room_detail() ก่อนแก้ไข
+    merged = dict(c["defaults"])
+    if isinstance(appl.get(key), dict):
+        merged.update(appl[key])
+    appl[key] = merged
+
+    if field == "enabled":
+        rule = ("bool", None, None)
+    else:
+        rule = appliance_field_rules(c.get("type")).get(field)
+    if rule is None:
+        raise PatchError(f"แก้ไขฟิลด์ {field} ของ {key} ไม่ได้")
+    return merged, field, rule, c, rid
+
+
+def apply_state_patch(profile, state, ops):
+    """ใช้ JSON Patch กับสำเนาของ profile/state — ถ้ามี op ใดผิด จะไม่แก้อะไรเลย"""
+    if not isinstance(ops, list) or not ops:
+        raise PatchError("body ต้องเป็นรายการ operation (JSON array)")
+
+    profile = json.loads(json.dumps(profile))
+    state = json.loads(json.dumps(state))
+    catalog = _catalog_by_key()
+    touched_rooms = set()
+
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError("operation ต้องเป็น object")
+        kind = op.get("op")
+        path = op.get("path")
+        parts = _json_pointer_parts(path)
+        target, field, rule, c, rid = _patch_target(profile, state, parts, catalog)
+
+        if kind == "test":
+            if target.get(field) != op.get("value"):
+                raise PatchError(f"test ไม่ผ่าน: {path}")
+            continue
+        if kind in ("add", "replace"):
+            if "value" not in op:
+                raise PatchError(f"{path}: ต้องระบุ value")
+            target[field] = _coerce_patch_value(op["value"], rule, path)
+        elif kind == "remove":
+            # ลบฟิลด์อุปกรณ์ = กลับไปใช้ค่า default ของ catalog
+            if c is None or field not in c["defaults"]:
+                raise PatchError(f"remove ใช้ได้กับฟิลด์อุปกรณ์เท่านั้น: {path}")
+            target[field] = c["defaults"][field]
+        else:
+            raise PatchError(f"ไม่รองรับ op: {kind!r}")
+
+        if c is not None and c.get("type") == "ev_charger":
+            derive_ev_charger_fields(target)
+        if rid is not None:
+            state["rooms"][rid]["configured"] = True
+            touched_rooms.add(rid)
+
+    return profile, state, touched_rooms
+
+
+def simulation_delta(before: dict, after: dict, rooms=None) -> dict:
+    out = {
+        "result": {k: after.get(k) for k in SIM_DELTA_KEYS},
+        "delta": {k: round(float(after.get(k, 0) or 0) - float(before.get(k, 0) or 0), 3) for k in SIM_DELTA_KEYS},
+    }
+    cb, ca = before.get("compare") or {}, after.get("compare") or {}
+    out["compare"] = {k: ca.get(k) for k in SIM_COMPARE_DELTA_KEYS}
+    out["compare"]["recommend"] = ca.get("recommend")
+    out["compare_delta"] = {k: round(float(ca.get(k, 0) or 0) - float(cb.get(k, 0) or 0), 2) for k in SIM_COMPARE_DELTA_KEYS}
+    if rooms:
+        rb = after.get("rooms_breakdown") or {}
+        out["rooms"] = {rid: rb.get(rid) for rid in sorted(rooms)}
+    return out
+
+
+@bp.route("/api/state", methods=["PATCH"])
 @login_required
+@idempotent
+def api_state_patch():
+    user = current_user()
+    st = get_or_create_user_state(user["id"])
+    ops = request.get_json(force=True, silent=True)
+
+    try:
+        profile, state, touched_rooms = apply_state_patch(st["profile"], st["state"], ops)
+    except PatchError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    billing = billing_settings_at(sim_day(st["state"]))
+    before = compute_daily_energy(st["profile"], st["state"], billing)
+    after = compute_daily_energy(profile, state, billing)
+
+    old_rooms = st["state"].get("rooms") or {}
+    for rid in sorted(touched_rooms):
+        first_time = not (old_rooms.get(rid) or {}).get("configured", False)
+        emit_mission_event(user["id"], "room_saved", room_saved_event(rid, state["rooms"][rid], first_time))
+    save_user_state(user["id"], profile, state, st["points"], st["house_level"])
+    return jsonify({"ok": True, **simulation_delta(before, after, touched_rooms)})
+
+
+# ============================================================
+# What-if: คำนวณหลาย scenario จาก state ปัจจุบันในครั้งเดียว (ไม่เขียนฐานข้อมูล)
+# ============================================================
+SCENARIO_MAX = 50
+
+
+def _scenario_all_ops(state, overrides):
+    """ขยาย {"ac": {"set_temp": 27}} เป็น replace op ของทุกห้องที่มีอุปกรณ์นั้น"""
+    if not isinstance(overrides, dict):
+        raise PatchError("all ต้องเป็น object {อุปกรณ์: {ฟิลด์: ค่า}}")
+    ops = []
+    rooms = state.get("rooms") or {}
+    for key, fields in overrides.items():
+        if not isinstance(fields, dict) or not fields:
+            raise PatchError(f"all.{key} ต้องเป็น object ของฟิลด์ที่จะแก้")
+        if isinstance(rooms, dict) and rooms:
+            bases = [f"/rooms/{rid}/appliances/{key}" for rid, room in rooms.items()
+                     if isinstance(room, dict) and key in (room.get("appliances") or {})]
+        else:
+            bases = [f"/appliances/{key}"] if key in (state.get("appliances") or {}) else []
+        if not bases:
+            raise PatchError(f"ไม่พบอุปกรณ์ {key}")
+        for b in bases:
+            ops.extend({"op": "replace", "path": f"{b}/{field}", "value": v} for field, v in fields.items())
+    return ops
+
+
+def evaluate_scenarios(profile, state, scenarios, base_ops=None):
+    """คืน (ผลของ base, รายการผลต่อ scenario) — scenario ที่ผิดจะได้ error ของตัวเองโดยไม่กระทบตัวอื่น"""
+    billing = billing_settings_at(sim_day(state))
+    if base_ops:
+        profile, state, _ = apply_state_patch(profile, state, base_ops)
+    base = compute_daily_energy(profile, state, billing)
+
+    out = []
+    for i, sc in enumerate(scenarios):
+        if not isinstance(sc, dict):
+            out.append({"label": f"#{i + 1}", "ok": False, "error": "scenario ต้องเป็น object"})
+            continue
+        label = str(sc.get("label") or f"#{i + 1}")[:80]
+        try:
+            ops = list(sc.get("ops") or [])
+            if sc.get("all") is not None:
+                ops.extend(_scenario_all_ops(state, sc["all"]))
+            p2, s2, touched = apply_state_patch(profile, state, ops)
+        except PatchError as e:
+            out.append({"label": label, "ok": False, "error": str(e)})
+            continue
+        res = compute_daily_energy(p2, s2, billing)
+        out.append({"label": label, "ok": True, **simulation_delta(base, res, touched)})
+    return base, out
+
+
+@bp.route("/api/scenarios", methods=["POST"])
+@login_required
+def api_scenarios():
+    data = request.get_json(force=True, silent=True) or {}
+    scenarios = data.get("scenarios")
+    if not isinstance(scenarios, list) or not scenarios:
+        return jsonify({"ok": False, "error": "ต้องระบุ scenarios อย่างน้อย 1 รายการ"}), 400
+    if len(scenarios) > SCENARIO_MAX:
+        return jsonify({"ok": False, "error": f"ส่งได้ไม่เกิน {SCENARIO_MAX} scenario ต่อครั้ง"}), 400
+
+    st = peek_user_state(current_user()["id"])
+    try:
+        base, results = evaluate_scenarios(st["profile"], st["state"], scenarios, data.get("base"))
+    except PatchError as e:
+        return jsonify({"ok": False, "error": f"base: {e}"}), 400
+
+    ok = [r for r in results if r["ok"]]
+    best = min(ok, key=lambda r: min(r["compare"]["non_tou_month"], r["compare"]["tou_month"]), default=None)
+    return jsonify({
+        "ok": True,
+        "base": {
+            "result": {k: base.get(k) for k in SIM_DELTA_KEYS},
+            "compare": {k: base["compare"].get(k) for k in SIM_COMPARE_DELTA_KEYS + ["recommend"]},
+        },
+        "scenarios": results,
+        "best": best["label"] if best else None,
+    })
+
+
+# ============================================================
+# Upgrade recommender: ของในร้านหมวด energy -> ผลต่อพารามิเตอร์ของอุปกรณ์
+# ============================================================
+# (อุปกรณ์, ฟิลด์, "mul" | "set", ค่า, เงื่อนไข {ฟิลด์: ค่า} หรือ None)
+# ของที่ลดภาระแอร์ = แอร์ทำงานสั้นลง (hours) ซึ่งเป็นเชิงเส้นกับ kWh และช่วง TOU เดิม
+UPGRADE_EFFECTS = {
+    "door_stopper": [("ac", "hours", "mul", 0.95, None)],
+    "uv_film": [("ac", "hours", "mul", 0.92, None)],
+    "thermal_curtain": [("ac", "hours", "mul", 0.90, None)],
+    "ac_clean": [("ac", "hours", "mul", 0.90, None)],
+    "led_pack": [("lights", "watts", "mul", 0.40, {"mode": "Normal"}),
+                 ("lights", "mode", "set", "LED", {"mode": "Normal"})],
+    "smart_strip": [("standby", "watts", "mul", 0.35, None)],
+}
+UPGRADE_TOP_COMBOS = 3
+UPGRADE_CACHE_MAX = 4096
+
+# user_id -> (signature, ผลลัพธ์) — signature = (user_state.updated_at, ของที่มี, อัตราค่าไฟ, เวอร์ชันโมเดล)
+_upgrade_cache = {}
+
+
+def _apply_upgrade_effects(state, upgrade_keys):
+    """คืนสำเนา state ที่ใส่ผลของ upgrade ทั้งหมดแล้ว (ผลซ้อนกันแบบคูณ)"""
+    state = json.loads(json.dumps(state))
+    rooms = state.get("rooms") or {}
+    if isinstance(rooms, dict) and rooms:
+        targets = [(r.get("appliances") or {}) for r in rooms.values() if isinstance(r, dict)]
+    else:
+        targets = [state.get("appliances") or {}]
+    catalog = _catalog_by_key()
+
+    for key in upgrade_keys:
+        for appl_key, field, op, value, when in UPGRADE_EFFECTS.get(key, []):
+            for appl in targets:
+                cfg = appl.get(appl_key)
+                # อุปกรณ์ที่ปิดอยู่/ยังไม่ได้ตั้งค่า ({}) ไม่ถูกคิดในโมเดล จึงไม่มีผล
+                if not isinstance(cfg, dict) or not cfg.get("enabled", False):
+                    continue
+                defaults = (catalog.get(appl_key) or {}).get("defaults", {})
+                if when and any(cfg.get(k, defaults.get(k)) != v for k, v in when.items()):
+                    continue
+                if op == "mul":
+                    cfg[field] = float(cfg.get(field, defaults.get(field, 0)) or 0) * value
+                else:
+                    cfg[field] = value
+    return state
+
+
+def _bill_for_mode(res, tariff_mode):
+    cmp_ = res["compare"]
+    return float(cmp_["tou_month"] if tariff_mode == "tou" else cmp_["non_tou_month"])
+
+
+def recommend_upgrades(user_id, profile, state, billing=None, version=None):
+    """จัดอันดับ upgrade (เดี่ยว + ชุดที่ดีที่สุด) ตามค่าไฟที่ลดได้ต่อเดือนของมิเตอร์ที่ใช้อยู่
+
+    ของที่มีแล้วถูกใส่ผลใน baseline (ไม่แนะนำซ้ำ) / version = user_state.updated_at: ผลเดิมใช้ซ้ำจาก cache
+    (ในเดือนเดียวกัน — ตัวคูณความร้อนของแอร์ขึ้นกับเดือน)
+    """
+    billing = billing or billing_settings_at(sim_day(state))
+    owned = sorted(k for k in UPGRADE_EFFECTS if inv_get(user_id, k) > 0)
+    sig = None
+    if version is not None:
+        sig = (version, sim_month(state), tuple(owned), tuple(sorted(billing.items())), _model_coeffs_state["version"])
+        hit = _upgrade_cache.get(user_id)
+        if hit is not None and hit[0] == sig:
+            return hit[1]
+
+    tariff_mode = state.get("tariff_mode", "non_tou")
+    base_state = _apply_upgrade_effects(state, owned)
+    base = compute_daily_energy(profile, base_state, billing)
+    base_bill = _bill_for_mode(base, tariff_mode)
+
+    def _evaluate(keys):
+        res = compute_daily_energy(profile, _apply_upgrade_effects(base_state, keys), billing)
+        cost = sum(SHOP_BY_KEY[k]["cost"] for k in keys)
+        return {
+            "keys": list(keys),
+            "names": [SHOP_BY_KEY[k]["name"] for k in keys],
+            "cost_points": cost,
+            "saved_thb_month": round(base_bill - _bill_for_mode(res, tariff_mode), 2),
+            "saved_kwh_day": round(float(base["kwh_total"]) - float(res["kwh_total"]), 3),
+            "compare_delta": {
+                k: round(float(res["compare"][k]) - float(base["compare"][k]), 2) for k in SIM_COMPARE_DELTA_KEYS
+            },
+        }
+
+    singles = [_evaluate((key,)) for key in UPGRADE_EFFECTS if key not in owned]
+    singles.sort(key=lambda r: r["saved_thb_month"], reverse=True)
+
+    # ชุดรวม: ลองทุก subset ของของที่ยังไม่มีและช่วยได้จริง (สูงสุด 2^6 แบบ)
+    useful = [r["keys"][0] for r in singles if r["saved_thb_month"] > 0]
+    combos = []
+    for n in range(2, len(useful) + 1):
+        for keys in itertools.combinations(useful, n):
+            combos.append(_evaluate(keys))
+    combos.sort(key=lambda r: (-r["saved_thb_month"], r["cost_points"]))
+
+    out = {
+        "tariff_mode": tariff_mode,
+        "base_bill_month": round(base_bill, 2),
+        "owned": [{"key": k, "name": SHOP_BY_KEY[k]["name"]} for k in owned],
+        "singles": singles,
+        "combos": combos[:UPGRADE_TOP_COMBOS],
+    }
+    if sig is not None:
+        if len(_upgrade_cache) >= UPGRADE_CACHE_MAX:
+            _upgrade_cache.clear()
+        _upgrade_cache[user_id] = (sig, out)
+    return out
+
+
+@bp.route("/api/upgrades", methods=["GET"])
+@login_required
+def api_upgrades():
+    user = current_user()
+    st = peek_user_state(user["id"])
+    return jsonify({"ok": True, **recommend_upgrades(user["id"], st["profile"], st["state"], version=st["updated_at"])})
+
+
+# ============================================================
+# Cohort: เทียบกับบ้านที่คล้ายกัน (ตารางสร้างล่วงหน้าด้วย flask --app app cohorts)
+# ============================================================
+COHORT_CACHE_TTL = float(os.environ.get("ENERGY_LIFE_COHORT_CACHE_TTL", 300))
+
+_cohort_cache = {"expires": 0.0, "tables": {}}
+
+
+def cohort_lookup(profile, state, kwh_day):
+    now = time.monotonic()
+    if _cohort_cache["expires"] <= now:
+        _cohort_cache["tables"] = load_cohort_tables(get_db())
+        _cohort_cache["expires"] = now + COHORT_CACHE_TTL
+    return cohort_percentile(_cohort_cache["tables"], cohort_of(profile, state), float(kwh_day))
+
+
+@bp.route("/api/simulate_day", methods=["POST"])
+@login_required
+@idempotent
 def api_simulate_day():
     user = current_user()
     st = get_or_create_user_state(user["id"])
     profile, state = st["profile"], st["state"]
 
-    res = compute_daily_energy(profile, state)
+    # บิลของวันจำลองใช้อัตราที่มีผลในวันนั้น (ไม่ใช่อัตราปัจจุบัน)
+    sim_date = sim_day(state)
+    res = compute_daily_energy(profile, state, billing_settings_at(sim_date))
+    cohort = cohort_lookup(profile, state, res["kwh_total"])
+    if cohort:
+        res["cohort"] = cohort
+        res["insights"].append(
+            f"ใช้ไฟมากกว่าบ้านที่คล้ายกัน {cohort['percentile']}% (เทียบ {cohort['n']} หลัง)"
+        )
 
     delta_points = int(res["points_earned"])
     points_new = int(st["points"]) + delta_points
@@ -1393,58 +2470,211 @@ def api_simulate_day():
 
     db = get_db()
     day = f"Day {int(state.get('day_counter', 1))}"
-    db.execute("""
-        INSERT INTO energy_daily(user_id,day,kwh_total,cost_thb,kwh_on,kwh_off,kwh_solar_used,kwh_ev,notes_json,created_at)
-        VALUES(?,?,?,?,?,?,?,?,?,?)
+    first_today = db.execute("SELECT 1 FROM energy_daily WHERE user_id=? AND date=?",
+                             (user["id"], sim_date.isoformat())).fetchone() is None
+    # จำลองซ้ำในวันเดียวกัน = เขียนทับแถวของวันนี้ (day = Day N ล่าสุด)
+    db.execute(f"""
+        INSERT INTO energy_daily(user_id,date,{ENERGY_DAILY_COLUMNS})
+        VALUES(?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(user_id,date) DO UPDATE SET
+            day=excluded.day, kwh_total=excluded.kwh_total, cost_thb=excluded.cost_thb,
+            kwh_on=excluded.kwh_on, kwh_off=excluded.kwh_off, kwh_solar_used=excluded.kwh_solar_used,
+            kwh_ev=excluded.kwh_ev, notes_json=excluded.notes_json, created_at=excluded.created_at
     """, (
-        user["id"], day, float(res["kwh_total"]), float(res["cost_thb"]),
+        user["id"], sim_date.isoformat(), day, float(res["kwh_total"]), float(res["cost_thb"]),
         float(res["kwh_on"]), float(res["kwh_off"]), float(res["kwh_solar_used"]), float(res.get("kwh_ev", 0.0)),
         None, datetime.utcnow().isoformat()
     ))
+    observe_daily(db, user["id"], sim_date.isoformat(), res["kwh_total"], res["cost_thb"])
+    if first_today:
+        # ภารกิจนับ "วัน" = วันที่จริงที่ไม่ซ้ำ (กดซ้ำในวันเดียวกันไม่นับเพิ่ม)
+        emit_mission_event(user["id"], "simulate_day", {
+            "points_earned": delta_points,
+            "kwh_total": float(res["kwh_total"]),
+            "tariff_mode": state.get("tariff_mode", "non_tou"),
+            "recommend": res["compare"]["recommend"],
+            "date": sim_date.isoformat(),
+        })
     db.commit()
 
     state["day_counter"] = int(state.get("day_counter", 1)) + 1
+    state.pop("calendar_start", None)  # ปฏิทินเดิม (calendar_start + Day N) ไม่ใช้แล้ว
     save_user_state(user["id"], profile, state, points_new, level_new)
+    if ENABLE_GAME and delta_points > 0:
+        weekly_add_score(user["id"], delta_points)
+
+    return jsonify({"result": res, "points": points_new, "house_level": level_new, "day_counter": state["day_counter"],
+                    "date": sim_date.isoformat()})
+
 
-    return jsonify({"result": res, "points": points_new, "house_level": level_new, "day_counter": state["day_counter"]})
+SHOP_BY_KEY = {it["key"]: it for it in SHOP_ITEMS}
 
 
-@app.route("/api/shop", methods=["GET"])
+@bp.route("/api/shop", methods=["GET"])
 @login_required
 def api_shop():
-    return jsonify({"ok": False, "error": "Shop ถูกปิดในโหมดใช้งานจริง"}), 404
+    if not ENABLE_GAME:
+        return jsonify({"ok": False, "error": "Shop ถูกปิดในโหมดใช้งานจริง"}), 404
+    st = get_or_create_user_state(current_user()["id"])
+    return jsonify({"ok": True, "items": SHOP_ITEMS, "points": st["points"]})
 
 
-@app.route("/api/buy", methods=["POST"])
+@bp.route("/api/buy", methods=["POST"])
 @login_required
 def api_buy():
-    return jsonify({"ok": False, "error": "Shop ถูกปิดในโหมดใช้งานจริง"}), 404
+    if not ENABLE_GAME:
+        return jsonify({"ok": False, "error": "Shop ถูกปิดในโหมดใช้งานจริง"}), 404
+    user = current_user()
+    data = request.get_json(force=True, silent=True) or {}
+    item = SHOP_BY_KEY.get(data.get("item_key"))
+    if not item:
+        return jsonify({"ok": False, "error": "ไม่พบสินค้า"}), 400
+
+    db = get_db()
+    now = datetime.utcnow().isoformat()
+    get_or_create_user_state(user["id"])
+    cur = db.execute("UPDATE user_state SET points = points - ?, updated_at=? WHERE user_id=? AND points >= ?",
+                     (int(item["cost"]), now, user["id"], int(item["cost"])))
+    if cur.rowcount == 0:
+        return jsonify({"ok": False, "error": "แต้มไม่พอ"}), 400
+    db.execute("INSERT INTO purchases(user_id,item_key,cost_points,created_at) VALUES(?,?,?,?)",
+               (user["id"], item["key"], int(item["cost"]), now))
+    emit_mission_event(user["id"], "purchase", {"item_key": item["key"], "category": item["category"], "cost": item["cost"]})
+    inv_add(user["id"], item["key"], 1)  # commit ทั้งหมดในครั้งเดียว
+
+    points = db.execute("SELECT points FROM user_state WHERE user_id=?", (user["id"],)).fetchone()["points"]
+    return jsonify({"ok": True, "points": points, "item_key": item["key"]})
 
 
-@app.route("/dashboard")
+@bp.route("/dashboard")
 @login_required
 def dashboard():
     user = current_user()
     st = get_or_create_user_state(user["id"])
-    db = get_db()
-    rows = db.execute("""
-        SELECT day,kwh_total,cost_thb,kwh_on,kwh_off,kwh_solar_used,kwh_ev,created_at
-        FROM energy_daily WHERE user_id=? ORDER BY id DESC LIMIT 30
-    """, (user["id"],)).fetchall()
-    return render_template("dashboard.html", user=user, st=st, rows=rows, levels=HOUSE_LEVELS)
+    rows = energy_range(user["id"], limit=30, newest_first=True)
+    monthly = []
+    if rows:
+        # 12 เดือนล่าสุดนับจากวันจำลองล่าสุด
+        last = date.fromisoformat(rows[0]["date"])
+        monthly = energy_aggregate(user["id"], start=date(last.year - 1, last.month, 1), bucket="month")
+    return render_template("dashboard.html", user=user, st=st, rows=rows, monthly=monthly, levels=HOUSE_LEVELS)
+
+
+def energy_history_rows(user_id, db=None):
+    """ประวัติทั้งหมด: แถวที่ archive แล้ว (retention) + แถวในฐานข้อมูล เรียงตามวันที่"""
+    archived = read_archived_energy(user_id)
+    live = energy_range(user_id, db=db)
+    live_dates = {r["date"] for r in live}
+    for r in archived:
+        if r["date"] not in live_dates:
+            yield [r[f] for f in ENERGY_ARCHIVE_FIELDS]
+    for r in live:
+        yield [r[f] for f in ENERGY_ARCHIVE_FIELDS]
+
+
+@bp.route("/export.csv")
+@login_required
+def export_csv():
+    user = current_user()
+    rows = list(energy_history_rows(user["id"]))
 
+    def generate():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(ENERGY_ARCHIVE_FIELDS)
+        for row in rows:
+            w.writerow(row)
+            if buf.tell() > 65536:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
 
-@app.route("/admin")
+    return Response(generate(), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=energy_history.csv"})
+
+
+# ============================================================
+# Smart meter: เทียบค่าจริงจากมิเตอร์กับค่าจำลองรายวัน
+# ============================================================
+METER_COMPARE_MAX_DAYS = 366
+
+
+def _meter_days_by_tariff(user_id, start, end):
+    """ตัดช่วงวันที่ตามวันที่อัตราเปลี่ยน — แต่ละช่วงแบ่ง On/Off และคิดเงินด้วยอัตราของช่วงนั้น"""
+    dates, _ = _tariff_versions()
+    cuts = [start] + [date.fromisoformat(d) for d in tariff_boundaries(dates, start, end)] + [end]
+    for seg_start, seg_end in zip(cuts, cuts[1:]):
+        billing = billing_settings_at(seg_start)
+        on_hours = window_hours(_to_int_safe(billing.get("on_peak_start", 9), 9),
+                                _to_int_safe(billing.get("on_peak_end", 22), 22))
+        for a in meter_days(user_id, seg_start, seg_end, on_hours):
+            yield a, billing
+
+
+def meter_compare(user_id, start, end):
+    sim = {r["date"]: r for r in energy_range(user_id, start, end)}
+
+    days = []
+    totals = {"actual_kwh": 0.0, "simulated_kwh": 0.0, "matched_days": 0}
+    for a, billing in _meter_days_by_tariff(user_id, start, end):
+        # ค่าไฟต่อวันคิดแบบเดียวกับ compute_daily_energy(): บิลรายเดือนของ (วันนี้ × 30) / 30
+        a["cost_non_tou"] = round(bill_day_from_month_obj(bill_non_tou_month(a["kwh"] * 30.0, billing)), 2)
+        a["cost_tou"] = round(bill_day_from_month_obj(
+            bill_tou_month(a["kwh_on"] * 30.0, a["kwh_off"] * 30.0, billing)), 2)
+        s = sim.get(a["date"])
+        row = {"date": a["date"], "actual": a, "simulated": None, "diff_kwh": None}
+        if s is not None:
+            row["simulated"] = {k: s[k] for k in ("kwh_total", "kwh_on", "kwh_off", "cost_thb")}
+            row["diff_kwh"] = round(a["kwh"] - float(s["kwh_total"]), 3)
+            totals["actual_kwh"] += a["kwh"]
+            totals["simulated_kwh"] += float(s["kwh_total"])
+            totals["matched_days"] += 1
+        days.append(row)
+
+    if totals["simulated_kwh"] > 0:
+        totals["ratio"] = round(totals["actual_kwh"] / totals["simulated_kwh"], 3)
+    totals["actual_kwh"] = round(totals["actual_kwh"], 3)
+    totals["simulated_kwh"] = round(totals["simulated_kwh"], 3)
+    return {"start": start.isoformat(), "end": end.isoformat(), "days": days, "totals": totals}
+
+
+@bp.route("/api/meter/compare", methods=["GET"])
+@login_required
+def api_meter_compare():
+    try:
+        end = date.fromisoformat(request.args["end"]) if request.args.get("end") else date.today() + timedelta(days=1)
+        start = date.fromisoformat(request.args["start"]) if request.args.get("start") else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({"ok": False, "error": "start/end ต้องเป็นวันที่รูปแบบ YYYY-MM-DD"}), 400
+    if not (start < end) or (end - start).days > METER_COMPARE_MAX_DAYS:
+        return jsonify({"ok": False, "error": f"ช่วงวันที่ต้องยาว 1–{METER_COMPARE_MAX_DAYS} วัน"}), 400
+    return jsonify({"ok": True, **meter_compare(current_user()["id"], start, end)})
+
+
+def active_since(db, since):
+    """จำนวนผู้ใช้ที่เข้าสู่ระบบตั้งแต่ since (ช่วงบน index ของ users.last_login_at)"""
+    return db.execute("SELECT COUNT(*) FROM users WHERE last_login_at >= ?", (since.isoformat(),)).fetchone()[0]
+
+
+@bp.route("/admin")
 @login_required
 @role_required("admin", "officer")
 def admin():
     db = get_db()
-    total_users = db.execute("SELECT COUNT(*) as c FROM users").fetchone()["c"]
-    active_7d = db.execute("SELECT COUNT(DISTINCT user_id) as c FROM login_log WHERE created_at >= datetime('now','-7 day')").fetchone()["c"]
-    active_30d = db.execute("SELECT COUNT(DISTINCT user_id) as c FROM login_log WHERE created_at >= datetime('now','-30 day')").fetchone()["c"]
-    todays = db.execute("SELECT COUNT(DISTINCT user_id) as c FROM login_log WHERE created_at >= datetime('now','start of day')").fetchone()["c"]
-    avg_kwh = db.execute("SELECT AVG(kwh_total) as a FROM energy_daily").fetchone()["a"] or 0
-    avg_cost = db.execute("SELECT AVG(cost_thb) as a FROM energy_daily").fetchone()["a"] or 0
+    # สถิติรวมทั้งระบบ: จาก snapshot ถ้าเปิดไว้ (ไม่แย่งฐานข้อมูลหลักกับผู้เล่น)
+    adb = get_analytics_db()
+    if adb is db:
+        current_app.extensions["energy_life"]["login_audit"].flush()
+    total_users = adb.execute("SELECT COUNT(*) as c FROM users").fetchone()["c"]
+    now = datetime.utcnow()
+    active_7d = active_since(adb, now - timedelta(days=7))
+    active_30d = active_since(adb, now - timedelta(days=30))
+    todays = active_since(adb, datetime(now.year, now.month, now.day))
+    avg_kwh = adb.execute("SELECT AVG(kwh_total) as a FROM energy_daily").fetchone()["a"] or 0
+    avg_cost = adb.execute("SELECT AVG(cost_thb) as a FROM energy_daily").fetchone()["a"] or 0
+    open_alerts = db.execute("SELECT COUNT(*) as c FROM usage_alerts WHERE status='open'").fetchone()["c"]
+    queued_jobs = db.execute("SELECT COUNT(*) as c FROM jobs WHERE status IN ('queued','running')").fetchone()["c"]
 
     users = db.execute("""
         SELECT u.id,u.username,u.role,us.points,us.house_level,us.updated_at
@@ -1461,6 +2691,13 @@ def admin():
         "non_tou_rate", "tou_on_rate", "tou_off_rate",
     ]
     settings = {k: load_setting(k, DEFAULT_BILLING_SETTINGS.get(k, DEFAULT_TARIFF.get(k))) for k in settings_keys}
+    # อัตรา “คิดเงินจริง” มาจากเวอร์ชันที่มีผลวันนี้ (settings เก็บไว้แค่ค่า legacy)
+    settings.update(_load_billing_settings())
+    tariff_history = [
+        {"id": r["id"], "effective_from": r["effective_from"], "created_by": r["created_by"] or "-",
+         "created_at": r["created_at"], "tariff": json.loads(r["tariff_json"])}
+        for r in list_tariff_versions(db)
+    ]
 
     return render_template(
         "admin.html",
@@ -1470,31 +2707,294 @@ def admin():
         todays=todays,
         avg_kwh=avg_kwh,
         avg_cost=avg_cost,
+        open_alerts=open_alerts,
+        queued_jobs=queued_jobs,
         users=users,
-        settings=settings
+        settings=settings,
+        tariff_history=tariff_history,
+        today=datetime.utcnow().date().isoformat(),
+        analytics_snapshot=g.analytics_snapshot,
     )
 
 
-@app.route("/admin/settings", methods=["POST"])
+BILLING_FORM_KEYS = [
+    "ft_rate", "ft_label", "vat_rate",
+    "non_tou_tier1_kwh", "non_tou_tier2_kwh",
+    "non_tou_service_fee", "non_tou_rate1", "non_tou_rate2", "non_tou_rate3",
+    "tou_on_rate_real", "tou_off_rate_real", "tou_service_fee",
+    "on_peak_start", "on_peak_end",
+]
+BILLING_INT_KEYS = ("non_tou_tier1_kwh", "non_tou_tier2_kwh", "on_peak_start", "on_peak_end")
+
+
+@bp.route("/admin/settings", methods=["POST"])
 @login_required
 @role_required("admin")
 def admin_settings():
-    keys = [
-        "ft_rate", "ft_label", "vat_rate",
-        "non_tou_tier1_kwh", "non_tou_tier2_kwh",
-        "non_tou_service_fee", "non_tou_rate1", "non_tou_rate2", "non_tou_rate3",
-        "tou_on_rate_real", "tou_off_rate_real", "tou_service_fee",
-        "on_peak_start", "on_peak_end",
-    ]
-    for key in keys:
-        if key in request.form:
-            save_setting(key, request.form.get(key))
+    proposed, err = _parse_billing_proposal(request.form)
+    effective_from = (request.form.get("effective_from") or "").strip() or datetime.utcnow().date().isoformat()
+    try:
+        date.fromisoformat(effective_from)
+    except ValueError:
+        err = err or "วันที่เริ่มใช้ไม่ถูกต้อง"
+    if err:
+        flash(f"บันทึกไม่สำเร็จ: {err}", "error")
+        return redirect(url_for("main.admin"))
+
+    # เวอร์ชันใหม่ = อัตราที่มีผลในวันนั้น + ค่าที่แก้ (บิลของวันก่อนหน้ายังใช้อัตราเดิม)
+    snapshot = {**billing_settings_at(effective_from), **proposed}
+    save_tariff_version(get_db(), snapshot, effective_from, current_user()["id"])
+    invalidate_tariff_cache()
+
+    flash(f"อัปเดตตั้งค่าเรียบร้อย ✅ (มีผลตั้งแต่ {effective_from})", "success")
+    return redirect(url_for("main.admin"))
+
+
+# ============================================================
+# ✅ Preview ผลกระทบของอัตราค่าไฟใหม่ (ก่อน admin กดบันทึก)
+# ============================================================
+PREVIEW_WORKERS = int(os.environ.get("ENERGY_LIFE_PREVIEW_WORKERS", min(8, os.cpu_count() or 1)))
+PREVIEW_POOL_MIN = 2000   # บ้านที่ต้องคำนวณใหม่น้อยกว่านี้ ทำใน process เดียวเร็วกว่าเปิด pool
+PREVIEW_CHUNK = 500
+PREVIEW_SAMPLE_MAX = 100000
+# บ้านที่ cache ยังไม่ตรง state ล่าสุดเกินสัดส่วนนี้ = ตอบ 409 (สั่ง tariff_cache แล้ว) แทนตัวเลขที่คลาดเคลื่อน
+PREVIEW_STALE_MAX = float(os.environ.get("ENERGY_LIFE_PREVIEW_STALE_MAX", 0.05))
+
+
+def _usage_chunk(billing, coeffs, items):
+    """รันใน process pool ได้: items = [(user_id, state_version, profile_raw, state_raw)]"""
+    if coeffs != MODEL_COEFFS:
+        MODEL_COEFFS.clear()
+        MODEL_COEFFS.update(coeffs)
+        _room_calc_cache.clear()
+    out = []
+    for uid, ver, profile_raw, state_raw in items:
+        state = decode_blob(state_raw) or {}
+        cmp_ = compute_daily_energy(decode_blob(profile_raw) or {}, state, billing)["compare"]
+        mode = "tou" if state.get("tariff_mode") == "tou" else "non_tou"
+        out.append((uid, ver, mode, cmp_["kwh_month"], cmp_["kwh_on_month"], cmp_["kwh_off_month"]))
+    return out
+
+
+def _stale_usage_chunks(db, stale):
+    for i in range(0, len(stale), PREVIEW_CHUNK):
+        part = dict(stale[i:i + PREVIEW_CHUNK])
+        marks = ",".join("?" * len(part))
+        rows = db.execute(
+            f"SELECT user_id, profile_json, state_json FROM user_state WHERE user_id IN ({marks})", list(part)
+        ).fetchall()
+        yield [(r[0], part[r[0]], r[1], r[2]) for r in rows]
+
+
+def cached_household_usage(db, billing, user_ids=None):
+    """อ่าน household_usage อย่างเดียว (ไม่คำนวณ) ตามช่วง On-Peak ของ billing
+
+    คืน ({user_id: (tariff_mode, kwh, kwh_on, kwh_off)}, stale)
+    usage มีค่าล่าสุดที่ cache ไว้ (รวมบ้านที่ state เปลี่ยนหลังจากนั้น) / stale = [(user_id, state_version)] ที่ต้องคำนวณใหม่
+    """
+    peak = peak_key(billing)
+    model_version = _model_coeffs_state["version"]
+    month = sim_month(None)
+    cached = {r[0]: tuple(r[1:]) for r in db.execute("""
+        SELECT user_id, state_version, tariff_mode, kwh_month, kwh_on_month, kwh_off_month
+        FROM household_usage WHERE peak=?
+    """, (peak,))}
+    wanted = None if user_ids is None else set(user_ids)
+
+    usage, stale = {}, []
+    for uid, updated_at in db.execute("SELECT user_id, updated_at FROM user_state"):
+        if wanted is not None and uid not in wanted:
+            continue
+        ver = usage_version(updated_at, model_version, month)
+        hit = cached.get(uid)
+        if hit is not None:
+            usage[uid] = hit[1:]
+        if hit is None or hit[0] != ver:
+            stale.append((uid, ver))
+    return usage, stale
+
+
+def refresh_household_usage(db, billing, user_ids=None):
+    """kWh/เดือนของทุกบ้าน (หรือเฉพาะ user_ids) ตามช่วง On-Peak ของ billing
+
+    คืน ({user_id: (tariff_mode, kwh, kwh_on, kwh_off)}, จำนวนบ้านที่คำนวณใหม่)
+    คำนวณใหม่เฉพาะบ้านที่ user_state เปลี่ยนตั้งแต่ครั้งก่อน — ถ้ามีมากใช้ process pool
+    ใช้จาก job tariff_cache / CLI เท่านั้น (request อ่าน cache ด้วย cached_household_usage)
+    """
+    peak = peak_key(billing)
+    usage, stale = cached_household_usage(db, billing, user_ids)
+    if not stale:
+        return usage, 0
+
+    work = partial(_usage_chunk, dict(billing), dict(MODEL_COEFFS))
+    chunks = _stale_usage_chunks(db, stale)
+    if len(stale) >= PREVIEW_POOL_MIN and PREVIEW_WORKERS > 1:
+        # fork: worker ได้ app + ค่าสัมประสิทธิ์ที่โหลดไว้แล้วโดยไม่ต้อง import ใหม่
+        ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=PREVIEW_WORKERS, mp_context=ctx) as pool:
+            results = list(pool.map(work, chunks))
+    else:
+        results = [work(c) for c in chunks]
+
+    for rows in results:
+        save_usage_rows(db, peak, rows)
+        for uid, _, mode, kwh, kwh_on, kwh_off in rows:
+            usage[uid] = (mode, kwh, kwh_on, kwh_off)
+    db.commit()
+    return usage, len(stale)
+
+
+def _parse_billing_proposal(data):
+    """คืน (proposed, error) — ค่าตัวเลขต้องแปลงได้ / ชั่วโมง On-Peak ต้องอยู่ใน 0-24"""
+    proposed = {}
+    for key in BILLING_FORM_KEYS:
+        raw = data.get(key)
+        if raw is None or str(raw).strip() == "":
+            continue
+        if key == "ft_label":
+            proposed[key] = str(raw)
+            continue
+        try:
+            val = float(raw)
+        except (TypeError, ValueError):
+            return None, f"{key} ต้องเป็นตัวเลข"
+        if not math.isfinite(val) or val < 0:
+            return None, f"{key} ต้องเป็นตัวเลขที่ไม่ติดลบ"
+        if key in ("on_peak_start", "on_peak_end") and val > 24:
+            return None, f"{key} ต้องอยู่ระหว่าง 0-24"
+        proposed[key] = int(val) if key in BILLING_INT_KEYS else val
+    return proposed, None
+
+
+@bp.route("/admin/settings/preview", methods=["POST"])
+@login_required
+@role_required("admin")
+def admin_settings_preview():
+    data = request.get_json(silent=True) or request.form
+    proposed, err = _parse_billing_proposal(data)
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+    sample = data.get("sample")
+    if sample not in (None, ""):
+        try:
+            sample = max(1, min(PREVIEW_SAMPLE_MAX, int(sample)))
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "sample ต้องเป็นจำนวนเต็ม"}), 400
+    else:
+        sample = None
+
+    t0 = time.perf_counter()
+    db = get_db()
+    current = _load_billing_settings()
+    new = {**current, **proposed}
+
+    # request อ่าน cache อย่างเดียว — การคำนวณทั้งประชากรเป็นงานของ jobs-worker (tariff_cache)
+    usage, stale = cached_household_usage(db, current)
+    population = len(usage) + sum(1 for uid, _ in stale if uid not in usage)
+    user_ids = stratified_sample(usage, sample) if sample else list(usage)
+    stale_ids = {uid for uid, _ in stale}
+    warm = [{}] if stale else []
+    if peak_key(new) == peak_key(current):
+        new_usage = usage
+    else:
+        # ช่วง On-Peak เปลี่ยน = สัดส่วน On/Off ของทุกบ้านเปลี่ยน (cache แยกตามช่วง)
+        new_usage, new_stale = cached_household_usage(db, new, user_ids if sample else None)
+        if new_stale:
+            stale_ids.update(uid for uid, _ in new_stale)
+            warm.append({k: new[k] for k in ("on_peak_start", "on_peak_end")})
+
+    enqueued = [enqueue_once(db, "tariff_cache", payload, current_user()["id"]) for payload in warm]
+    if not usage or len(stale_ids) > population * PREVIEW_STALE_MAX:
+        resp = jsonify({"ok": False, "error": "ข้อมูล kWh ของบ้านยังไม่พร้อม — สั่งคำนวณเบื้องหลังแล้ว ลองใหม่อีกครั้ง",
+                        "enqueued": enqueued, "stale": len(stale_ids), "population": population})
+        return resp, 409
+
+    pairs = [(usage[u][0], usage[u][1:], new_usage[u][1:]) for u in user_ids if u in new_usage]
+    preview = summarize_changes(pairs, current, new)
+    preview.update(
+        population=population,
+        sampled=sample is not None,
+        stale=len(stale_ids),
+        enqueued=enqueued,
+        elapsed_ms=round((time.perf_counter() - t0) * 1000, 1),
+    )
+    changed = sorted(k for k, v in proposed.items() if str(v) != str(current.get(k)))
+    return jsonify({"ok": True, "changed": changed, "preview": preview})
 
-    flash("อัปเดตตั้งค่าเรียบร้อย ✅", "success")
-    return redirect(url_for("admin"))
+
+ALERTS_PAGE_SIZE = 50
+
+
+@bp.route("/admin/alerts", methods=["GET", "POST"])
+@login_required
+@role_required("admin", "officer")
+def admin_alerts():
+    db = get_db()
+    if request.method == "POST":
+        if resolve_alert(db, _to_int_safe(request.form.get("alert_id"), 0), current_user()["id"]):
+            flash("ปิด alert แล้ว ✅", "success")
+        return redirect(url_for("main.admin_alerts", status="open"))
+
+    status = request.args.get("status", "open")
+    if status not in ("open", "resolved"):
+        status = "open"
+    before = request.args.get("before", type=int)
+    alerts = list_alerts(db, status=status, before_id=before, limit=ALERTS_PAGE_SIZE)
+    return render_template("admin_alerts.html", alerts=alerts, status=status, kinds=ALERT_KINDS,
+                           next_before=alerts[-1]["id"] if len(alerts) == ALERTS_PAGE_SIZE else None)
+
+
+@bp.route("/admin/jobs", methods=["GET", "POST"])
+@login_required
+@role_required("admin")
+def admin_jobs():
+    db = get_db()
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "enqueue":
+            kind = request.form.get("kind", "")
+            if kind not in JOB_HANDLERS:
+                flash("ไม่รู้จักงานนี้", "error")
+            else:
+                payload = {"publish": True} if kind == "calibrate" and request.form.get("publish") else {}
+                job_id = enqueue_job(db, kind, payload, created_by=current_user()["id"])
+                flash(f"เพิ่มงาน #{job_id} เข้าคิวแล้ว ✅", "success")
+        elif action == "retry":
+            if retry_job(db, _to_int_safe(request.form.get("job_id"), 0)):
+                flash("ส่งงานกลับเข้าคิวแล้ว ✅", "success")
+        return redirect(url_for("main.admin_jobs"))
+
+    status = request.args.get("status")
+    if status not in JOB_STATUSES:
+        status = None
+    before = request.args.get("before", type=int)
+    jobs = [dict(r) for r in list_jobs(db, status=status, before_id=before, limit=JOBS_PAGE_SIZE)]
+    for j in jobs:
+        j["result"] = json.loads(j["result_json"]) if j["result_json"] else None
+    return render_template("admin_jobs.html", jobs=jobs, stats=job_stats(db), status=status,
+                           kinds={k: v[0] for k, v in JOB_HANDLERS.items()},
+                           next_before=jobs[-1]["id"] if len(jobs) == JOBS_PAGE_SIZE else None)
+
+
+@bp.route("/admin/jobs/<int:job_id>/download")
+@login_required
+@role_required("admin")
+def admin_job_download(job_id):
+    row = get_db().execute("SELECT result_json FROM jobs WHERE id=? AND status='done'", (job_id,)).fetchone()
+    name = (json.loads(row["result_json"] or "{}") if row else {}).get("file")
+    if not name:
+        return jsonify({"ok": False, "error": "ไม่มีไฟล์ของงานนี้"}), 404
+    return send_from_directory(os.path.abspath(EXPORT_DIR), name, as_attachment=True)
+
+
+@bp.route("/admin/metrics/auth")
+@login_required
+@role_required("admin")
+def admin_auth_metrics():
+    return jsonify(hash_metrics())
 
 
-@app.route("/admin/user/<int:user_id>")
+@bp.route("/admin/user/<int:user_id>")
 @login_required
 @role_required("admin", "officer")
 def admin_user(user_id):
@@ -1502,19 +3002,43 @@ def admin_user(user_id):
     user = db.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
     if not user:
         flash("ไม่พบผู้ใช้", "error")
-        return redirect(url_for("admin"))
+        return redirect(url_for("main.admin"))
     st = get_or_create_user_state(user_id)
-    rows = db.execute("""
-        SELECT day,kwh_total,cost_thb,kwh_on,kwh_off,kwh_solar_used,kwh_ev,created_at
-        FROM energy_daily WHERE user_id=? ORDER BY id DESC LIMIT 60
-    """, (user_id,)).fetchall()
-    return render_template("admin_user.html", u=user, st=st, rows=rows, levels=HOUSE_LEVELS)
+    rows = energy_range(user_id, limit=60, newest_first=True)
+    bills = db.execute(
+        "SELECT month, kwh, amount_thb, source FROM actual_bills WHERE user_id=? ORDER BY month DESC LIMIT 24",
+        (user_id,)
+    ).fetchall()
+    return render_template("admin_user.html", u=user, st=st, rows=rows, bills=bills, levels=HOUSE_LEVELS)
+
+
+@bp.route("/admin/user/<int:user_id>/bills", methods=["POST"])
+@login_required
+@role_required("admin", "officer")
+def admin_user_bill(user_id):
+    db = get_db()
+    if not db.execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone():
+        flash("ไม่พบผู้ใช้", "error")
+        return redirect(url_for("main.admin"))
+    try:
+        save_actual_bill(db, user_id, request.form.get("month", "").strip(), request.form.get("kwh", ""),
+                         request.form.get("amount_thb") or None, source="officer", entered_by=current_user()["id"])
+    except ValueError:
+        flash("กรอกเดือน (YYYY-MM) และหน่วยไฟ (kWh) ให้ถูกต้อง", "error")
+        return redirect(url_for("main.admin_user", user_id=user_id))
+    db.commit()
+    flash("บันทึกบิลจริงแล้ว ✅", "success")
+    return redirect(url_for("main.admin_user", user_id=user_id))
 
 
 def inv_get(user_id: int, item_key: str) -> int:
+    cache = g.setdefault("inventory", {})
+    if (user_id, item_key) in cache:
+        return cache[(user_id, item_key)]
     db = get_db()
     row = db.execute("SELECT qty FROM inventory WHERE user_id=? AND item_key=?", (user_id, item_key)).fetchone()
-    return int(row["qty"]) if row else 0
+    cache[(user_id, item_key)] = int(row["qty"]) if row else 0
+    return cache[(user_id, item_key)]
 
 
 def inv_add(user_id: int, item_key: str, qty: int):
@@ -1527,6 +3051,7 @@ def inv_add(user_id: int, item_key: str, qty: int):
             updated_at = excluded.updated_at
     """, (user_id, item_key, int(qty), now))
     db.commit()
+    g.get("inventory", {}).pop((user_id, item_key), None)
 
 
 def inv_take(user_id: int, item_key: str, qty: int) -> bool:
@@ -1538,29 +3063,246 @@ def inv_take(user_id: int, item_key: str, qty: int) -> bool:
     db.execute("UPDATE inventory SET qty = qty - ?, updated_at=? WHERE user_id=? AND item_key=?",
                (int(qty), now, user_id, item_key))
     db.commit()
+    g.get("inventory", {}).pop((user_id, item_key), None)
     return True
 
 
+# ============================================================
+# ✅ Leaderboard: index (week_id, listed, score) + cache หน้าแรก/คะแนนเรียงต่อ worker
+# ============================================================
+LEADERBOARD_PAGE_SIZE = 20
+LEADERBOARD_CACHE_TTL = float(os.environ.get("ENERGY_LIFE_LEADERBOARD_TTL", 15))
+# รายการคะแนนสำหรับหาอันดับ: write ใน worker นี้อัปเดตทันที / TTL นี้ตามทัน write จาก worker อื่น
+LEADERBOARD_RANK_TTL = float(os.environ.get("ENERGY_LIFE_LEADERBOARD_RANK_TTL", 300))
+
+# week_id -> {"expires", "top" (LEADERBOARD_PAGE_SIZE แถวแรก เรียงมาก->น้อย)}
+_leaderboard_cache = {}
+# week_id -> {"expires", "scores" (เรียงน้อย->มาก, เฉพาะคนที่แสดงตัว), "by_user"}
+_leaderboard_ranks = {}
+
+
+def _leaderboard_query_top(week_id, limit):
+    rows = get_db().execute("""
+        SELECT ws.user_id, ws.score, u.display_name FROM weekly_scores ws
+        JOIN users u ON u.id = ws.user_id
+        WHERE ws.week_id=? AND ws.listed=1
+        ORDER BY ws.score DESC, ws.user_id DESC
+        LIMIT ?
+    """, (week_id, int(limit))).fetchall()
+    top = []
+    for i, r in enumerate(rows):
+        # คะแนนเท่ากันได้อันดับเดียวกัน: คนที่คะแนนมากกว่าอยู่ก่อนหน้าในหน้านี้ทั้งหมดแล้ว
+        rank = top[-1]["rank"] if top and top[-1]["score"] == r["score"] else i + 1
+        top.append({"user_id": r["user_id"], "name": r["display_name"] or "ผู้เล่น", "score": r["score"], "rank": rank})
+    return top
+
+
+def _leaderboard_rank_entry(week_id):
+    now = time.monotonic()
+    entry = _leaderboard_ranks.get(week_id)
+    if entry and entry["expires"] > now:
+        return entry
+    # อ่านจาก idx_weekly_scores_listed อย่างเดียว (covering, เรียงตาม score อยู่แล้ว)
+    rows = get_db().execute(
+        "SELECT user_id, score FROM weekly_scores WHERE week_id=? AND listed=1 ORDER BY score", (week_id,)
+    ).fetchall()
+    entry = {
+        "expires": now + LEADERBOARD_RANK_TTL,
+        "scores": [r["score"] for r in rows],
+        "by_user": {r["user_id"]: r["score"] for r in rows},
+    }
+    for k in [k for k in _leaderboard_ranks if k != week_id and k != current_week_id()]:
+        _leaderboard_ranks.pop(k, None)
+    _leaderboard_ranks[week_id] = entry
+    return entry
+
+
+def leaderboard_rank_of(week_id, score) -> int:
+    # 1 + จำนวนคนที่แสดงตัวและคะแนนมากกว่า (bisect = O(log n))
+    scores = _leaderboard_rank_entry(week_id)["scores"]
+    return 1 + len(scores) - bisect.bisect_right(scores, int(score))
+
+
+def leaderboard_top(week_id=None, limit=LEADERBOARD_PAGE_SIZE):
+    week_id = week_id or current_week_id()
+    if limit > LEADERBOARD_PAGE_SIZE:
+        return _leaderboard_query_top(week_id, limit)
+    now = time.monotonic()
+    entry = _leaderboard_cache.get(week_id)
+    if not entry or entry["expires"] <= now:
+        entry = {"expires": now + LEADERBOARD_CACHE_TTL, "top": _leaderboard_query_top(week_id, LEADERBOARD_PAGE_SIZE)}
+        # เก็บแค่สัปดาห์ปัจจุบัน/ที่เพิ่งขอ กัน cache โตไม่จำกัด
+        for k in [k for k in _leaderboard_cache if k != week_id and k != current_week_id()]:
+            _leaderboard_cache.pop(k, None)
+        _leaderboard_cache[week_id] = entry
+    return entry["top"][:limit]
+
+
+def leaderboard_my_rank(user_id, week_id=None):
+    """(อันดับ, คะแนน) ของผู้ใช้ — ผู้ที่ซ่อนตัวก็ดูอันดับตัวเองได้ (เทียบกับคนที่แสดง)"""
+    week_id = week_id or current_week_id()
+    row = get_db().execute("SELECT score FROM weekly_scores WHERE user_id=? AND week_id=?",
+                           (user_id, week_id)).fetchone()
+    if not row:
+        return None, 0
+    return leaderboard_rank_of(week_id, row["score"]), row["score"]
+
+
+def _leaderboard_on_score(user_id, week_id, new_score, listed):
+    if not listed:
+        return
+    ranks = _leaderboard_ranks.get(week_id)
+    if ranks:
+        # ย้ายคะแนนของผู้ใช้ในรายการที่เรียงอยู่ (O(log n) หา + O(n) memmove) แทนโหลดใหม่ทั้งสัปดาห์
+        old = ranks["by_user"].get(user_id)
+        if old is not None:
+            del ranks["scores"][bisect.bisect_left(ranks["scores"], old)]
+        bisect.insort(ranks["scores"], new_score)
+        ranks["by_user"][user_id] = new_score
+
+    # ล้าง cache หน้าแรกเฉพาะเมื่อหน้าแรกเปลี่ยน (คนที่ซ่อนตัว / คะแนนยังไม่ถึงหน้าแรก ไม่กระทบ)
+    entry = _leaderboard_cache.get(week_id)
+    if not entry:
+        return
+    top = entry["top"]
+    if (len(top) < LEADERBOARD_PAGE_SIZE or new_score >= top[-1]["score"]
+            or any(r["user_id"] == user_id for r in top)):
+        _leaderboard_cache.pop(week_id, None)
+
+
+def invalidate_leaderboard_cache():
+    _leaderboard_cache.clear()
+    _leaderboard_ranks.clear()
+
+
 def weekly_add_score(user_id: int, delta: int):
     db = get_db()
     week_id = current_week_id()
     now = datetime.utcnow().isoformat()
-    db.execute("""
-        INSERT INTO weekly_scores(user_id,week_id,score,updated_at) VALUES(?,?,?,?)
+    row = db.execute("""
+        INSERT INTO weekly_scores(user_id,week_id,score,updated_at,listed)
+        VALUES(?,?,?,?,(SELECT show_on_leaderboard FROM users WHERE id=?))
         ON CONFLICT(user_id,week_id) DO UPDATE SET
             score = score + excluded.score,
             updated_at = excluded.updated_at
-    """, (user_id, week_id, int(delta), now))
+        RETURNING score, listed
+    """, (user_id, week_id, int(delta), now, user_id)).fetchone()
     db.commit()
+    _leaderboard_on_score(user_id, week_id, row["score"], row["listed"])
 
 
-def get_user_display(user_id: int):
+# ============================================================
+# ✅ Missions: action -> event -> อัปเดตเฉพาะแถว progress ที่เกี่ยวข้อง
+# - ขึ้นสัปดาห์ใหม่ = week_id ใหม่ (current_week_id) แถวถูกสร้างเมื่อมี event แรก ไม่ต้อง reset ทุกคน
+# - emit_mission_event() ไม่ commit เอง: อยู่ในทรานแซกชันเดียวกับ action ที่เรียก
+# ============================================================
+MISSIONS = [
+    {"id": "simulate_3", "type": "weekly", "event": "simulate_day", "target": 3, "reward_points": 30,
+     "title": "จำลองการใช้ไฟ 3 วัน", "desc": "กดจำลองการใช้ไฟครบ 3 วันในสัปดาห์นี้"},
+    {"id": "below_baseline_3", "type": "weekly", "event": "simulate_day", "target": 3, "reward_points": 60,
+     "where": lambda e: e["points_earned"] > 0,
+     "title": "ใช้ไฟต่ำกว่าเกณฑ์ 3 วัน", "desc": "ใช้ไฟต่ำกว่าเกณฑ์พื้นฐานของบ้านขนาดเดียวกัน 3 วัน"},
+    {"id": "right_meter_2", "type": "weekly", "event": "simulate_day", "target": 2, "reward_points": 40,
+     "where": lambda e: e["tariff_mode"] == e["recommend"],
+     "title": "เลือกมิเตอร์ถูกแบบ", "desc": "จำลอง 2 วันด้วยโหมดมิเตอร์ที่ระบบแนะนำ (TOU / Non-TOU)"},
+    {"id": "configure_rooms_3", "type": "weekly", "event": "room_saved", "target": 3, "reward_points": 30,
+     "where": lambda e: e["first_time"],
+     "title": "ตั้งค่าห้อง 3 ห้อง", "desc": "ตั้งค่าอุปกรณ์ในห้องที่ยังไม่เคยตั้งค่าให้ครบ 3 ห้อง",
+     "reward_item": {"key": "pet_food_basic", "qty": 1}},
+    {"id": "ac_26", "type": "weekly", "event": "room_saved", "target": 1, "reward_points": 40,
+     "where": lambda e: e["ac_enabled"] and e["ac_set_temp"] >= 26,
+     "title": "แอร์ 26°C ขึ้นไป", "desc": "ตั้งแอร์ในห้องใดก็ได้ที่ 26°C หรือสูงกว่า"},
+    {"id": "energy_upgrade", "type": "weekly", "event": "purchase", "target": 1, "reward_points": 50,
+     "where": lambda e: e["category"] == "energy",
+     "title": "อัปเกรดประหยัดไฟ", "desc": "ซื้อไอเท็มหมวดพลังงาน 1 ชิ้นจากร้านค้า",
+     "reward_item": {"key": "name_change_ticket", "qty": 1}},
+]
+MISSIONS_BY_ID = {m["id"]: m for m in MISSIONS}
+MISSIONS_BY_EVENT = {}
+for _m in MISSIONS:
+    MISSIONS_BY_EVENT.setdefault(_m["event"], []).append(_m)
+
+
+def emit_mission_event(user_id: int, event: str, payload: dict):
+    subs = MISSIONS_BY_EVENT.get(event)
+    if not subs:
+        return
+    week_id = current_week_id()
+    rows = []
+    for m in subs:
+        if "where" in m and not m["where"](payload):
+            continue
+        inc = int(m["amount"](payload)) if "amount" in m else 1
+        if inc > 0:
+            rows.append({"u": user_id, "m": m["id"], "w": week_id, "inc": inc, "t": int(m["target"])})
+    if not rows:
+        return
+    get_db().executemany("""
+        INSERT INTO mission_progress(user_id,mission_id,week_id,status,progress,target)
+        VALUES(:u, :m, :w, CASE WHEN :inc >= :t THEN 'done' ELSE 'active' END, MIN(:inc, :t), :t)
+        ON CONFLICT(user_id,mission_id,week_id) DO UPDATE SET
+            progress = MIN(target, progress + :inc),
+            status = CASE WHEN progress + :inc >= target THEN 'done' ELSE 'active' END
+        WHERE status = 'active'
+    """, rows)
+
+
+def missions_for_user(user_id: int):
+    week_id = current_week_id()
+    rows = get_db().execute("""
+        SELECT mission_id, status, progress, target FROM mission_progress
+        WHERE user_id=? AND week_id=?
+    """, (user_id, week_id)).fetchall()
+    by_id = {r["mission_id"]: r for r in rows}
+    out = []
+    for m in MISSIONS:
+        r = by_id.get(m["id"])
+        status = r["status"] if r else "active"
+        out.append({
+            "id": m["id"], "type": m["type"], "title": m["title"], "desc": m["desc"],
+            "reward_points": m["reward_points"], "reward_item": m.get("reward_item"),
+            "progress": r["progress"] if r else 0, "target": m["target"],
+            "available": status == "done", "claimed": status == "claimed",
+        })
+    return out
+
+
+def claim_mission(user_id: int, mission_id: str) -> bool:
+    m = MISSIONS_BY_ID.get(mission_id)
+    if not m:
+        return False
     db = get_db()
-    row = db.execute("SELECT display_name, share_token FROM users WHERE id=?", (user_id,)).fetchone()
+    now = datetime.utcnow().isoformat()
+    cur = db.execute("""
+        UPDATE mission_progress SET status='claimed', claimed_at=?
+        WHERE user_id=? AND mission_id=? AND week_id=? AND status='done'
+    """, (now, user_id, mission_id, current_week_id()))
+    if cur.rowcount == 0:
+        return False
+    row = db.execute("SELECT points FROM user_state WHERE user_id=?", (user_id,)).fetchone()
+    points = int(row["points"] if row else 0) + int(m["reward_points"])
+    db.execute("UPDATE user_state SET points=?, house_level=?, updated_at=? WHERE user_id=?",
+               (points, recompute_level(points), now, user_id))
+    if m.get("reward_item"):
+        inv_add(user_id, m["reward_item"]["key"], m["reward_item"]["qty"])  # commit ทั้งหมด
+    db.commit()
+    weekly_add_score(user_id, int(m["reward_points"]))
+    return True
+
+
+def get_user_display(user_id: int):
+    row = _load_user_identity(user_id)
     return (row["display_name"] or "ผู้เล่น", row["share_token"])
 
 
 def get_user_prefs(user_id: int):
+    cache = g.setdefault("user_prefs", {})
+    if user_id not in cache:
+        cache[user_id] = _query_user_prefs(user_id)
+    return cache[user_id]
+
+
+def _query_user_prefs(user_id: int):
     db = get_db()
     row = db.execute("SELECT prefs_json FROM user_prefs WHERE user_id=?", (user_id,)).fetchone()
     if not row:
@@ -1582,23 +3324,45 @@ def save_user_prefs(user_id: int, prefs: dict):
     db = get_db()
     db.execute("INSERT OR REPLACE INTO user_prefs(user_id,prefs_json,updated_at) VALUES(?,?,?)",
                (user_id, json.dumps(prefs), datetime.utcnow().isoformat()))
+    privacy = prefs.get("privacy") or {}
+    show = 1 if privacy.get("show_on_leaderboard", True) else 0
+    share = 1 if privacy.get("share_house", True) else 0
+    cur = db.execute("UPDATE users SET show_on_leaderboard=? WHERE id=? AND show_on_leaderboard<>?", (show, user_id, show))
+    if cur.rowcount:
+        db.execute("UPDATE weekly_scores SET listed=? WHERE user_id=?", (show, user_id))
+    share_cur = db.execute("UPDATE users SET share_house=? WHERE id=? AND share_house<>?", (share, user_id, share))
     db.commit()
+    g.setdefault("user_prefs", {})[user_id] = prefs
+    if cur.rowcount:
+        invalidate_leaderboard_cache()
+    if share_cur.rowcount and not share:
+        # ปิดแชร์: ทิ้ง HTML ที่ cache ไว้ของ token นี้ทันที (worker อื่นเช็ก share_house ทุก request อยู่แล้ว)
+        row = db.execute("SELECT share_token FROM users WHERE id=?", (user_id,)).fetchone()
+        if row:
+            _share_cache.pop(row["share_token"], None)
 
 
 def _game_disabled_redirect():
     flash("โหมดเกมถูกปิดชั่วคราว (โหมดใช้งานจริง)", "error")
-    return redirect(url_for("home"))
+    return redirect(url_for("main.home"))
 
 
-@app.route("/missions", methods=["GET", "POST"])
+@bp.route("/missions", methods=["GET", "POST"])
 @login_required
 def missions():
     if not ENABLE_GAME:
         return _game_disabled_redirect()
-    return _game_disabled_redirect()
+    user = current_user()
+    if request.method == "POST":
+        if claim_mission(user["id"], request.form.get("mission_id", "")):
+            flash("รับรางวัลภารกิจแล้ว ⭐", "success")
+        else:
+            flash("ยังรับรางวัลภารกิจนี้ไม่ได้", "error")
+        return redirect(url_for("main.missions"))
+    return render_template("missions.html", app_name=APP_NAME, app_mode="game", missions=missions_for_user(user["id"]))
 
 
-@app.route("/pets", methods=["GET", "POST"])
+@bp.route("/pets", methods=["GET", "POST"])
 @login_required
 def pets():
     if not ENABLE_GAME:
@@ -1606,22 +3370,78 @@ def pets():
     return _game_disabled_redirect()
 
 
-@app.route("/leaderboard")
+@bp.route("/leaderboard")
 @login_required
 def leaderboard():
     if not ENABLE_GAME:
         return _game_disabled_redirect()
-    return _game_disabled_redirect()
+    user = current_user()
+    week_id = current_week_id()
+    my_rank, my_score = leaderboard_my_rank(user["id"], week_id)
+    return render_template("leaderboard.html", app_name=APP_NAME, app_mode="game", week_id=week_id,
+                           board=leaderboard_top(week_id), my_rank=my_rank, my_score=my_score)
 
 
-@app.route("/share/<token>")
+# ✅ หน้าแชร์สาธารณะ: cache HTML ต่อ token (ต่อ worker) + header ให้ reverse proxy cache ได้
+SHARE_CACHE_MAX = 2000
+SHARE_CACHE_TTL = 300
+# ปิดแชร์แล้วต้องหายจาก proxy เร็ว: s-maxage สั้น ไม่มี stale-while-revalidate / เบราว์เซอร์ revalidate ด้วย ETag ทุกครั้ง
+SHARE_S_MAXAGE = int(os.environ.get("ENERGY_LIFE_SHARE_S_MAXAGE", 30))
+SHARE_CACHE_CONTROL = f"public, max-age=0, s-maxage={SHARE_S_MAXAGE}, must-revalidate"
+SHARE_NOT_FOUND_CACHE_CONTROL = "no-store"
+
+_share_cache = OrderedDict()  # token -> {"version", "html", "expires"}
+
+
+def _share_not_found():
+    html = render_template("share_public.html", app_name=APP_NAME, not_found=True)
+    return html, 404, {"Cache-Control": SHARE_NOT_FOUND_CACHE_CONTROL}
+
+
+@bp.route("/share/<token>")
 def share_public(token):
     if not ENABLE_GAME:
         return render_template("share_public.html", app_name=APP_NAME, not_found=True)
-    return render_template("share_public.html", app_name=APP_NAME, not_found=True)
+
+    db = get_db()
+    row = db.execute("""
+        SELECT u.id, u.display_name, u.share_house, us.updated_at
+        FROM users u LEFT JOIN user_state us ON us.user_id = u.id
+        WHERE u.share_token=?
+    """, (token,)).fetchone()
+    if not row or not row["share_house"] or row["updated_at"] is None:
+        _share_cache.pop(token, None)
+        return _share_not_found()
+
+    # เวอร์ชันของหน้า: เปลี่ยนเมื่อ user_state.updated_at หรือชื่อเปลี่ยน (ปิดแชร์ = ไม่ถึงตรงนี้)
+    version = hashlib.sha1(f"{row['id']}|{row['updated_at']}|{row['display_name']}".encode()).hexdigest()[:16]
+    headers = {"Cache-Control": SHARE_CACHE_CONTROL, "ETag": f'"{version}"'}
+    if request.if_none_match.contains(version):
+        return "", 304, headers
+
+    now = time.monotonic()
+    hit = _share_cache.get(token)
+    if hit and hit["version"] == version and hit["expires"] > now:
+        _share_cache.move_to_end(token)
+        return hit["html"], 200, headers
+
+    st = get_or_create_user_state(row["id"])
+    pet = db.execute("SELECT * FROM pets WHERE user_id=? ORDER BY id DESC LIMIT 1", (row["id"],)).fetchone()
+    rooms = [
+        {"label": r.get("label", rid), "type": r.get("type", ""), "appliances": len(r.get("appliances") or {})}
+        for rid, r in (st["state"].get("rooms") or {}).items() if isinstance(r, dict)
+    ]
+    html = render_template("share_public.html", app_name=APP_NAME, not_found=False,
+                           name=row["display_name"] or "ผู้เล่น", st=st, pet=pet, rooms=rooms)
+
+    _share_cache[token] = {"version": version, "html": html, "expires": now + SHARE_CACHE_TTL}
+    _share_cache.move_to_end(token)
+    while len(_share_cache) > SHARE_CACHE_MAX:
+        _share_cache.popitem(last=False)
+    return html, 200, headers
 
 
-@app.route("/settings", methods=["GET", "POST"])
+@bp.route("/settings", methods=["GET", "POST"])
 @login_required
 def user_settings():
     user = current_user()
@@ -1638,11 +3458,11 @@ def user_settings():
         prefs["language"]["voice"] = request.form.get("lang_voice") or prefs["language"]["voice"]
         save_user_prefs(user["id"], prefs)
         flash("บันทึกการตั้งค่าแล้ว", "success")
-        return redirect(url_for("user_settings"))
+        return redirect(url_for("main.user_settings"))
     return render_template("settings_user.html", app_name=APP_NAME, prefs=prefs)
 
 
-@app.route("/profile", methods=["GET", "POST"])
+@bp.route("/profile", methods=["GET", "POST"])
 @login_required
 def profile():
     user = current_user()
@@ -1651,24 +3471,317 @@ def profile():
         new_name = (request.form.get("display_name") or "").strip()
         if len(new_name) < 3 or len(new_name) > 16:
             flash("ชื่อที่แสดงต้องยาว 3–16 ตัวอักษร", "error")
-            return redirect(url_for("profile"))
+            return redirect(url_for("main.profile"))
 
         if inv_get(user["id"], "name_change_ticket") <= 0:
             flash("ต้องมีไอเท็ม ‘ตั๋วเปลี่ยนชื่อ’ ก่อนถึงจะเปลี่ยนชื่อได้", "error")
-            return redirect(url_for("profile"))
+            return redirect(url_for("main.profile"))
         if not inv_take(user["id"], "name_change_ticket", 1):
             flash("ตั๋วเปลี่ยนชื่อไม่พอ", "error")
-            return redirect(url_for("profile"))
+            return redirect(url_for("main.profile"))
 
         db = get_db()
         db.execute("UPDATE users SET display_name=? WHERE id=?", (new_name, user["id"]))
         db.commit()
+        invalidate_user_cache(user["id"])
         flash("เปลี่ยนชื่อสำเร็จ", "success")
-        return redirect(url_for("profile"))
+        return redirect(url_for("main.profile"))
 
     return render_template("profile.html", app_name=APP_NAME, name=name, token=token,
                            ticket=inv_get(user["id"], "name_change_ticket"))
 
 
+@bp.cli.command("retention")
+def retention_command():
+    """ย่อ/ย้ายประวัติเก่า (energy_daily, login_events) และคืนพื้นที่ฐานข้อมูลทีละน้อย"""
+    init_db()
+    print(json.dumps(run_retention(get_db()), ensure_ascii=False))
+
+
+@bp.cli.command("enable-incremental-vacuum")
+def enable_incremental_vacuum_command():
+    """เปลี่ยนฐานข้อมูลเดิมเป็น auto_vacuum=INCREMENTAL (VACUUM เต็มครั้งเดียว ล็อกทั้งไฟล์ — ทำตอนปิดระบบ)"""
+    init_db()
+    db = get_db()
+    t0 = time.perf_counter()
+    changed = enable_incremental_vacuum(db)
+    print(json.dumps({"changed": changed, "auto_vacuum": auto_vacuum_mode(db),
+                      "seconds": round(time.perf_counter() - t0, 3)}))
+
+
+@bp.cli.command("meter-import")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user", "username", help="ชื่อผู้ใช้ของไฟล์ (ถ้าไฟล์ไม่มีคอลัมน์ user_id)")
+def meter_import_command(csv_path, username):
+    """นำเข้าค่าอ่าน smart meter ทุก 15 นาทีจาก CSV (อ่านทีละ chunk)"""
+    init_db()
+    db = get_db()
+    user_id = None
+    if username:
+        row = db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()
+        if not row:
+            raise click.ClickException(f"ไม่พบผู้ใช้ {username}")
+        user_id = row["id"]
+    allowed = {r["id"] for r in db.execute("SELECT id FROM users")}
+    try:
+        out = ingest_csv(csv_path, user_id=user_id, allowed_users=allowed)
+    except MeterImportError as e:
+        raise click.ClickException(str(e))
+    out["users"] = len(out["users"])
+    print(json.dumps(out, ensure_ascii=False))
+
+
+def calibration_samples(db):
+    """[(features, kWh จริงต่อ 30 วัน, cohort)] จากบิลจริง + การตั้งค่าบ้านปัจจุบันของผู้ใช้"""
+    samples = []
+    for r in db.execute("""
+        SELECT b.month, b.kwh, us.profile_json, us.state_json
+        FROM actual_bills b JOIN user_state us ON us.user_id = b.user_id
+        ORDER BY b.user_id, b.month
+    """):
+        profile, state = decode_blob(r["profile_json"]), decode_blob(r["state_json"])
+        cohort = "|".join(cohort_of(profile, state)[:2])
+        samples.append((household_features(profile, state), float(r["kwh"]) * 30.0 / month_days(r["month"]), cohort))
+    return samples
+
+
+@bp.cli.command("bills-import")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+def bills_import_command(csv_path):
+    """นำเข้าบิลจริงรายเดือนจาก CSV (user_id,month,kwh[,amount_thb])"""
+    init_db()
+    db = get_db()
+    imported, skipped = import_bills_csv(db, csv_path, {r["id"] for r in db.execute("SELECT id FROM users")})
+    print(json.dumps({"imported": imported, "skipped": skipped}))
+
+
+@bp.cli.command("calibrate")
+@click.option("--publish", is_flag=True, help="บันทึกเป็นเวอร์ชันใหม่และใช้งานทันที (worker อื่นโหลดตอนเริ่มใหม่)")
+@click.option("--ridge", type=float, default=None, help="น้ำหนักดึงกลับหาค่าเริ่มต้น")
+@click.option("--activate", "activate_version", type=int, default=None, help="สลับไปใช้เวอร์ชันที่มีอยู่แล้ว")
+def calibrate_command(publish, ridge, activate_version):
+    """fit ค่าสัมประสิทธิ์ของโมเดลอุปกรณ์กับบิลจริง (least squares)"""
+    init_db()
+    db = get_db()
+    if activate_version is not None:
+        if not activate_coefficients(db, activate_version):
+            raise click.ClickException(f"ไม่พบเวอร์ชัน {activate_version}")
+        print(json.dumps({"active": activate_version}))
+        return
+
+    samples = calibration_samples(db)
+    if not samples:
+        raise click.ClickException("ยังไม่มีบิลจริง (actual_bills)")
+    # fit จากค่าเริ่มต้นเสมอ ไม่ใช่จากเวอร์ชันที่ใช้อยู่ เพื่อไม่ให้ ridge ดึงค่าไหลไปเรื่อยๆ
+    t0 = time.perf_counter()
+    coeffs, report = fit_coefficients(samples, DEFAULT_MODEL_COEFFS,
+                                      **({"ridge": ridge} if ridge is not None else {}))
+    report["fit_seconds"] = round(time.perf_counter() - t0, 3)
+    if publish:
+        report["version"] = publish_coefficients(db, coeffs, report)
+    print(json.dumps({"coeffs": coeffs, "report": report}, ensure_ascii=False, indent=2))
+
+
+@bp.cli.command("tariff-cache")
+def tariff_cache_command():
+    """คำนวณ kWh/เดือนของบ้านที่ state เปลี่ยนไว้ล่วงหน้า ให้หน้า preview ค่าไฟตอบได้ทันที"""
+    init_db()
+    load_model_coefficients()
+    t0 = time.perf_counter()
+    usage, recomputed = refresh_household_usage(get_db(), _load_billing_settings())
+    print(json.dumps({"households": len(usage), "recomputed": recomputed,
+                      "seconds": round(time.perf_counter() - t0, 3)}))
+
+
+@bp.cli.command("cohorts")
+def cohorts_command():
+    """สร้างตารางเปอร์เซ็นไทล์ของกลุ่มบ้านที่คล้ายกันใหม่จาก energy_daily"""
+    init_db()
+    print(json.dumps(build_cohort_tables(get_db()), ensure_ascii=False))
+
+
+# ============================================================
+# ✅ Background jobs: งานหนักไม่รันใน request — admin กดสั่ง แล้ว jobs-worker (process แยก) ทำ
+# ============================================================
+JOB_PROCESSES = int(os.environ.get("ENERGY_LIFE_JOB_PROCESSES", 2))
+JOB_POLL_SECONDS = float(os.environ.get("ENERGY_LIFE_JOB_POLL", 1.0))
+EXPORT_DIR = os.environ.get("ENERGY_LIFE_EXPORT_DIR", "exports")
+EXPORT_USER_BATCH = 200
+JOBS_PAGE_SIZE = 50
+
+
+def _job_cohorts(job_id, payload, progress):
+    return build_cohort_tables(get_db())
+
+
+def _job_retention(job_id, payload, progress):
+    return run_retention(get_db())
+
+
+def _job_tariff_cache(job_id, payload, progress):
+    # payload ว่าง = ช่วง On-Peak ปัจจุบัน / {"on_peak_start", "on_peak_end"} = เตรียม cache ให้ preview ช่วงใหม่
+    usage, recomputed = refresh_household_usage(get_db(), {**_load_billing_settings(), **payload})
+    return {"households": len(usage), "recomputed": recomputed}
+
+
+def _job_calibrate(job_id, payload, progress):
+    db = get_db()
+    samples = calibration_samples(db)
+    if not samples:
+        raise ValueError("ยังไม่มีบิลจริง (actual_bills)")
+    progress(0.1, f"{len(samples)} บิล")
+    coeffs, report = fit_coefficients(samples, DEFAULT_MODEL_COEFFS)
+    if payload.get("publish"):
+        report["version"] = publish_coefficients(db, coeffs, report)
+    return {"coeffs": coeffs, "report": report}
+
+
+def _job_export_energy(job_id, payload, progress):
+    """ประวัติการใช้ไฟของทุกบ้านเป็น CSV.gz ใน EXPORT_DIR (ดาวน์โหลดจากหน้า Admin › Jobs)"""
+    db = get_analytics_db()
+    total = db.execute("SELECT COUNT(*) FROM users").fetchone()[0] or 1
+    name = f"energy_all_{job_id}.csv.gz"
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, name)
+    tmp = path + ".tmp"
+    rows = done = 0
+    last_id = 0
+    with gzip.open(tmp, "wt", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh)
+        w.writerow(["user_id"] + ENERGY_ARCHIVE_FIELDS)
+        while True:
+            ids = [r[0] for r in db.execute(
+                "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, EXPORT_USER_BATCH))]
+            if not ids:
+                break
+            for uid in ids:
+                for row in energy_history_rows(uid, db=db):
+                    w.writerow([uid] + row)
+                    rows += 1
+            last_id = ids[-1]
+            done += len(ids)
+            progress(done / total, f"{done}/{total} บ้าน")
+    os.replace(tmp, path)
+    return {"file": name, "rows": rows, "households": done}
+
+
+def _job_snapshot(job_id, payload, progress):
+    return take_snapshot(current_app.config["DATABASE"], current_app.config["SNAPSHOT_DIR"])
+
+
+# kind -> (ชื่อที่แสดง, handler(job_id, payload, progress) -> ผลลัพธ์ที่ JSON ได้)
+JOB_HANDLERS = {
+    "tariff_cache": ("คำนวณ kWh/เดือนทุกบ้าน (preview ค่าไฟ)", _job_tariff_cache),
+    "cohorts": ("สร้างตาราง cohort ใหม่", _job_cohorts),
+    "retention": ("ย่อ/ย้ายประวัติเก่า", _job_retention),
+    "calibrate": ("fit ค่าสัมประสิทธิ์กับบิลจริง", _job_calibrate),
+    "export_energy": ("export ประวัติทุกบ้าน (CSV.gz)", _job_export_energy),
+    "snapshot": ("snapshot/backup ฐานข้อมูล", _job_snapshot),
+}
+
+_job_app = None
+
+
+def _job_process_init(config):
+    # process ใน pool ของ jobs-worker: app ของตัวเอง + warmup ครั้งเดียว
+    global _job_app
+    _job_app = create_app({**config, "PRELOAD": True})
+
+
+def _run_job(job_id, kind, payload_json):
+    with _job_app.app_context():
+        def progress(fraction, note=None):
+            set_progress(get_db(), job_id, fraction, note)
+        return JOB_HANDLERS[kind][1](job_id, json.loads(payload_json or "{}"), progress)
+
+
+def _schedule_snapshot(db):
+    """ENERGY_LIFE_SNAPSHOT_EVERY นาที: ถ้า snapshot ล่าสุดเก่ากว่านั้นและยังไม่มีในคิว = เพิ่มงาน snapshot"""
+    snaps = list_snapshots(current_app.config["SNAPSHOT_DIR"])
+    if snaps and time.time() - snaps[0]["taken_at"] < SNAPSHOT_EVERY_MINUTES * 60:
+        return None
+    if db.execute("SELECT 1 FROM jobs WHERE kind='snapshot' AND status IN ('queued','running')").fetchone():
+        return None
+    return enqueue_job(db, "snapshot", {})
+
+
+@bp.cli.command("snapshot")
+@click.option("--list", "list_only", is_flag=True, help="แสดง snapshot ที่มีอยู่")
+def snapshot_command(list_only):
+    """สำเนาฐานข้อมูลแบบ online (SQLite backup API) ลง ENERGY_LIFE_SNAPSHOT_DIR — ใช้กับ cron ได้"""
+    snap_dir = current_app.config["SNAPSHOT_DIR"]
+    if list_only:
+        print(json.dumps([{k: s[k] for k in ("name", "bytes")} | {"taken_at": datetime.utcfromtimestamp(s["taken_at"]).isoformat()}
+                          for s in list_snapshots(snap_dir)], indent=2))
+        return
+    init_db()
+    print(json.dumps(take_snapshot(current_app.config["DATABASE"], snap_dir)))
+
+
+@bp.cli.command("jobs-worker")
+@click.option("--processes", type=int, default=JOB_PROCESSES, show_default=True, help="จำนวนงานที่รันพร้อมกัน")
+@click.option("--once", is_flag=True, help="ทำงานที่พร้อมในคิวจนหมดแล้วออก")
+def jobs_worker_command(processes, once):
+    """รันงานในคิว jobs ด้วย process pool (รันแยกจาก gunicorn; หยุดกลางคัน = lease หมดแล้วงานกลับเข้าคิว)"""
+    init_db()
+    db = get_db()
+    worker = worker_name()
+    kinds = list(JOB_HANDLERS)
+    config = {k: current_app.config[k]
+              for k in ("DATABASE", "V4_DATABASE", "SECRET_KEY", "SNAPSHOT_DIR", "ANALYTICS_FROM_SNAPSHOT")}
+    running = {}
+    extended_at = time.monotonic()
+    snapshot_check_at = 0.0
+    idle = 0
+    ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    print(json.dumps({"worker": worker, "processes": processes, "kinds": kinds}))
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                             initializer=_job_process_init, initargs=(config,)) as pool:
+        while True:
+            if SNAPSHOT_EVERY_MINUTES and time.monotonic() >= snapshot_check_at:
+                _schedule_snapshot(db)
+                snapshot_check_at = time.monotonic() + 60
+            while len(running) < processes:
+                job = lease_next(db, worker, kinds)
+                if job is None:
+                    break
+                running[pool.submit(_run_job, job["id"], job["kind"], job["payload_json"])] = job["id"]
+
+            if not running:
+                if once:
+                    break
+                idle_sleep(JOB_POLL_SECONDS, idle)
+                idle += 1
+                continue
+            idle = 0
+
+            finished, _ = wait_futures(running, timeout=JOB_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                job_id = running.pop(fut)
+                try:
+                    complete_job(db, job_id, worker, fut.result())
+                    print(json.dumps({"job": job_id, "status": "done"}))
+                except BrokenProcessPool:
+                    fail_job(db, job_id, worker, "process ของ worker ล้ม")
+                    raise click.ClickException("process pool ล้ม — เริ่ม jobs-worker ใหม่")
+                except Exception as e:
+                    fail_job(db, job_id, worker, f"{type(e).__name__}: {e}")
+                    print(json.dumps({"job": job_id, "status": "error", "error": str(e)}, ensure_ascii=False))
+
+            if time.monotonic() - extended_at > JOB_LEASE_SECONDS / 3:
+                extend_leases(db, list(running.values()), worker)
+                extended_at = time.monotonic()
+
+
+def __getattr__(name):
+    # ที่ deploy เดิมยังอ้าง app:app (gunicorn app:app / flask run) — สร้างเมื่อมีคนขอครั้งแรกเท่านั้น
+    # import app.py เฉยๆ ยังไม่มี I/O เหมือนเดิม
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    create_app().run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,282 @@
+import calendar
+import csv
+import json
+import math
+from datetime import datetime
+
+# ============================================================
+# Calibration: ค่าสัมประสิทธิ์ของโมเดลอุปกรณ์ + การ fit กับบิลจริง (least squares)
+# ============================================================
+# ค่าเริ่มต้น = ค่าที่เคยเขียนตายตัวไว้ใน calc_ac_kwh()/ตู้เย็น/size_factor/resident_factor
+DEFAULT_MODEL_COEFFS = {
+    "ac_cool_per_deg": 0.06,    # ต่ำกว่า 26°C: +6%/°C
+    "ac_warm_per_deg": 0.03,    # สูงกว่า 26°C: -3%/°C
+    "ac_min_mult": 0.70,
+    "ac_non_inverter": 1.15,
+    "fridge_6_9": 0.8,          # kWh/วัน/เครื่อง ตามขนาด (คิว)
+    "fridge_10_14": 1.0,
+    "fridge_15_18": 1.2,
+    "fridge_19_25": 1.5,
+    "fridge_open_per_time": 0.01,  # +1% ต่อการเปิดที่เกิน 20 ครั้ง/วัน
+    "size_small": 0.9,
+    "size_medium": 1.0,
+    "size_large": 1.15,
+    "resident_base": 0.85,
+    "resident_step": 0.08,
+    "resident_cap": 0.6,
+}
+
+# ขนาดตู้เย็น (คิว) ที่โมเดลมีค่าสัมประสิทธิ์ fridge_<band>
+FRIDGE_SIZE_BANDS = ("6_9", "10_14", "15_18", "19_25")
+
+# ตัวที่ fit (ac_min_mult / resident_cap เป็นจุดหักของโมเดล ไม่มี gradient ที่ใช้ได้)
+FIT_PARAMS = [
+    "ac_cool_per_deg", "ac_warm_per_deg", "ac_non_inverter",
+    "fridge_6_9", "fridge_10_14", "fridge_15_18", "fridge_19_25", "fridge_open_per_time",
+    "size_small", "size_medium", "size_large", "resident_base", "resident_step",
+]
+FIT_BOUNDS = (-0.5, 1.0)  # สัดส่วนเทียบค่าเริ่มต้น: ได้ตั้งแต่ ×0.5 ถึง ×2
+FIT_RIDGE = 0.002         # ดึงค่ากลับหาค่าเริ่มต้น (ตัวคูณ size × resident แยกกันไม่ออกจากบิลอย่างเดียว)
+FIT_MAX_ITERS = 20
+FIT_STEP = 1e-4
+
+CALIBRATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS actual_bills (
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    kwh REAL NOT NULL,
+    amount_thb REAL,
+    source TEXT NOT NULL,
+    entered_by INTEGER,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, month),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS model_coefficients (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    coeffs_json TEXT NOT NULL,
+    report_json TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+# ------------------------------------------------------------
+# สูตรของโมเดล (ใช้ทั้งใน compute_daily_energy() และตอน fit)
+# ------------------------------------------------------------
+def ac_temp_mult(c, set_temp):
+    if set_temp < 26:
+        return 1.0 + (26 - set_temp) * c["ac_cool_per_deg"]
+    if set_temp > 26:
+        return max(c["ac_min_mult"], 1.0 - (set_temp - 26) * c["ac_warm_per_deg"])
+    return 1.0
+
+
+def fridge_band_kwh(c, size_band):
+    band = str(size_band or "").strip()
+    return float(c.get(f"fridge_{band}", c["fridge_10_14"]))
+
+
+def fridge_open_factor(c, open_times):
+    mult = 1.0 + (open_times - 20) * c["fridge_open_per_time"]
+    # กันหลุด: ไม่ให้ต่ำหรือสูงเกินจริง
+    return max(0.6, min(1.8, float(mult)))
+
+
+def house_size_factor(c, house_size):
+    return float(c.get(f"size_{house_size}", 1.0))
+
+
+def resident_factor(c, residents):
+    return c["resident_base"] + min(c["resident_cap"], (residents - 1) * c["resident_step"])
+
+
+def model_month_kwh(c, f):
+    """kWh/เดือนจาก features ของบ้าน (ดู household_features() ใน app.py)"""
+    ac = 0.0
+    for kw_hours, set_temp, inverter in f["ac"]:
+        ac += kw_hours * (1.0 if inverter else c["ac_non_inverter"]) * ac_temp_mult(c, set_temp)
+    fridge = 0.0
+    for band, open_times, qty in f["fridge"]:
+        fridge += fridge_band_kwh(c, band) * fridge_open_factor(c, open_times) * qty
+    scale = house_size_factor(c, f["house_size"]) * resident_factor(c, f["residents"])
+    return scale * (30.0 * (ac + fridge + f["other_day"]) + f["other_month"])
+
+
+# ------------------------------------------------------------
+# Fit
+# ------------------------------------------------------------
+def _solve(a, b):
+    """แก้ระบบสมการเชิงเส้น a·x = b (Gaussian elimination + partial pivoting)"""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        piv = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[piv][col]) < 1e-12:
+            raise ValueError("singular matrix")
+        m[col], m[piv] = m[piv], m[col]
+        for r in range(col + 1, n):
+            k = m[r][col] / m[col][col]
+            if k:
+                for j in range(col, n + 1):
+                    m[r][j] -= k * m[col][j]
+    x = [0.0] * n
+    for i in range(n - 1, -1, -1):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+    return x
+
+
+def _coeffs_at(base, u):
+    c = dict(base)
+    for p, ui in zip(FIT_PARAMS, u):
+        c[p] = base[p] * (1.0 + ui)
+    return c
+
+
+def _error_stats(samples, c):
+    out = {}
+    for feats, target, cohort in samples:
+        pred = model_month_kwh(c, feats)
+        for key in (cohort, "*"):
+            s = out.setdefault(key, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += abs(pred - target) / target
+            s[2] += (pred - target) ** 2
+    return {k: {"n": n, "mape": round(ape / n, 4), "rmse_kwh": round(math.sqrt(se / n), 2)}
+            for k, (n, ape, se) in out.items()}
+
+
+def fit_coefficients(samples, base=None, ridge=FIT_RIDGE, max_iters=FIT_MAX_ITERS):
+    """Gauss-Newton + ridge บน residual แบบสัมพัทธ์ (ทุกบ้านมีน้ำหนักเท่ากัน)
+
+    samples: [(features, kWh จริงต่อ 30 วัน, cohort)] — คืน (coeffs, report)
+    สะสม JᵀJ / Jᵀr ทีละบ้านในรอบเดียว จึงใช้หน่วยความจำ O(p²) ไม่ว่าจะมีกี่บ้าน
+    """
+    base = dict(base or DEFAULT_MODEL_COEFFS)
+    samples = [s for s in samples if s[1] > 0]
+    if not samples:
+        raise ValueError("ไม่มีบิลที่ใช้ fit ได้")
+    p = len(FIT_PARAMS)
+    n = len(samples)
+    lam = ridge * n
+    lo, hi = FIT_BOUNDS
+    u = [0.0] * p
+    iters = 0
+
+    for iters in range(1, max_iters + 1):
+        c0 = _coeffs_at(base, u)
+        shifted = []
+        for j in range(p):
+            uj = list(u)
+            uj[j] += FIT_STEP
+            shifted.append(_coeffs_at(base, uj))
+
+        jtj = [[0.0] * p for _ in range(p)]
+        jtr = [0.0] * p
+        for feats, target, _ in samples:
+            f0 = model_month_kwh(c0, feats)
+            r = (target - f0) / target
+            row = [(model_month_kwh(cj, feats) - f0) / FIT_STEP / target for cj in shifted]
+            for a in range(p):
+                ra = row[a]
+                if ra == 0.0:
+                    continue
+                jtr[a] += ra * r
+                ja = jtj[a]
+                for b in range(a, p):
+                    ja[b] += ra * row[b]
+
+        for a in range(p):
+            for b in range(a):
+                jtj[a][b] = jtj[b][a]
+            jtj[a][a] += lam
+            jtr[a] -= lam * u[a]
+
+        delta = _solve(jtj, jtr)
+        u = [min(hi, max(lo, ui + di)) for ui, di in zip(u, delta)]
+        if max(abs(d) for d in delta) < 1e-6:
+            break
+
+    fitted = _coeffs_at(base, u)
+    report = {
+        "samples": n,
+        "iterations": iters,
+        "ridge": ridge,
+        "before": _error_stats(samples, base),
+        "after": _error_stats(samples, fitted),
+        "changes": {k: [round(base[k], 5), round(fitted[k], 5)] for k in FIT_PARAMS},
+    }
+    return {k: round(v, 6) for k, v in fitted.items()}, report
+
+
+# ------------------------------------------------------------
+# บิลจริง + เวอร์ชันของค่าสัมประสิทธิ์
+# ------------------------------------------------------------
+def month_days(month: str) -> int:
+    y, m = (int(x) for x in month.split("-"))
+    return calendar.monthrange(y, m)[1]
+
+
+def save_actual_bill(db, user_id, month, kwh, amount_thb=None, source="officer", entered_by=None):
+    datetime.strptime(month, "%Y-%m")
+    kwh = float(kwh)
+    if not math.isfinite(kwh) or kwh <= 0:
+        raise ValueError("kWh ต้องมากกว่า 0")
+    db.execute("""
+        INSERT INTO actual_bills(user_id,month,kwh,amount_thb,source,entered_by,created_at)
+        VALUES(?,?,?,?,?,?,?)
+        ON CONFLICT(user_id,month) DO UPDATE SET
+            kwh=excluded.kwh, amount_thb=excluded.amount_thb, source=excluded.source,
+            entered_by=excluded.entered_by, created_at=excluded.created_at
+    """, (user_id, month, kwh, None if amount_thb in (None, "") else float(amount_thb), source, entered_by,
+          datetime.utcnow().isoformat()))
+
+
+def import_bills_csv(db, path, user_ids):
+    """CSV: user_id,month,kwh[,amount_thb] — คืน (นำเข้า, ข้าม)"""
+    imported = skipped = 0
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        for row in csv.DictReader(fh):
+            try:
+                uid = int(row["user_id"])
+                if uid not in user_ids:
+                    raise ValueError(uid)
+                save_actual_bill(db, uid, row["month"].strip(), row["kwh"], row.get("amount_thb"), source="import")
+                imported += 1
+            except (KeyError, ValueError, TypeError):
+                skipped += 1
+    db.commit()
+    return imported, skipped
+
+
+def publish_coefficients(db, coeffs, report):
+    now = datetime.utcnow().isoformat()
+    with db:
+        db.execute("UPDATE model_coefficients SET active=0 WHERE active=1")
+        cur = db.execute("""
+            INSERT INTO model_coefficients(coeffs_json,report_json,samples,active,created_at)
+            VALUES(?,?,?,1,?)
+        """, (json.dumps(coeffs), json.dumps(report, ensure_ascii=False), report["samples"], now))
+    return cur.lastrowid
+
+
+def activate_coefficients(db, version):
+    with db:
+        if not db.execute("SELECT 1 FROM model_coefficients WHERE version=?", (version,)).fetchone():
+            return False
+        db.execute("UPDATE model_coefficients SET active = (version = ?)", (version,))
+    return True
+
+
+def load_active_coefficients(db):
+    """คืน (version, coeffs) — ยังไม่เคย publish = (None, ค่าเริ่มต้น)"""
+    row = db.execute("SELECT version, coeffs_json FROM model_coefficients WHERE active=1").fetchone()
+    coeffs = dict(DEFAULT_MODEL_COEFFS)
+    if row is None:
+        return None, coeffs
+    # ค่าที่เพิ่มเข้ามาภายหลังแต่ไม่มีในเวอร์ชันเก่าจะใช้ค่าเริ่มต้น
+    coeffs.update({k: float(v) for k, v in json.loads(row[1]).items() if k in coeffs})
+    return row[0], coeffs
@@ -0,0 +1,145 @@
+import bisect
+import os
+from array import array
+from datetime import datetime, timedelta
+
+from state_codec import decode_blob
+
+# ============================================================
+# Cohort percentiles: ตารางเปอร์เซ็นไทล์ kWh/วัน ของ "บ้านที่คล้ายกัน"
+# สร้างเป็นรอบ (flask --app app cohorts) แล้วตอน simulate แค่เปิดตาราง + bisect
+# ============================================================
+COHORT_WINDOW_DAYS = int(os.environ.get("ENERGY_LIFE_COHORT_WINDOW_DAYS", 30))
+COHORT_MIN_SIZE = int(os.environ.get("ENERGY_LIFE_COHORT_MIN_SIZE", 5))
+COHORT_POINTS = 101  # p0..p100
+USER_BATCH = 500
+
+# ลำดับการถอยไปกลุ่มที่กว้างขึ้นเมื่อกลุ่มละเอียดมีบ้านไม่พอ (ตัดมิติจากท้ายก่อน)
+COHORT_DIMS = ("house_type", "house_size", "residents", "tariff", "ev", "solar")
+WILDCARD = "*"
+
+COHORT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cohort_percentiles (
+    cohort_key TEXT PRIMARY KEY,
+    n INTEGER NOT NULL,
+    cuts BLOB NOT NULL,
+    built_at TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def _residents_band(residents) -> str:
+    try:
+        r = int(residents)
+    except (TypeError, ValueError):
+        r = 3
+    if r <= 1:
+        return "1"
+    if r == 2:
+        return "2"
+    if r <= 4:
+        return "3-4"
+    return "5+"
+
+
+def _has_enabled(state, key) -> bool:
+    rooms = state.get("rooms") or {}
+    if isinstance(rooms, dict) and rooms:
+        appls = [(r.get("appliances") or {}) for r in rooms.values() if isinstance(r, dict)]
+    else:
+        appls = [state.get("appliances") or {}]
+    return any(isinstance(a.get(key), dict) and a[key].get("enabled", False) for a in appls)
+
+
+def cohort_of(profile: dict, state: dict) -> tuple:
+    """ค่ามิติของบ้านตามลำดับ COHORT_DIMS"""
+    layout = state.get("house_layout") or {}
+    solar = float(state.get("solar_kw", 0) or 0) > 0 or state.get("solar_mode") == "advisor"
+    return (
+        str(layout.get("house_type") or profile.get("house_type") or "condo"),
+        str(profile.get("house_size") or "medium"),
+        _residents_band(profile.get("residents", 3)),
+        "tou" if state.get("tariff_mode") == "tou" else "non_tou",
+        "ev" if _has_enabled(state, "ev_charger") else "no_ev",
+        "pv" if solar else "no_pv",
+    )
+
+
+def cohort_keys(dims: tuple) -> list:
+    """key จากละเอียดที่สุดไปกว้างที่สุด เช่น condo|medium|3-4|tou|ev|pv ... *|*|*|*|*|*"""
+    keys = []
+    for keep in range(len(dims), -1, -1):
+        keys.append("|".join(list(dims[:keep]) + [WILDCARD] * (len(dims) - keep)))
+    return keys
+
+
+def _percentile_cuts(values) -> array:
+    values = sorted(values)
+    last = len(values) - 1
+    cuts = array("f")
+    for i in range(COHORT_POINTS):
+        pos = last * i / (COHORT_POINTS - 1)
+        lo = int(pos)
+        hi = min(lo + 1, last)
+        cuts.append(values[lo] + (values[hi] - values[lo]) * (pos - lo))
+    return cuts
+
+
+def build_cohort_tables(db, today=None, window_days=COHORT_WINDOW_DAYS, min_size=COHORT_MIN_SIZE):
+    """สร้าง cohort_percentiles ใหม่ทั้งตารางจากค่าเฉลี่ย kWh/วัน ของแต่ละบ้านในช่วง window_days"""
+    db.executescript(COHORT_SCHEMA)
+    today = today or datetime.utcnow().date()
+    since = (today - timedelta(days=window_days)).isoformat()
+
+    avg_by_user = {r[0]: float(r[1]) for r in db.execute("""
+        SELECT user_id, AVG(kwh_total) FROM energy_daily
+        WHERE date >= ? GROUP BY user_id
+    """, (since,))}
+
+    groups = {}
+    last_id = -1
+    while True:
+        rows = db.execute(
+            "SELECT user_id, profile_json, state_json FROM user_state WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (last_id, USER_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        for user_id, profile_raw, state_raw in rows:
+            last_id = user_id
+            if user_id not in avg_by_user:
+                continue
+            dims = cohort_of(decode_blob(profile_raw) or {}, decode_blob(state_raw) or {})
+            for key in cohort_keys(dims):
+                groups.setdefault(key, []).append(avg_by_user[user_id])
+
+    built_at = datetime.utcnow().isoformat()
+    rows = [(key, len(vals), _percentile_cuts(vals).tobytes(), built_at)
+            for key, vals in groups.items() if len(vals) >= min_size]
+    with db:
+        db.execute("DELETE FROM cohort_percentiles")
+        db.executemany("INSERT INTO cohort_percentiles(cohort_key,n,cuts,built_at) VALUES(?,?,?,?)", rows)
+    return {"homes": len(avg_by_user), "cohorts": len(rows), "since": since, "built_at": built_at}
+
+
+def load_cohort_tables(db) -> dict:
+    """{cohort_key: (n, cuts)} — ทั้งตารางมีขนาดเล็ก (404 bytes ต่อ cohort) โหลดเก็บไว้ทั้ง worker ได้"""
+    out = {}
+    for key, n, blob in db.execute("SELECT cohort_key, n, cuts FROM cohort_percentiles"):
+        cuts = array("f")
+        cuts.frombytes(blob)
+        out[key] = (n, cuts)
+    return out
+
+
+def cohort_percentile(tables: dict, dims: tuple, kwh_day: float):
+    """คืน {"percentile", "n", "cohort"} จากกลุ่มที่ละเอียดที่สุดที่มีข้อมูล หรือ None"""
+    for key in cohort_keys(dims):
+        hit = tables.get(key)
+        if hit is None:
+            continue
+        n, cuts = hit
+        # จำนวน cut ที่ต่ำกว่าค่านี้ = เปอร์เซ็นไทล์ (0 = ใช้น้อยที่สุดในกลุ่ม)
+        pct = bisect.bisect_left(cuts, kwh_day)
+        return {"percentile": min(100, pct), "n": n, "cohort": key}
+    return None
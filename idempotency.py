@@ -0,0 +1,136 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+# ============================================================
+# Idempotency: POST ที่ส่งซ้ำ (กดสองครั้ง / มือถือ retry เอง) ด้วย Idempotency-Key เดิม
+# ได้คำตอบเดิมกลับไป ไม่จำลองวัน/ไม่ให้แต้มซ้ำ — เก็บคำตอบต่อ (user, key) ไว้ IDEMPOTENCY_TTL_HOURS
+# ============================================================
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get("ENERGY_LIFE_IDEMPOTENCY_TTL_HOURS", 24))
+IDEMPOTENCY_WAIT_SECONDS = 10.0   # คำขอซ้ำที่มาระหว่างคำขอแรกยังทำอยู่ รอได้นานเท่านี้
+IDEMPOTENCY_POLL_SECONDS = 0.05  # รอบแรก แล้วห่างขึ้นเท่าตัวจนถึง IDEMPOTENCY_POLL_MAX_SECONDS
+IDEMPOTENCY_POLL_MAX_SECONDS = 0.5
+IDEMPOTENCY_STALE_SECONDS = 60    # จองไว้แต่ไม่มีคำตอบนานเกินนี้ = process ที่ทำตายไปแล้ว
+IDEMPOTENCY_KEY_RE = re.compile(r"[A-Za-z0-9_.:-]{8,128}")
+
+IDEMPOTENCY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER,
+    mimetype TEXT,
+    body BLOB,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, key),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at);
+"""
+
+
+def request_fingerprint(method, path, body: bytes) -> str:
+    h = hashlib.sha256(f"{method} {path}\n".encode())
+    h.update(body or b"")
+    return h.hexdigest()
+
+
+def claim_key(db, user_id, key, fingerprint, purge=True):
+    """จองคีย์ — คืน ("new", None) / ("replay", row) / ("pending", None) / ("mismatch", None)
+
+    "new" = คำขอนี้เป็นคนทำ (ต้องเรียก store_response() หรือ release_key() ตามมา)
+    """
+    now = datetime.utcnow()
+    if purge:
+        # ล้างคีย์หมดอายุของผู้ใช้คนนี้ไปด้วย (ช่วง PK ของผู้ใช้) — ทั้งตารางล้างโดย purge_expired_keys
+        cutoff = (now - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).isoformat()
+        db.execute("DELETE FROM idempotency_keys WHERE user_id=? AND created_at < ?", (user_id, cutoff))
+    cur = db.execute("""
+        INSERT INTO idempotency_keys(user_id,key,fingerprint,created_at) VALUES(?,?,?,?)
+        ON CONFLICT(user_id,key) DO NOTHING
+    """, (user_id, key, fingerprint, now.isoformat()))
+    db.commit()
+    if cur.rowcount == 1:
+        return "new", None
+    outcome, row = peek_key(db, user_id, key, fingerprint)
+    if outcome is None:  # ถูกปล่อยคืนไประหว่างนี้ / คนทำตายไปแล้ว (ลบเฉพาะที่ค้างจริง ไม่แย่งคีย์ที่เพิ่งจอง)
+        stale = (now - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS)).isoformat()
+        db.execute("DELETE FROM idempotency_keys WHERE user_id=? AND key=? AND status_code IS NULL AND created_at < ?",
+                   (user_id, key, stale))
+        db.commit()
+        return claim_key(db, user_id, key, fingerprint, purge=False)
+    return outcome, row
+
+
+def peek_key(db, user_id, key, fingerprint):
+    """อ่านสถานะคีย์อย่างเดียว (SELECT) — ใช้ตอนรอคำขอแรก
+
+    คืนเหมือน claim_key ยกเว้น (None, None) = ไม่มีคีย์แล้ว หรือจองค้างนานเกิน (ต้อง claim_key ใหม่)
+    """
+    row = db.execute("""
+        SELECT fingerprint, status_code, mimetype, body, created_at FROM idempotency_keys WHERE user_id=? AND key=?
+    """, (user_id, key)).fetchone()
+    db.commit()  # จบ read transaction (WAL: ไม่ค้าง snapshot เก่าระหว่าง poll)
+    if row is None:
+        return None, None
+    if row[0] != fingerprint:
+        return "mismatch", None
+    if row[1] is None:
+        stale = (datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS)).isoformat()
+        return (None, None) if row[4] < stale else ("pending", None)
+    return "replay", row
+
+
+def purge_expired_keys(db, now=None):
+    """ลบคีย์หมดอายุทั้งตาราง (ผู้ใช้ที่ไม่กลับมาอีก) — คืนจำนวนแถว"""
+    cutoff = ((now or datetime.utcnow()) - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).isoformat()
+    cur = db.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (cutoff,))
+    db.commit()
+    return cur.rowcount
+
+
+def store_response(db, user_id, key, status_code, mimetype, body: bytes):
+    db.execute("UPDATE idempotency_keys SET status_code=?, mimetype=?, body=? WHERE user_id=? AND key=?",
+               (int(status_code), mimetype, body, user_id, key))
+    db.commit()
+
+
+def release_key(db, user_id, key):
+    """คำขอแรกล้ม (5xx/exception) — ปล่อยคีย์ให้ retry ทำใหม่ได้"""
+    db.execute("DELETE FROM idempotency_keys WHERE user_id=? AND key=? AND status_code IS NULL", (user_id, key))
+    db.commit()
+
+
+class _Flight:
+    __slots__ = ("done", "response")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class InflightGroup:
+    """คำขอที่เหมือนกันซึ่งมาพร้อมกันใน process เดียว ให้คำขอแรกคำนวณ ที่เหลือรอใช้ผลเดียวกัน"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def join(self, key):
+        """คืน (เป็นคนคำนวณหรือไม่, flight)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return False, flight
+            flight = self._flights[key] = _Flight()
+            return True, flight
+
+    def leave(self, key, flight, response=None):
+        flight.response = response
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+# ============================================================
+# Job queue: งานหนัก (คำนวณทั้งประชากร, export, rebuild, retention) เก็บเป็นแถวใน SQLite
+# worker แยก process (flask --app app jobs-worker) เช่า (lease) งานทีละชิ้น — ถ้า worker ตาย
+# lease หมดอายุแล้วงานกลับเข้าคิวเอง / ล้มเหลวได้ max_attempts ครั้งพร้อม backoff
+# ============================================================
+JOB_LEASE_SECONDS = int(os.environ.get("ENERGY_LIFE_JOB_LEASE", 120))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 30  # 30s, 60s, 120s, ...
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload_json TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after TEXT NOT NULL,
+    lease_until TEXT,
+    worker TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    progress_note TEXT,
+    result_json TEXT,
+    error TEXT,
+    created_by INTEGER,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+"""
+
+
+def _now():
+    return datetime.utcnow()
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue(db, kind, payload=None, created_by=None, max_attempts=JOB_MAX_ATTEMPTS, delay_seconds=0):
+    now = _now()
+    cur = db.execute("""
+        INSERT INTO jobs(kind,payload_json,max_attempts,run_after,created_by,created_at)
+        VALUES(?,?,?,?,?,?)
+    """, (kind, json.dumps(payload or {}, ensure_ascii=False), int(max_attempts),
+          (now + timedelta(seconds=delay_seconds)).isoformat(), created_by, now.isoformat()))
+    db.commit()
+    return cur.lastrowid
+
+
+def enqueue_once(db, kind, payload=None, created_by=None):
+    """เหมือน enqueue แต่ถ้ามีงานชนิด+payload เดียวกันรออยู่/กำลังทำ คืน id เดิม (กดซ้ำไม่เพิ่มงาน)"""
+    payload_json = json.dumps(payload or {}, ensure_ascii=False)
+    row = db.execute("""
+        SELECT id FROM jobs WHERE status IN ('queued','running') AND kind=? AND payload_json=? ORDER BY id LIMIT 1
+    """, (kind, payload_json)).fetchone()
+    if row:
+        return row[0]
+    return enqueue(db, kind, payload, created_by)
+
+
+def lease_next(db, worker, kinds, lease_seconds=JOB_LEASE_SECONDS):
+    """เช่างานถัดไปที่พร้อม (หรือ running ที่ lease หมดอายุ) แบบ atomic — คืนแถวหรือ None"""
+    now = _now()
+    # worker ตายระหว่างทำครบทุกครั้งแล้ว (เช่น งานทำให้ process ล้ม) = ไม่เช่าใหม่อีก
+    db.execute("""
+        UPDATE jobs SET status='failed', lease_until=NULL, finished_at=?, error=COALESCE(error, 'lease หมดอายุ')
+        WHERE status='running' AND lease_until < ? AND attempts >= max_attempts
+    """, (now.isoformat(), now.isoformat()))
+    marks = ",".join("?" * len(kinds))
+    row = db.execute(f"""
+        UPDATE jobs SET status='running', attempts=attempts+1, worker=?, lease_until=?,
+                        started_at=?, error=NULL
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE kind IN ({marks}) AND (
+                (status='queued' AND run_after <= ?) OR (status='running' AND lease_until < ?)
+            )
+            ORDER BY id LIMIT 1
+        )
+        RETURNING id, kind, payload_json, attempts, max_attempts
+    """, (worker, (now + timedelta(seconds=lease_seconds)).isoformat(), now.isoformat(),
+          *kinds, now.isoformat(), now.isoformat())).fetchone()
+    db.commit()
+    return row
+
+
+def extend_leases(db, job_ids, worker, lease_seconds=JOB_LEASE_SECONDS):
+    """worker ยังทำงานอยู่: ต่อ lease ของงานที่ถืออยู่ (ไม่ให้ worker อื่นแย่งไป)"""
+    if not job_ids:
+        return
+    until = (_now() + timedelta(seconds=lease_seconds)).isoformat()
+    db.executemany("UPDATE jobs SET lease_until=? WHERE id=? AND worker=? AND status='running'",
+                   [(until, jid, worker) for jid in job_ids])
+    db.commit()
+
+
+def set_progress(db, job_id, progress, note=None):
+    db.execute("UPDATE jobs SET progress=?, progress_note=? WHERE id=? AND status='running'",
+               (max(0.0, min(1.0, float(progress))), note, job_id))
+    db.commit()
+
+
+def complete(db, job_id, worker, result):
+    db.execute("""
+        UPDATE jobs SET status='done', progress=1, result_json=?, lease_until=NULL, finished_at=?
+        WHERE id=? AND worker=? AND status='running'
+    """, (json.dumps(result, ensure_ascii=False, default=str), _now().isoformat(), job_id, worker))
+    db.commit()
+
+
+def fail(db, job_id, worker, error):
+    """ยังเหลือโอกาส = กลับเข้าคิวพร้อม backoff / ครบแล้ว = failed"""
+    row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if row is None:
+        return
+    now = _now()
+    if row[0] < row[1]:
+        run_after = now + timedelta(seconds=JOB_RETRY_BASE_SECONDS * 2 ** (row[0] - 1))
+        db.execute("""
+            UPDATE jobs SET status='queued', run_after=?, lease_until=NULL, error=?
+            WHERE id=? AND worker=? AND status='running'
+        """, (run_after.isoformat(), str(error)[:2000], job_id, worker))
+    else:
+        db.execute("""
+            UPDATE jobs SET status='failed', lease_until=NULL, error=?, finished_at=?
+            WHERE id=? AND worker=? AND status='running'
+        """, (str(error)[:2000], now.isoformat(), job_id, worker))
+    db.commit()
+
+
+def retry(db, job_id):
+    """admin สั่งรันงานที่ failed ใหม่ (นับ attempts ใหม่)"""
+    cur = db.execute("""
+        UPDATE jobs SET status='queued', attempts=0, run_after=?, error=NULL, finished_at=NULL, progress=0
+        WHERE id=? AND status='failed'
+    """, (_now().isoformat(), job_id))
+    db.commit()
+    return cur.rowcount > 0
+
+
+def job_stats(db, window_hours=24):
+    since = (_now() - timedelta(hours=window_hours)).isoformat()
+    counts = {s: 0 for s in JOB_STATUSES}
+    for status, n in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+        counts[status] = n
+    by_kind = [dict(r) for r in db.execute("""
+        SELECT kind, SUM(status='done') AS done, SUM(status='failed') AS failed,
+               AVG(CASE WHEN status='done'
+                        THEN (julianday(finished_at) - julianday(started_at)) * 86400 END) AS avg_seconds
+        FROM jobs WHERE finished_at >= ? GROUP BY kind ORDER BY kind
+    """, (since,))]
+    done = sum(r["done"] or 0 for r in by_kind)
+    return {
+        "counts": counts,
+        "window_hours": window_hours,
+        "done": done,
+        "per_hour": round(done / window_hours, 2),
+        "by_kind": by_kind,
+        "oldest_queued": db.execute(
+            "SELECT MIN(created_at) FROM jobs WHERE status='queued'"
+        ).fetchone()[0],
+    }
+
+
+def list_jobs(db, status=None, before_id=None, limit=50):
+    sql = "SELECT * FROM jobs WHERE 1=1"
+    args = []
+    if status:
+        sql += " AND status=?"
+        args.append(status)
+    if before_id is not None:
+        sql += " AND id < ?"
+        args.append(int(before_id))
+    sql += " ORDER BY id DESC LIMIT ?"
+    args.append(int(limit))
+    return db.execute(sql, args).fetchall()
+
+
+def idle_sleep(poll, idle_rounds):
+    """poll ถี่ตอนมีงาน ห่างขึ้นเรื่อยๆ ตอนคิวว่าง (สูงสุด 8 เท่า)"""
+    time.sleep(poll * min(8, 2 ** idle_rounds))
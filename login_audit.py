@@ -0,0 +1,189 @@
+import atexit
+import ipaddress
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# ============================================================
+# Login audit: บันทึกการเข้าสู่ระบบแบบกะทัดรัด
+# - User-Agent เก็บครั้งเดียวในตาราง user_agents (แถวอ้างด้วย id)
+# - IP เก็บเป็นไบต์ (4/16 ไบต์) เวลาเป็น unix seconds
+# - หน้า login แค่ใส่ buffer — thread เบื้องหลังเขียนทีละชุด (1 commit ต่อชุด)
+# - users.last_login_at อัปเดตพร้อมกัน: "active ใน N วัน" = นับจาก index ไม่ต้องสแกน log
+# ============================================================
+LOGIN_LOG_BATCH = int(os.environ.get("ENERGY_LIFE_LOGIN_LOG_BATCH", 100))
+LOGIN_LOG_FLUSH_SECONDS = float(os.environ.get("ENERGY_LIFE_LOGIN_LOG_FLUSH", 2.0))
+USER_AGENT_MAX_LEN = 512
+USER_AGENT_CACHE_MAX = 2048
+LEGACY_MIGRATE_BATCH = 5000
+
+LOGIN_AUDIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_agents (
+    id INTEGER PRIMARY KEY,
+    ua TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS login_events (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    ip BLOB,
+    ua_id INTEGER,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+"""
+
+
+def pack_ip(ip):
+    try:
+        return ipaddress.ip_address(ip).packed
+    except (TypeError, ValueError):
+        return None
+
+
+def unpack_ip(raw):
+    return str(ipaddress.ip_address(bytes(raw))) if raw else None
+
+
+def _utc_ts(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def _iso_to_ts(s):
+    return _utc_ts(datetime.fromisoformat(s)) if s else 0
+
+
+def ts_to_iso(ts):
+    return datetime.utcfromtimestamp(ts).isoformat()
+
+
+def intern_user_agents(db, uas, cache=None):
+    """คืน {ua: id} — เพิ่ม ua ที่ยังไม่มี (ไม่ commit)"""
+    cache = {} if cache is None else cache
+    missing = [ua for ua in set(uas) if ua not in cache]
+    if missing:
+        db.executemany("INSERT OR IGNORE INTO user_agents(ua) VALUES(?)", [(ua,) for ua in missing])
+        for i in range(0, len(missing), 500):
+            part = missing[i:i + 500]
+            marks = ",".join("?" * len(part))
+            cache.update(db.execute(f"SELECT ua, id FROM user_agents WHERE ua IN ({marks})", part).fetchall())
+    return cache
+
+
+def write_login_events(db, events, ua_cache=None):
+    """events: [(user_id, ts, ip (ข้อความ), user_agent)] — แถว log + users.last_login_at (ไม่ commit)"""
+    uas = [(ua or "")[:USER_AGENT_MAX_LEN] for _, _, _, ua in events]
+    ids = intern_user_agents(db, [ua for ua in uas if ua], ua_cache)
+    db.executemany("INSERT INTO login_events(user_id,ts,ip,ua_id) VALUES(?,?,?,?)", [
+        (uid, int(ts), pack_ip(ip), ids.get(ua) if ua else None)
+        for (uid, ts, ip, _), ua in zip(events, uas)
+    ])
+    latest = {}
+    for uid, ts, _, _ in events:
+        latest[uid] = max(latest.get(uid, 0), int(ts))
+    db.executemany("""
+        UPDATE users SET last_login_at = ? WHERE id = ? AND (last_login_at IS NULL OR last_login_at < ?)
+    """, [(ts_to_iso(ts), uid, ts_to_iso(ts)) for uid, ts in latest.items()])
+
+
+def read_login_events(db, before_ts, limit):
+    """แถวที่เก่ากว่า before_ts ในรูปแบบเดิมของ login_log (id,user_id,ip,user_agent,created_at) — ใช้ตอน archive"""
+    rows = db.execute("""
+        SELECT e.id, e.user_id, e.ip, a.ua, e.ts
+        FROM login_events e LEFT JOIN user_agents a ON a.id = e.ua_id
+        WHERE e.ts < ? ORDER BY e.id LIMIT ?
+    """, (int(before_ts), int(limit))).fetchall()
+    return [{"id": r[0], "user_id": r[1], "ip": unpack_ip(r[2]), "user_agent": r[3] or "",
+             "created_at": ts_to_iso(r[4])} for r in rows]
+
+
+def migrate_legacy_login_log(db):
+    """ย้าย login_log แบบเดิม (ข้อความเต็มทุกแถว) มาเป็น login_events แล้วลบตารางเดิม"""
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='login_log'").fetchone():
+        return 0
+    moved = 0
+    cache = {}
+    last_id = 0
+    with db:
+        while True:
+            rows = db.execute("""
+                SELECT id, user_id, ip, user_agent, created_at FROM login_log WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, LEGACY_MIGRATE_BATCH)).fetchall()
+            if not rows:
+                break
+            write_login_events(db, [(r[1], _iso_to_ts(r[4]), r[2], r[3]) for r in rows], cache)
+            last_id = rows[-1][0]
+            moved += len(rows)
+        db.execute("DROP TABLE login_log")
+    return moved
+
+
+class LoginAuditBuffer:
+    """buffer ต่อ process: record() ไม่แตะฐานข้อมูล / flush() เขียนทั้งชุดด้วย connection ของตัวเอง"""
+
+    def __init__(self, db_path, batch=LOGIN_LOG_BATCH, flush_seconds=LOGIN_LOG_FLUSH_SECONDS):
+        self.db_path = db_path
+        self.batch = batch
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._ua_ids = {}
+        self._wake = threading.Event()
+        self._thread_pid = None
+        self.flushed = 0
+        atexit.register(self._flush_at_exit)
+
+    def record(self, user_id, ip, user_agent, when=None):
+        ts = _utc_ts(when or datetime.utcnow())
+        with self._lock:
+            self._pending.append((user_id, ts, ip, user_agent))
+            full = len(self._pending) >= self.batch
+            # gunicorn fork หลัง preload: thread ไม่ตามมาใน process ลูก — เริ่มใหม่ต่อ pid
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, args=(self._wake,), name="login-audit", daemon=True).start()
+        if full:
+            self._wake.set()
+
+    def _run(self, wake):
+        while True:
+            wake.wait(self.flush_seconds)
+            wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(self.flush_seconds)  # ฐานข้อมูลล็อกอยู่: แถวยังอยู่ใน buffer ลองรอบถัดไป
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except sqlite3.Error:
+            pass
+
+    def flush(self):
+        """เขียนทุกแถวที่ค้างอยู่ — คืนจำนวนแถว"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+            if not events:
+                return 0
+            if len(self._ua_ids) > USER_AGENT_CACHE_MAX:
+                self._ua_ids.clear()
+            try:
+                db = sqlite3.connect(self.db_path, timeout=10)
+                try:
+                    with db:
+                        write_login_events(db, events, self._ua_ids)
+                finally:
+                    db.close()
+            except sqlite3.Error:
+                self._ua_ids.clear()
+                with self._lock:
+                    self._pending[:0] = events
+                raise
+            self.flushed += len(events)
+            return len(events)
@@ -0,0 +1,188 @@
+import argparse
+import calendar
+import csv
+import itertools
+import math
+import mmap
+import os
+from array import array
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+# ============================================================
+# Smart meter: ค่าอ่านมิเตอร์ทุก 15 นาที เก็บเป็นไฟล์ไบนารีความกว้างคงที่ต่อผู้ใช้ต่อเดือน
+#   <METER_DIR>/user_<id>/<YYYY-MM>.f32
+#   float32 (byte order ของเครื่อง), ช่อง = (วันที่-1) * 96 + ชั่วโมง*4 + นาที//15, ไม่มีข้อมูล = NaN
+# ไฟล์หนึ่งเดือน ~12 KB ต่อบ้าน เปิดด้วย mmap แล้วอ่าน/เขียนตามตำแหน่งได้ทันที
+# ============================================================
+METER_DIR = os.environ.get("ENERGY_LIFE_METER_DIR", "meter_data")
+SLOTS_PER_DAY = 96
+SLOT_MINUTES = 15
+ITEM_SIZE = 4
+CHUNK_ROWS = 200_000
+
+NAN = float("nan")
+_NAN_BLOCK = array("f", [NAN] * SLOTS_PER_DAY).tobytes()
+
+if array("f").itemsize != ITEM_SIZE:
+    raise ImportError("meter_store ต้องการ float32 ขนาด 4 ไบต์")
+
+
+class MeterImportError(ValueError):
+    pass
+
+
+def _month_path(meter_dir, user_id, year, month) -> Path:
+    return Path(meter_dir) / f"user_{int(user_id)}" / f"{year:04d}-{month:02d}.f32"
+
+
+def _open_month(meter_dir, user_id, year, month, create=False):
+    """คืน (file, mmap) ของเดือนนั้น หรือ None ถ้ายังไม่มีไฟล์และไม่ได้ให้สร้าง"""
+    path = _month_path(meter_dir, user_id, year, month)
+    if not path.exists():
+        if not create:
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        days = calendar.monthrange(year, month)[1]
+        with open(path, "wb") as f:
+            f.write(_NAN_BLOCK * days)
+    f = open(path, "r+b" if create else "rb")
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+    return f, mm
+
+
+def _parse_header(row):
+    """หา index ของคอลัมน์จาก header — คืน (ts_idx, value_idx, scale, user_idx) หรือ None ถ้าไม่ใช่ header"""
+    cols = [c.strip().lower() for c in row]
+    ts_idx = next((i for i, c in enumerate(cols) if c in ("timestamp", "datetime", "time", "ts")), None)
+    if ts_idx is None:
+        return None
+    user_idx = next((i for i, c in enumerate(cols) if c in ("user_id", "uid")), None)
+    for name, scale in (("kwh", 1.0), ("wh", 0.001), ("kw", SLOT_MINUTES / 60.0)):
+        if name in cols:
+            return ts_idx, cols.index(name), scale, user_idx
+    raise MeterImportError("header ต้องมีคอลัมน์ kwh, wh หรือ kw")
+
+
+def _flush(pending, meter_dir):
+    """เขียน {(user, year, month): [(slot, kwh), ...]} ลงไฟล์ผ่าน mmap"""
+    for (uid, year, month), items in pending.items():
+        f, mm = _open_month(meter_dir, uid, year, month, create=True)
+        try:
+            view = memoryview(mm).cast("f")
+            try:
+                for slot, kwh in items:
+                    view[slot] = kwh
+            finally:
+                view.release()
+            mm.flush()
+        finally:
+            mm.close()
+            f.close()
+    pending.clear()
+
+
+def ingest_csv(path, user_id=None, meter_dir=METER_DIR, chunk_rows=CHUNK_ROWS, allowed_users=None):
+    """อ่าน CSV ทีละ chunk แล้วเขียนลงไฟล์รายเดือน — ไม่โหลดทั้งไฟล์เข้าหน่วยความจำ
+
+    รูปแบบ: timestamp,kwh (หรือ wh / kw เฉลี่ย 15 นาที) และคอลัมน์ user_id ถ้าไฟล์มีหลายบ้าน
+    timestamp = เวลาเริ่มช่วง 15 นาที (เวลาท้องถิ่น ISO 8601)
+    """
+    stats = {"rows": 0, "stored": 0, "skipped": 0, "users": set(), "first": None, "last": None}
+    pending = {}
+    buffered = 0
+
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        reader = csv.reader(fh)
+        first = next(reader, None)
+        if first is None:
+            return {**stats, "users": []}
+        layout = _parse_header(first)
+        if layout is None:
+            layout = (0, 1, 1.0, None)
+            rows = itertools.chain([first], reader)
+        else:
+            rows = reader
+        ts_idx, val_idx, scale, user_idx = layout
+        if user_idx is None and user_id is None:
+            raise MeterImportError("ต้องระบุ user_id (ไฟล์ไม่มีคอลัมน์ user_id)")
+
+        for row in rows:
+            stats["rows"] += 1
+            try:
+                ts = datetime.fromisoformat(row[ts_idx].strip())
+                kwh = float(row[val_idx]) * scale
+                uid = int(row[user_idx]) if user_idx is not None else int(user_id)
+            except (ValueError, IndexError):
+                stats["skipped"] += 1
+                continue
+            if not math.isfinite(kwh) or kwh < 0 or (allowed_users is not None and uid not in allowed_users):
+                stats["skipped"] += 1
+                continue
+
+            slot = (ts.day - 1) * SLOTS_PER_DAY + ts.hour * 4 + ts.minute // SLOT_MINUTES
+            pending.setdefault((uid, ts.year, ts.month), []).append((slot, kwh))
+            stats["stored"] += 1
+            stats["users"].add(uid)
+            d = ts.date()
+            if stats["first"] is None or d < stats["first"]:
+                stats["first"] = d
+            if stats["last"] is None or d > stats["last"]:
+                stats["last"] = d
+
+            buffered += 1
+            if buffered >= chunk_rows:
+                _flush(pending, meter_dir)
+                buffered = 0
+        _flush(pending, meter_dir)
+
+    stats["users"] = sorted(stats["users"])
+    for k in ("first", "last"):
+        stats[k] = stats[k].isoformat() if stats[k] else None
+    return stats
+
+
+def meter_days(user_id, start: date, end: date, on_hours=(), meter_dir=METER_DIR):
+    """รวมรายวันในช่วง [start, end) — คืนรายการ {date, kwh, kwh_on, kwh_off, slots} เฉพาะวันที่มีข้อมูล"""
+    on_slots = [h * 4 + q for h in sorted(set(on_hours)) for q in range(4)]
+    out = []
+    d = date(start.year, start.month, 1)
+    while d < end:
+        days_in_month = calendar.monthrange(d.year, d.month)[1]
+        opened = _open_month(meter_dir, user_id, d.year, d.month)
+        if opened is not None:
+            f, mm = opened
+            try:
+                values = array("f")
+                values.frombytes(mm[:])
+            finally:
+                mm.close()
+                f.close()
+            for day in range(1, days_in_month + 1):
+                cur = date(d.year, d.month, day)
+                if cur < start or cur >= end:
+                    continue
+                block = values[(day - 1) * SLOTS_PER_DAY: day * SLOTS_PER_DAY]
+                present = [v for v in block if v == v]  # NaN != NaN
+                if not present:
+                    continue
+                kwh = math.fsum(present)
+                kwh_on = math.fsum(v for v in (block[i] for i in on_slots) if v == v)
+                out.append({
+                    "date": cur.isoformat(),
+                    "kwh": round(kwh, 3),
+                    "kwh_on": round(kwh_on, 3),
+                    "kwh_off": round(kwh - kwh_on, 3),
+                    "slots": len(present),
+                })
+        d = date(d.year, d.month, days_in_month) + timedelta(days=1)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="นำเข้าค่าอ่าน smart meter (CSV ทุก 15 นาที)")
+    parser.add_argument("csv", help="ไฟล์ CSV: timestamp,kwh[,user_id]")
+    parser.add_argument("--user-id", type=int, help="ผู้ใช้ของไฟล์ (ถ้าไฟล์ไม่มีคอลัมน์ user_id)")
+    parser.add_argument("--meter-dir", default=METER_DIR)
+    args = parser.parse_args()
+    print(ingest_csv(args.csv, user_id=args.user_id, meter_dir=args.meter_dir))
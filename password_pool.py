@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# KDF (scrypt/pbkdf2) ตั้งใจให้ช้า — รันใน thread pool ที่จำกัดจำนวน
+# เพื่อไม่ให้ช่วงคนล็อกอินพร้อมกันแย่ง CPU จาก endpoint อื่นใน worker เดียวกัน
+PASSWORD_HASH_METHOD = os.environ.get("ENERGY_LIFE_PASSWORD_METHOD", "scrypt:32768:8:1")
+HASH_WORKERS = int(os.environ.get("ENERGY_LIFE_HASH_WORKERS", 2))
+HASH_QUEUE_DEPTH = int(os.environ.get("ENERGY_LIFE_HASH_QUEUE", 8))
+HASH_TIMEOUT = float(os.environ.get("ENERGY_LIFE_HASH_TIMEOUT", 10))
+HASH_LATENCY_WINDOW = 500
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_DEPTH)
+_canonical_method = None
+
+_metrics_lock = threading.Lock()
+_metrics = {"hash": 0, "verify": 0, "rehash": 0, "rejected": 0, "timeouts": 0, "in_flight": 0}
+_latencies = deque(maxlen=HASH_LATENCY_WINDOW)
+
+
+class PasswordPoolBusy(RuntimeError):
+    """คิว hash เต็ม — ผู้เรียกควรตอบ 429"""
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+    return _executor
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        with _metrics_lock:
+            _latencies.append(time.perf_counter() - t0)
+
+
+def _run(kind, fn, *args):
+    if not _slots.acquire(blocking=False):
+        with _metrics_lock:
+            _metrics["rejected"] += 1
+        raise PasswordPoolBusy("password hashing queue is full")
+    with _metrics_lock:
+        _metrics[kind] += 1
+        _metrics["in_flight"] += 1
+    try:
+        future = _get_executor().submit(_timed, fn, *args)
+    except BaseException:
+        _release_slot()
+        raise
+    # คืน slot เมื่อ hash เสร็จจริง (ไม่ใช่ตอนผู้เรียกเลิกรอ) — งานที่ timeout ยังกิน thread อยู่
+    future.add_done_callback(_release_slot)
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeout:
+        with _metrics_lock:
+            _metrics["timeouts"] += 1
+        raise PasswordPoolBusy("password hashing timed out")
+
+
+def _release_slot(_future=None):
+    with _metrics_lock:
+        _metrics["in_flight"] -= 1
+    _slots.release()
+
+
+def hash_password(password: str) -> str:
+    return _run("hash", generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    return _run("verify", check_password_hash, pwhash, password)
+
+
+def _method_prefix():
+    # werkzeug เติมค่า default ให้ method (เช่น "pbkdf2" -> "pbkdf2:sha256:600000")
+    # จึงใช้ prefix ของ hash จริงเป็นตัวเทียบ
+    global _canonical_method
+    if _canonical_method is None:
+        _canonical_method = generate_password_hash("", PASSWORD_HASH_METHOD).split("$", 1)[0]
+    return _canonical_method
+
+
+def needs_rehash(pwhash: str) -> bool:
+    return (pwhash or "").split("$", 1)[0] != _method_prefix()
+
+
+def rehash_password(password: str) -> str:
+    with _metrics_lock:
+        _metrics["rehash"] += 1
+    return hash_password(password)
+
+
+def hash_metrics() -> dict:
+    with _metrics_lock:
+        lat = sorted(_latencies)
+        out = dict(_metrics)
+    out["method"] = PASSWORD_HASH_METHOD
+    out["workers"] = HASH_WORKERS
+    out["queue_depth"] = HASH_QUEUE_DEPTH
+    out["samples"] = len(lat)
+    if lat:
+        out["latency_ms"] = {
+            "p50": round(lat[len(lat) // 2] * 1000, 1),
+            "p95": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000, 1),
+            "max": round(lat[-1] * 1000, 1),
+        }
+    return out
@@ -0,0 +1,236 @@
+import csv
+import gzip
+import io
+import os
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from idempotency import purge_expired_keys
+from login_audit import read_login_events
+
+# ============================================================
+# Retention: ย่อประวัติเก่าเป็นรายเดือน + เก็บแถวดิบลงไฟล์ .csv.gz + คืนพื้นที่ทีละน้อย
+# ============================================================
+RETENTION_DAYS = int(os.environ.get("ENERGY_LIFE_RETENTION_DAYS", 400))
+LOGIN_LOG_RETENTION_DAYS = int(os.environ.get("ENERGY_LIFE_LOGIN_LOG_RETENTION_DAYS", 180))
+ARCHIVE_DIR = os.environ.get("ENERGY_LIFE_ARCHIVE_DIR", "archive")
+USER_BATCH = 200
+VACUUM_STEP_PAGES = 256
+VACUUM_MAX_STEPS = 200
+VACUUM_PAUSE_SEC = 0.02
+
+ENERGY_ARCHIVE_FIELDS = ["date", "day", "kwh_total", "cost_thb", "kwh_on", "kwh_off", "kwh_solar_used", "kwh_ev",
+                         "notes_json", "created_at"]
+LOGIN_ARCHIVE_FIELDS = ["id", "user_id", "ip", "user_agent", "created_at"]
+
+RETENTION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS energy_monthly (
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    days INTEGER NOT NULL,
+    kwh_total REAL NOT NULL,
+    cost_thb REAL NOT NULL,
+    kwh_on REAL NOT NULL,
+    kwh_off REAL NOT NULL,
+    kwh_solar_used REAL NOT NULL,
+    kwh_ev REAL NOT NULL,
+    first_date TEXT NOT NULL,
+    last_date TEXT NOT NULL,
+    PRIMARY KEY (user_id, month),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS login_monthly (
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    logins INTEGER NOT NULL,
+    PRIMARY KEY (user_id, month),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+"""
+
+
+def month_cutoff(today: date, horizon_days: int) -> date:
+    """ตัดทีละเดือนเต็ม: วันที่ 1 ของเดือนที่ (today - horizon) ตกอยู่"""
+    d = today - timedelta(days=horizon_days)
+    return date(d.year, d.month, 1)
+
+
+def _energy_archive_path(archive_dir, user_id, month) -> Path:
+    return Path(archive_dir) / "energy_daily" / f"user_{int(user_id)}" / f"{month}.csv.gz"
+
+
+def _append_csv_gz(path: Path, fields, rows):
+    # gzip แบบ append = หลาย member ต่อกัน ซึ่ง gzip.open อ่านต่อเนื่องได้
+    path.parent.mkdir(parents=True, exist_ok=True)
+    new_file = not path.exists()
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    if new_file:
+        w.writerow(fields)
+    for r in rows:
+        w.writerow([r[f] for f in fields])
+    with gzip.open(path, "at", encoding="utf-8", newline="") as f:
+        f.write(buf.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_archived_energy(user_id, archive_dir=ARCHIVE_DIR, start=None, end=None):
+    """แถวรายวันที่ถูก archive แล้วของผู้ใช้ (เรียงตามวันที่) — ใช้กับ export"""
+    base = Path(archive_dir) / "energy_daily" / f"user_{int(user_id)}"
+    if not base.is_dir():
+        return []
+    by_date = {}
+    for path in sorted(base.glob("*.csv.gz")):
+        month = path.name[:7]
+        if start is not None and month < str(start)[:7]:
+            continue
+        if end is not None and month > str(end)[:7]:
+            continue
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            for r in csv.DictReader(f):
+                if start is not None and r["date"] < str(start):
+                    continue
+                if end is not None and r["date"] >= str(end):
+                    continue
+                # ถ้ารอบก่อนล้มหลังเขียนไฟล์แต่ก่อนลบแถว แถวเดียวกันอาจซ้ำ: ใช้วันที่เป็น key
+                by_date[r["date"]] = r
+    return [by_date[k] for k in sorted(by_date)]
+
+
+def roll_energy_daily(db, cutoff: date, archive_dir=ARCHIVE_DIR):
+    """ย้ายแถว energy_daily ที่ date < cutoff ไป archive + สรุปลง energy_monthly — คืนจำนวนแถวที่ย้าย"""
+    moved = 0
+    cutoff_s = cutoff.isoformat()
+    last_uid = -1
+    while True:
+        uids = [r[0] for r in db.execute(
+            "SELECT DISTINCT user_id FROM energy_daily WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (last_uid, USER_BATCH)
+        ).fetchall()]
+        if not uids:
+            break
+        for uid in uids:
+            last_uid = uid
+            rows = db.execute(f"""
+                SELECT {",".join(ENERGY_ARCHIVE_FIELDS)} FROM energy_daily
+                WHERE user_id=? AND date < ? ORDER BY date
+            """, (uid, cutoff_s)).fetchall()
+            if not rows:
+                continue
+
+            by_month = {}
+            for r in rows:
+                by_month.setdefault(r["date"][:7], []).append(r)
+
+            # 1) เขียนไฟล์ให้เสร็จก่อน 2) ค่อยสรุป+ลบในทรานแซกชันเดียว
+            for month, mrows in by_month.items():
+                _append_csv_gz(_energy_archive_path(archive_dir, uid, month), ENERGY_ARCHIVE_FIELDS, mrows)
+
+            with db:
+                for month, mrows in by_month.items():
+                    db.execute("""
+                        INSERT INTO energy_monthly(user_id,month,days,kwh_total,cost_thb,kwh_on,kwh_off,
+                                                   kwh_solar_used,kwh_ev,first_date,last_date)
+                        VALUES(?,?,?,?,?,?,?,?,?,?,?)
+                        ON CONFLICT(user_id,month) DO UPDATE SET
+                            days = days + excluded.days,
+                            kwh_total = kwh_total + excluded.kwh_total,
+                            cost_thb = cost_thb + excluded.cost_thb,
+                            kwh_on = kwh_on + excluded.kwh_on,
+                            kwh_off = kwh_off + excluded.kwh_off,
+                            kwh_solar_used = kwh_solar_used + excluded.kwh_solar_used,
+                            kwh_ev = kwh_ev + excluded.kwh_ev,
+                            first_date = MIN(first_date, excluded.first_date),
+                            last_date = MAX(last_date, excluded.last_date)
+                    """, (
+                        uid, month, len(mrows),
+                        sum(r["kwh_total"] for r in mrows), sum(r["cost_thb"] for r in mrows),
+                        sum(r["kwh_on"] for r in mrows), sum(r["kwh_off"] for r in mrows),
+                        sum(r["kwh_solar_used"] for r in mrows), sum(r["kwh_ev"] for r in mrows),
+                        mrows[0]["date"], mrows[-1]["date"],
+                    ))
+                db.execute("DELETE FROM energy_daily WHERE user_id=? AND date < ?", (uid, cutoff_s))
+            moved += len(rows)
+    return moved
+
+
+def roll_login_log(db, cutoff: date, archive_dir=ARCHIVE_DIR, batch=5000):
+    """ย้าย log การเข้าสู่ระบบ (login_events) ที่เก่ากว่า cutoff ไป archive + นับรายเดือนต่อผู้ใช้ลง login_monthly"""
+    moved = 0
+    cutoff_ts = int((datetime(cutoff.year, cutoff.month, cutoff.day) - datetime(1970, 1, 1)).total_seconds())
+    while True:
+        rows = read_login_events(db, cutoff_ts, batch)
+        if not rows:
+            break
+
+        by_month = {}
+        for r in rows:
+            by_month.setdefault(r["created_at"][:7], []).append(r)
+        for month, mrows in by_month.items():
+            _append_csv_gz(Path(archive_dir) / "login_log" / f"{month}.csv.gz", LOGIN_ARCHIVE_FIELDS, mrows)
+
+        with db:
+            counts = {}
+            for r in rows:
+                key = (r["user_id"], r["created_at"][:7])
+                counts[key] = counts.get(key, 0) + 1
+            db.executemany("""
+                INSERT INTO login_monthly(user_id,month,logins) VALUES(?,?,?)
+                ON CONFLICT(user_id,month) DO UPDATE SET logins = logins + excluded.logins
+            """, [(uid, month, n) for (uid, month), n in counts.items()])
+            db.execute("DELETE FROM login_events WHERE id <= ? AND ts < ?", (rows[-1]["id"], cutoff_ts))
+        moved += len(rows)
+    return moved
+
+
+def auto_vacuum_mode(db) -> int:
+    """0 = NONE, 1 = FULL, 2 = INCREMENTAL"""
+    return db.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def enable_incremental_vacuum(db):
+    """เปลี่ยนเป็น auto_vacuum=INCREMENTAL — ฐานข้อมูลเดิมต้อง VACUUM เต็ม (ล็อกทั้งไฟล์)
+
+    งานบำรุงรักษาครั้งเดียว สั่งเองตอนปิดระบบ (flask --app app enable-incremental-vacuum) ไม่เรียกจาก retention
+    """
+    if auto_vacuum_mode(db) == 2:
+        return False
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("VACUUM")
+    return True
+
+
+def incremental_vacuum(db, step_pages=VACUUM_STEP_PAGES, max_steps=VACUUM_MAX_STEPS, pause=VACUUM_PAUSE_SEC):
+    """คืนหน้าว่างทีละ step_pages เพื่อไม่ล็อกฐานข้อมูลนาน — คืนจำนวนหน้าที่คืนไป"""
+    freed = 0
+    for _ in range(max_steps):
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        if free <= 0:
+            break
+        db.execute(f"PRAGMA incremental_vacuum({int(step_pages)})").fetchall()
+        db.commit()
+        freed += min(free, step_pages)
+        time.sleep(pause)
+    return freed
+
+
+def run_retention(db, today=None, energy_days=RETENTION_DAYS, login_days=LOGIN_LOG_RETENTION_DAYS,
+                  archive_dir=ARCHIVE_DIR, vacuum=True):
+    today = today or datetime.utcnow().date()
+    db.executescript(RETENTION_SCHEMA)
+    out = {
+        "energy_cutoff": month_cutoff(today, energy_days).isoformat(),
+        "login_cutoff": month_cutoff(today, login_days).isoformat(),
+    }
+    out["energy_rows"] = roll_energy_daily(db, month_cutoff(today, energy_days), archive_dir)
+    out["login_rows"] = roll_login_log(db, month_cutoff(today, login_days), archive_dir)
+    out["idempotency_keys"] = purge_expired_keys(db)
+    if vacuum:
+        # ยังไม่ได้เปลี่ยนเป็น INCREMENTAL = ข้าม (PRAGMA incremental_vacuum ไม่มีผล) ไม่ VACUUM เต็มให้เอง
+        incremental = auto_vacuum_mode(db) == 2
+        out["incremental_vacuum"] = incremental
+        out["pages_freed"] = incremental_vacuum(db) if incremental else 0
+    return out
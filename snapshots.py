@@ -0,0 +1,83 @@
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+# ============================================================
+# Snapshots: สำเนาฐานข้อมูลแบบ online ด้วย SQLite backup API
+# ฐานข้อมูลหลักเป็น WAL: backup อ่านใน read transaction เดียว = สำเนาที่สอดคล้องกัน ณ จุดเดียว
+# โดยผู้เขียน (เช่น /api/simulate_day) ไม่ต้องรอ — ใช้เป็น backup และเป็นฐานข้อมูลอ่านอย่างเดียวของรายงาน
+# ============================================================
+SNAPSHOT_KEEP = int(os.environ.get("ENERGY_LIFE_SNAPSHOT_KEEP", 7))
+SNAPSHOT_EVERY_MINUTES = int(os.environ.get("ENERGY_LIFE_SNAPSHOT_EVERY", 0))  # 0 = ไม่สั่งเองจาก jobs-worker
+SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get("ENERGY_LIFE_SNAPSHOT_MAX_AGE", 6 * 3600))
+SNAPSHOT_PREFIX = "energy_life-"
+_SNAPSHOT_RE = re.compile(rf"^{SNAPSHOT_PREFIX}\d{{8}}T\d{{6}}Z\.db$")
+
+
+def list_snapshots(snapshot_dir):
+    """[{name, path, bytes, taken_at (unix)}] ใหม่สุดก่อน"""
+    try:
+        names = [n for n in os.listdir(snapshot_dir) if _SNAPSHOT_RE.match(n)]
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in sorted(names, reverse=True):
+        path = os.path.join(snapshot_dir, name)
+        st = os.stat(path)
+        out.append({"name": name, "path": path, "bytes": st.st_size, "taken_at": st.st_mtime})
+    return out
+
+
+def latest_snapshot(snapshot_dir, max_age=SNAPSHOT_MAX_AGE_SECONDS):
+    """snapshot ล่าสุดที่อายุไม่เกิน max_age วินาที หรือ None"""
+    snaps = list_snapshots(snapshot_dir)
+    if not snaps or time.time() - snaps[0]["taken_at"] > max_age:
+        return None
+    return snaps[0]
+
+
+def take_snapshot(db_path, snapshot_dir, keep=SNAPSHOT_KEEP):
+    """สำเนาฐานข้อมูลทั้งไฟล์ลง snapshot_dir แล้วลบของเก่าให้เหลือ keep ไฟล์"""
+    # สำเนาทั้งฐานข้อมูล (รวม password hash): โฟลเดอร์ 0700 ไฟล์ 0600 ไม่ขึ้นกับ umask
+    os.makedirs(snapshot_dir, mode=0o700, exist_ok=True)
+    os.chmod(snapshot_dir, 0o700)
+    t0 = time.perf_counter()
+    name = f"{SNAPSHOT_PREFIX}{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.db"
+    path = os.path.join(snapshot_dir, name)
+    tmp = path + ".tmp"
+    os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+    os.chmod(tmp, 0o600)
+
+    src = sqlite3.connect(db_path, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        # pages=-1: คัดลอกทั้งหมดใน read transaction เดียว (ทีละส่วน = เริ่มใหม่ทุกครั้งที่มีคนเขียน)
+        src.backup(dst)
+        # สำเนาเปิดแบบอ่านอย่างเดียวได้โดยไม่ต้องมีไฟล์ -wal/-shm
+        dst.execute("PRAGMA journal_mode=DELETE")
+        ok = dst.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+    finally:
+        dst.close()
+        src.close()
+    if not ok:
+        os.remove(tmp)
+        raise sqlite3.DatabaseError("snapshot ไม่ผ่าน quick_check")
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, path)
+
+    removed = []
+    for old in list_snapshots(snapshot_dir)[keep:]:
+        os.remove(old["path"])
+        removed.append(old["name"])
+    return {"snapshot": name, "bytes": os.path.getsize(path), "seconds": round(time.perf_counter() - t0, 3),
+            "removed": removed}
+
+
+def open_snapshot(path):
+    """connection อ่านอย่างเดียว (เขียนไม่ได้แม้เผลอเรียก)"""
+    db = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA query_only = ON")
+    return db
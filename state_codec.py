@@ -0,0 +1,197 @@
+import argparse
+import json
+import sqlite3
+import zlib
+
+try:
+    import msgpack  # optional: pip install msgpack
+except ImportError:
+    msgpack = None
+
+# รูปแบบไบนารีของ user_state.profile_json / state_json
+#   MAGIC(2) + version(1) + flags(1) + body
+#   flags: bit0 = zlib, bit1 = msgpack (ถ้าไม่ตั้ง = JSON แบบ compact)
+# แถวเก่าที่เป็น JSON TEXT ยังอ่านได้ตามเดิม (decode_blob แยกให้อัตโนมัติ)
+MAGIC = b"EL"
+FLAG_ZLIB = 0x01
+FLAG_MSGPACK = 0x02
+ZLIB_MIN_BYTES = 256
+ZLIB_LEVEL = 6
+
+# ค่าที่ละไว้ (elided) จะเติมกลับจาก snapshot ของ version ที่เขียนแถวนั้น
+# ถ้า APPLIANCES_CATALOG เปลี่ยน default ให้เพิ่ม version ใหม่ ห้ามแก้ snapshot เดิม
+ELIDED_MARK = "~d"
+APPLIANCE_DEFAULTS_BY_VERSION = {
+    1: {
+        "ac": {"enabled": True, "btu": 12000, "set_temp": 26, "hours": 6, "inverter": True, "start_hour": 20, "end_hour": 2},
+        "lights": {"enabled": True, "mode": "LED", "watts": 30, "hours": 5},
+        "tv": {"enabled": True, "watts": 120, "hours": 3},
+        "fridge": {"enabled": True, "size_band": "10_14", "qty": 1, "open_times": 20},
+        "water_heater": {"enabled": False, "watts": 3500, "hours": 0.3},
+        "washer": {"enabled": False, "watts": 500, "hours": 0.5},
+        "microwave": {"enabled": False, "watts": 1200, "hours": 0.1},
+        "computer": {"enabled": False, "watts": 200, "hours": 2},
+        "standby": {"enabled": True, "watts": 20, "hours": 24},
+        "ev_charger": {"enabled": True, "battery_kwh": 60.0, "charger_kw": 7.4, "efficiency": 0.9, "soc_from": 30,
+                       "soc_to": 80, "charges_per_week": 2, "start_hour": 22, "end_hour": 2, "hours": 2.0},
+    },
+}
+CODEC_VERSION = max(APPLIANCE_DEFAULTS_BY_VERSION)
+
+
+class StateCodecError(ValueError):
+    pass
+
+
+def _same(a, b) -> bool:
+    # 6 กับ 6.0 ถือว่าไม่เท่ากัน เพื่อให้ถอดกลับได้ตรงชนิดเดิม
+    return type(a) is type(b) and a == b
+
+
+def _elide_cfg(key, cfg, defaults):
+    d = defaults.get(key)
+    if not d or not isinstance(cfg, dict) or ELIDED_MARK in cfg:
+        return cfg
+    # ละได้เฉพาะเมื่อมีครบทุกฟิลด์ของ default (dict ว่าง = ยังไม่ตั้งค่า ต้องคงไว้ตามเดิม)
+    if any(k not in cfg for k in d):
+        return cfg
+    out = {k: v for k, v in cfg.items() if not (k in d and _same(v, d[k]))}
+    out[ELIDED_MARK] = 1
+    return out
+
+
+def _hydrate_cfg(key, cfg, defaults):
+    if not isinstance(cfg, dict) or ELIDED_MARK not in cfg:
+        return cfg
+    d = defaults.get(key)
+    if d is None:
+        raise StateCodecError(f"ไม่มีค่า default ของอุปกรณ์ {key!r}")
+    out = dict(d)
+    out.update(cfg)
+    del out[ELIDED_MARK]
+    return out
+
+
+def _map_appliances(obj, fn, defaults):
+    if not isinstance(obj, dict):
+        return obj
+    out = dict(obj)
+    appl = out.get("appliances")
+    if isinstance(appl, dict):
+        out["appliances"] = {k: fn(k, v, defaults) for k, v in appl.items()}
+    rooms = out.get("rooms")
+    if isinstance(rooms, dict):
+        new_rooms = {}
+        for rid, room in rooms.items():
+            if isinstance(room, dict) and isinstance(room.get("appliances"), dict):
+                room = dict(room)
+                room["appliances"] = {k: fn(k, v, defaults) for k, v in room["appliances"].items()}
+            new_rooms[rid] = room
+        out["rooms"] = new_rooms
+    return out
+
+
+def encode_blob(obj, use_msgpack=None, compress=True) -> bytes:
+    defaults = APPLIANCE_DEFAULTS_BY_VERSION[CODEC_VERSION]
+    body = _map_appliances(obj, _elide_cfg, defaults)
+
+    flags = 0
+    if use_msgpack is None:
+        use_msgpack = msgpack is not None
+    if use_msgpack:
+        if msgpack is None:
+            raise StateCodecError("ต้องติดตั้ง msgpack ก่อน")
+        raw = msgpack.packb(body, use_bin_type=True)
+        flags |= FLAG_MSGPACK
+    else:
+        raw = json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    if compress and len(raw) >= ZLIB_MIN_BYTES:
+        z = zlib.compress(raw, ZLIB_LEVEL)
+        if len(z) < len(raw):
+            raw = z
+            flags |= FLAG_ZLIB
+
+    return MAGIC + bytes((CODEC_VERSION, flags)) + raw
+
+
+def is_encoded(value) -> bool:
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:2]) == MAGIC
+
+
+def decode_blob(value):
+    """อ่านได้ทั้งแบบไบนารี (encode_blob) และ JSON TEXT แบบเดิม"""
+    if value is None:
+        return None
+    if not is_encoded(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value).decode("utf-8")
+        return json.loads(value)
+
+    value = bytes(value)
+    if len(value) < 4:
+        raise StateCodecError("blob สั้นเกินไป")
+    version, flags = value[2], value[3]
+    defaults = APPLIANCE_DEFAULTS_BY_VERSION.get(version)
+    if defaults is None:
+        raise StateCodecError(f"ไม่รู้จัก state codec version {version}")
+
+    raw = value[4:]
+    if flags & FLAG_ZLIB:
+        raw = zlib.decompress(raw)
+    if flags & FLAG_MSGPACK:
+        if msgpack is None:
+            raise StateCodecError("แถวนี้เขียนด้วย msgpack แต่ไม่ได้ติดตั้ง msgpack")
+        body = msgpack.unpackb(raw, raw=False)
+    else:
+        body = json.loads(raw.decode("utf-8"))
+    return _map_appliances(body, _hydrate_cfg, defaults)
+
+
+def convert_user_state(db_path, to="compact", batch_size=500, use_msgpack=None):
+    """แปลงทุกแถวใน user_state ไปเป็นรูปแบบที่ต้องการ (compact | json) — คืนค่า (แปลง, ข้าม)"""
+    conn = sqlite3.connect(db_path)
+    converted = skipped = 0
+    last_id = -1
+    try:
+        while True:
+            rows = conn.execute(
+                "SELECT user_id, profile_json, state_json FROM user_state WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for user_id, profile_raw, state_raw in rows:
+                last_id = user_id
+                want_encoded = to == "compact"
+                if is_encoded(profile_raw) == want_encoded and is_encoded(state_raw) == want_encoded:
+                    skipped += 1
+                    continue
+                profile, state = decode_blob(profile_raw), decode_blob(state_raw)
+                if want_encoded:
+                    updates.append((encode_blob(profile, use_msgpack), encode_blob(state, use_msgpack), user_id))
+                else:
+                    updates.append((json.dumps(profile), json.dumps(state), user_id))
+            conn.executemany("UPDATE user_state SET profile_json=?, state_json=? WHERE user_id=?", updates)
+            conn.commit()
+            converted += len(updates)
+    finally:
+        conn.close()
+    return converted, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="แปลง user_state ระหว่าง JSON เดิมกับรูปแบบ compact")
+    parser.add_argument("db", help="path ของ energy_life.db")
+    parser.add_argument("--to", choices=("compact", "json"), default="compact")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM หลังแปลงเพื่อคืนพื้นที่ไฟล์")
+    args = parser.parse_args()
+
+    n, skip = convert_user_state(args.db, to=args.to, batch_size=args.batch_size)
+    print(f"converted={n} skipped={skip}")
+    if args.vacuum:
+        conn = sqlite3.connect(args.db)
+        conn.execute("VACUUM")
+        conn.close()
@@ -104,28 +104,98 @@ async function apiGetState() {
   return res.json();
 }
 
+/**
+ * ✅ POST ที่ห้ามทำซ้ำ: ส่ง Idempotency-Key เดียวกันทุกครั้งที่ retry
+ * (เน็ตหลุดแล้วส่งใหม่ = server ตอบผลเดิม ไม่จำลองวัน/ไม่ให้แต้มซ้ำ)
+ */
+function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+async function idempotentFetch(url, options, retries = 2) {
+  const key = newIdempotencyKey();
+  const opts = { ...options, headers: { ...(options.headers || {}), "Idempotency-Key": key } };
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const res = await fetch(url, opts);
+      // 409 = คำขอเดิมยังทำอยู่ที่ server รอแล้วถามใหม่ด้วยคีย์เดิม
+      if (res.status === 409 && attempt < retries) {
+        await new Promise((r) => setTimeout(r, 1000));
+        continue;
+      }
+      return res;
+    } catch (err) {
+      if (attempt >= retries) throw err;
+      await new Promise((r) => setTimeout(r, 500 * (attempt + 1)));
+    }
+  }
+}
+
+// กดซ้ำระหว่างที่คำขอเดิมยังไม่กลับมา = ใช้ผลของคำขอเดิม
+const pendingRequests = new Map();
+
+function coalesce(name, fn) {
+  if (pendingRequests.has(name)) return pendingRequests.get(name);
+  const p = fn().finally(() => pendingRequests.delete(name));
+  pendingRequests.set(name, p);
+  return p;
+}
+
 async function apiSaveState(payload) {
+  const body = JSON.stringify(payload);
+  return coalesce(`save:${body}`, async () => {
+    const res = await idempotentFetch("/api/state", {
+      method: "POST",
+      credentials: "same-origin",
+      headers: { "Content-Type": "application/json" },
+      body,
+    });
+    if (!res.ok) throw new Error("บันทึกไม่สำเร็จ");
+    return res.json();
+  });
+}
+
+/**
+ * ✅ แก้ไขบางฟิลด์ (JSON Patch) เช่น slider อุณหภูมิแอร์
+ * ops: [{ op: "replace", path: "/rooms/bedroom_1/appliances/ac/set_temp", value: 25 }]
+ * คืนค่า: { result, delta, compare, compare_delta, rooms }
+ */
+async function apiPatchState(ops) {
   const res = await fetch("/api/state", {
-    method: "POST",
+    method: "PATCH",
     credentials: "same-origin",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(payload),
+    headers: { "Content-Type": "application/json-patch+json" },
+    body: JSON.stringify(ops),
   });
   if (!res.ok) throw new Error("บันทึกไม่สำเร็จ");
   return res.json();
 }
 
-async function apiSimulateDay() {
-  const res = await fetch("/api/simulate_day", {
+async function apiScenarios(scenarios, base) {
+  const res = await fetch("/api/scenarios", {
     method: "POST",
     credentials: "same-origin",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({}),
+    body: JSON.stringify({ scenarios, base }),
   });
-  if (!res.ok) throw new Error("จำลองไม่สำเร็จ");
+  if (!res.ok) throw new Error("คำนวณ scenario ไม่สำเร็จ");
   return res.json();
 }
 
+async function apiSimulateDay() {
+  return coalesce("simulate_day", async () => {
+    const res = await idempotentFetch("/api/simulate_day", {
+      method: "POST",
+      credentials: "same-origin",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({}),
+    });
+    if (!res.ok) throw new Error("จำลองไม่สำเร็จ");
+    return res.json();
+  });
+}
+
 function renderResultBox(result) {
   const box = $("resultBox");
   if (!box) return;
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from pathlib import Path
+
+from flask import Response, abort, current_app, request, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+# ไฟล์ static ที่ถูก fingerprint + บีบอัดไว้ล่วงหน้าตอนเริ่มแอป
+# URL: /assets/<stem>.<hash><ext>  เช่น /assets/style.3f2a9c1b0d.css
+ASSET_URL_PREFIX = "/assets"
+ASSET_HASH_LEN = 10
+ASSET_MAX_AGE = 31536000  # 1 ปี (immutable: เนื้อหาเปลี่ยน = URL เปลี่ยน)
+ASSET_STALE_MAX_AGE = 60  # hash เก่า (ระหว่าง deploy) ส่งไฟล์ปัจจุบันแต่ไม่ cache นาน
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS_BYTES = 512
+
+_HASHED_NAME_RE = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$" % ASSET_HASH_LEN)
+
+_manifest = {}      # "style.css" -> asset dict
+_by_hashed = {}     # "style.3f2a9c1b0d.css" -> "style.css"
+_static_dir = None
+
+
+def _hashed_name(rel: str, digest: str) -> str:
+    p = Path(rel)
+    return str(p.with_name(f"{p.stem}.{digest}{p.suffix}")).replace(os.sep, "/")
+
+
+def _build_asset(path: Path, rel: str) -> dict:
+    data = path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()[:ASSET_HASH_LEN]
+    mimetype = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+
+    variants = {"identity": data}
+    if len(data) >= MIN_COMPRESS_BYTES and mimetype.startswith(COMPRESSIBLE_TYPES):
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gz) < len(data):
+            variants["gzip"] = gz
+        if brotli is not None:
+            br = brotli.compress(data, quality=11)
+            if len(br) < len(data):
+                variants["br"] = br
+
+    return {
+        "rel": rel,
+        "hash": digest,
+        "hashed": _hashed_name(rel, digest),
+        "mtime": path.stat().st_mtime,
+        "mimetype": mimetype,
+        "variants": variants,
+    }
+
+
+def build_asset_manifest(static_dir) -> dict:
+    """อ่านทุกไฟล์ใน static/ คำนวณ hash และเตรียม gzip/brotli ไว้ในหน่วยความจำ"""
+    global _static_dir
+    _static_dir = Path(static_dir)
+    _manifest.clear()
+    _by_hashed.clear()
+    if not _static_dir.is_dir():
+        return _manifest
+    for path in sorted(_static_dir.rglob("*")):
+        if not path.is_file() or path.name.startswith("."):
+            continue
+        rel = path.relative_to(_static_dir).as_posix()
+        asset = _build_asset(path, rel)
+        _manifest[rel] = asset
+        _by_hashed[asset["hashed"]] = rel
+    return _manifest
+
+
+def _static_path(rel: str):
+    """path ของไฟล์ใน static/ เท่านั้น — ชื่อที่มาจาก URL (../, %2e%2e/, symlink ออกนอก) = None"""
+    if _static_dir is None:
+        return None
+    joined = safe_join(str(_static_dir), rel)
+    if joined is None:
+        return None
+    path = Path(joined)
+    root = _static_dir.resolve()
+    resolved = path.resolve()
+    if resolved != root and root not in resolved.parents:
+        return None
+    if any(part.startswith(".") for part in path.relative_to(_static_dir).parts):
+        return None
+    return path
+
+
+def _lookup(rel: str):
+    # โหมด debug: แก้ไฟล์แล้วได้ URL ใหม่ทันทีโดยไม่ต้องรีสตาร์ท
+    asset = _manifest.get(rel)
+    if not current_app.debug:
+        return asset
+    path = _static_path(rel)
+    if path is None or not path.is_file():
+        return asset
+    if asset is None or path.stat().st_mtime != asset["mtime"]:
+        if asset is not None:
+            _by_hashed.pop(asset["hashed"], None)
+        asset = _build_asset(path, rel)
+        _manifest[rel] = asset
+        _by_hashed[asset["hashed"]] = rel
+    return asset
+
+
+def asset_url(filename: str) -> str:
+    """ใช้ใน template แทน url_for('static', filename=...)"""
+    asset = _lookup(filename)
+    if asset is None:
+        return url_for("static", filename=filename)
+    return url_for("static_asset", filename=asset["hashed"])
+
+
+def _pick_encoding(asset: dict) -> str:
+    accepted = request.accept_encodings
+    for enc in ("br", "gzip"):
+        if enc in asset["variants"] and accepted[enc]:
+            return enc
+    return "identity"
+
+
+def serve_asset(filename: str):
+    rel = _by_hashed.get(filename)
+    stale = False
+    if rel is None:
+        # hash เก่า/ไม่ตรง: ส่งไฟล์ปัจจุบันแบบ cache สั้น เพื่อไม่ให้หน้าเว็บพังระหว่าง deploy
+        m = _HASHED_NAME_RE.match(filename)
+        if not m:
+            abort(404)
+        rel = f"{m.group('stem')}{m.group('ext')}"
+        stale = True
+    asset = _lookup(rel)
+    if asset is None:
+        abort(404)
+
+    encoding = _pick_encoding(asset)
+    etag = asset["hash"] if encoding == "identity" else f"{asset['hash']}-{encoding}"
+    headers = {"Vary": "Accept-Encoding", "ETag": f'"{etag}"'}
+    if stale:
+        headers["Cache-Control"] = f"public, max-age={ASSET_STALE_MAX_AGE}"
+    else:
+        headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset["variants"][encoding], mimetype=asset["mimetype"], headers=headers)
+
+
+def init_static_assets(app):
+    build_asset_manifest(app.static_folder)
+    app.add_url_rule(f"{ASSET_URL_PREFIX}/<path:filename>", "static_asset", serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
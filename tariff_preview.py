@@ -0,0 +1,165 @@
+import math
+from array import array
+from datetime import datetime
+
+# ============================================================
+# Tariff preview: ผลกระทบของอัตราค่าไฟชุดใหม่ต่อทุกบ้าน ก่อนกดบันทึก
+# kWh/เดือนของแต่ละบ้านไม่ขึ้นกับอัตรา (ขึ้นกับช่วง On-Peak เท่านั้น) จึงเก็บ cache ต่อ (บ้าน, ช่วง On-Peak)
+# แล้วคิดบิลใหม่ทั้งก้อนจากตัวเลขในตารางนี้ ไม่ต้องจำลองบ้านซ้ำ
+# ============================================================
+# เพิ่มเมื่อสูตรใน compute_daily_energy() เปลี่ยน เพื่อให้ cache เดิมหมดอายุทั้งหมด
+USAGE_CACHE_VERSION = 1
+
+PREVIEW_SCHEMA = """
+CREATE TABLE IF NOT EXISTS household_usage (
+    user_id INTEGER NOT NULL,
+    peak TEXT NOT NULL,
+    state_version TEXT NOT NULL,
+    tariff_mode TEXT NOT NULL,
+    kwh_month REAL NOT NULL,
+    kwh_on_month REAL NOT NULL,
+    kwh_off_month REAL NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, peak),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+"""
+
+# ขอบของช่วงการเปลี่ยนแปลงบิล (บาท/เดือน) สำหรับ histogram
+CHANGE_BUCKETS = (-200.0, -100.0, -50.0, -20.0, -5.0, 5.0, 20.0, 50.0, 100.0, 200.0)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# ลำดับเดียวกับ tuple ที่ tariff_rates() คืน
+_RATE_FIELDS = (
+    ("non_tou_tier1_kwh", 150), ("non_tou_tier2_kwh", 400),
+    ("non_tou_rate1", 3.2484), ("non_tou_rate2", 4.2218), ("non_tou_rate3", 4.4217),
+    ("non_tou_service_fee", 24.62),
+    ("tou_on_rate_real", 5.7982), ("tou_off_rate_real", 2.6369), ("tou_service_fee", 24.62),
+    ("ft_rate", 0.0), ("vat_rate", 0.07),
+)
+
+
+def peak_key(settings) -> str:
+    return f"{_num(settings, 'on_peak_start', 9, int)}-{_num(settings, 'on_peak_end', 22, int)}"
+
+
+def usage_version(updated_at, model_version, month) -> str:
+    """ทุกการเขียน user_state อัปเดต updated_at — ใช้เป็นเวอร์ชันโดยไม่ต้องอ่าน blob
+
+    month = เดือนของการจำลอง: ตัวคูณความร้อนของแอร์ขึ้นกับเดือน ขึ้นเดือนใหม่ต้องคำนวณใหม่ทุกบ้าน
+    """
+    return f"{updated_at}|{model_version or 0}|{month}|{USAGE_CACHE_VERSION}"
+
+
+def _num(settings, key, default, cast=float):
+    try:
+        return cast(float(settings.get(key, default)))
+    except (TypeError, ValueError):
+        return cast(default)
+
+
+def tariff_rates(settings) -> tuple:
+    """แปลง settings เป็นตัวเลขครั้งเดียว (bill_non_tou_month/bill_tou_month แปลงใหม่ทุกครั้งที่เรียก)"""
+    vals = [_num(settings, k, d) for k, d in _RATE_FIELDS]
+    vals[0], vals[1] = int(vals[0]), int(vals[1])
+    vals[9] /= 100.0  # Ft สตางค์ -> บาท
+    return tuple(vals)
+
+
+def bill_pair(rates, kwh, kwh_on, kwh_off):
+    """คืน (Non-TOU, TOU) บาท/เดือน — สูตรเดียวกับ bill_non_tou_month()/bill_tou_month() ใน app.py"""
+    tier1, tier2, r1, r2, r3, nt_fee, on_rate, off_rate, t_fee, ft, vat = rates
+    kwh = max(0.0, kwh)
+    a1 = min(kwh, max(0, tier1))
+    a2 = min(max(0.0, kwh - a1), max(0, tier2 - tier1))
+    a3 = max(0.0, kwh - a1 - a2)
+    nt = (a1 * r1 + a2 * r2 + a3 * r3 + kwh * ft) * (1.0 + vat) + nt_fee
+
+    on, off = max(0.0, kwh_on), max(0.0, kwh_off)
+    t = (on * on_rate + off * off_rate + (on + off) * ft) * (1.0 + vat) + t_fee
+    return nt, t
+
+
+def _percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    pos = (len(sorted_vals) - 1) * p / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (pos - lo)
+
+
+def summarize_changes(pairs, old_settings, new_settings):
+    """pairs: [(tariff_mode, (kwh, on, off) ตามช่วงเดิม, (kwh, on, off) ตามช่วงใหม่)]
+
+    การเปลี่ยนแปลงคิดจากโหมดที่บ้านนั้นใช้อยู่ / flip = คำแนะนำ TOU หรือ Non-TOU กลับด้าน
+    """
+    old_r, new_r = tariff_rates(old_settings), tariff_rates(new_settings)
+    deltas = array("d")
+    total_old = total_new = 0.0
+    flips = {"to_tou": 0, "to_non_tou": 0}
+    for mode, old_kwh, new_kwh in pairs:
+        nt0, t0 = bill_pair(old_r, *old_kwh)
+        nt1, t1 = bill_pair(new_r, *new_kwh)
+        b0, b1 = (t0, t1) if mode == "tou" else (nt0, nt1)
+        deltas.append(b1 - b0)
+        total_old += b0
+        total_new += b1
+        if (t0 < nt0) != (t1 < nt1):
+            flips["to_tou" if t1 < nt1 else "to_non_tou"] += 1
+
+    n = len(deltas)
+    ordered = sorted(deltas)
+    counts = [0] * (len(CHANGE_BUCKETS) + 1)
+    edges = (-math.inf,) + CHANGE_BUCKETS + (math.inf,)
+    i = 0
+    for v in ordered:
+        while v >= edges[i + 1]:
+            i += 1
+        counts[i] += 1
+    return {
+        "households": n,
+        "increase": sum(1 for v in deltas if v > 0.005),
+        "decrease": sum(1 for v in deltas if v < -0.005),
+        "mean_change": round(math.fsum(deltas) / n, 2) if n else 0.0,
+        "percentiles": {f"p{p}": round(_percentile(ordered, p), 2) for p in PERCENTILES},
+        "min_change": round(ordered[0], 2) if n else 0.0,
+        "max_change": round(ordered[-1], 2) if n else 0.0,
+        "total_month_before": round(total_old, 2),
+        "total_month_after": round(total_new, 2),
+        "histogram": [
+            {"from": None if math.isinf(lo) else lo, "to": None if math.isinf(hi) else hi, "count": c}
+            for lo, hi, c in zip(edges, edges[1:], counts)
+        ],
+        "recommend_flips": flips,
+    }
+
+
+def stratified_sample(usage: dict, size: int) -> list:
+    """เลือก user_id แบบแบ่งชั้นตาม (โหมดค่าไฟ, ช่วง kWh/เดือน) สัดส่วนตามขนาดชั้น — ผลเหมือนเดิมทุกครั้ง"""
+    if size >= len(usage):
+        return sorted(usage)
+    strata = {}
+    for uid, (mode, kwh, _, _) in usage.items():
+        band = 0 if kwh < 150 else 1 if kwh < 400 else 2 if kwh < 800 else 3
+        strata.setdefault((mode, band), []).append(uid)
+    picked = []
+    for uids in strata.values():
+        take = max(1, round(size * len(uids) / len(usage)))
+        # กระจายตาม user_id (ไม่ใช่แค่ id ต้นๆ ซึ่งเป็นบ้านเก่าทั้งหมด)
+        uids.sort(key=lambda u: (u * 2654435761) & 0xFFFFFFFF)
+        picked.extend(uids[:take])
+    return sorted(picked)
+
+
+def save_usage_rows(db, peak, rows):
+    """rows: [(user_id, state_version, tariff_mode, kwh, on, off)] (ไม่ commit)"""
+    now = datetime.utcnow().isoformat()
+    db.executemany("""
+        INSERT INTO household_usage(user_id,peak,state_version,tariff_mode,kwh_month,kwh_on_month,kwh_off_month,updated_at)
+        VALUES(?,?,?,?,?,?,?,?)
+        ON CONFLICT(user_id,peak) DO UPDATE SET
+            state_version=excluded.state_version, tariff_mode=excluded.tariff_mode,
+            kwh_month=excluded.kwh_month, kwh_on_month=excluded.kwh_on_month,
+            kwh_off_month=excluded.kwh_off_month, updated_at=excluded.updated_at
+    """, [(uid, peak, ver, mode, kwh, on, off, now) for uid, ver, mode, kwh, on, off in rows])
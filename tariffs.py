@@ -0,0 +1,65 @@
+import bisect
+import json
+from datetime import datetime
+
+# ============================================================
+# Tariff history: อัตราค่าไฟทั้งชุดเป็นเวอร์ชัน พร้อมวันที่เริ่มใช้
+# บิลของวัน D ใช้เวอร์ชันล่าสุดที่ effective_from <= D (วันเดียวกันหลายเวอร์ชัน = id ใหม่สุดชนะ)
+# ============================================================
+TARIFF_EPOCH = "1970-01-01"  # เวอร์ชันแรกที่ย้ายมาจากตาราง settings ใช้ย้อนหลังได้ทุกวัน
+
+TARIFF_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tariff_versions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    effective_from TEXT NOT NULL,
+    tariff_json TEXT NOT NULL,
+    created_by INTEGER,
+    created_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_tariff_versions_effective ON tariff_versions(effective_from, id);
+"""
+
+
+def load_tariff_versions(db):
+    """คืน (effective_from ที่เรียงแล้ว, snapshot ตามลำดับเดียวกัน) สำหรับ tariff_at()"""
+    dates, snapshots = [], []
+    for eff, raw in db.execute("SELECT effective_from, tariff_json FROM tariff_versions ORDER BY effective_from, id"):
+        if dates and dates[-1] == eff:
+            snapshots[-1] = json.loads(raw)
+            continue
+        dates.append(eff)
+        snapshots.append(json.loads(raw))
+    return dates, snapshots
+
+
+def tariff_at(dates, snapshots, day):
+    """snapshot ที่มีผลในวัน day (date หรือ 'YYYY-MM-DD') — ก่อนเวอร์ชันแรกใช้เวอร์ชันแรก"""
+    if not snapshots:
+        return None
+    key = day if isinstance(day, str) else day.isoformat()
+    return snapshots[max(0, bisect.bisect_right(dates, key) - 1)]
+
+
+def tariff_boundaries(dates, start, end):
+    """วันที่ใน (start, end) ที่อัตราเปลี่ยน — ใช้ตัดช่วงวันที่ให้แต่ละช่วงใช้อัตราเดียว"""
+    lo, hi = start.isoformat(), end.isoformat()
+    return [d for d in dates if lo < d < hi]
+
+
+def save_tariff_version(db, snapshot, effective_from, created_by=None):
+    datetime.strptime(effective_from, "%Y-%m-%d")
+    cur = db.execute("""
+        INSERT INTO tariff_versions(effective_from,tariff_json,created_by,created_at)
+        VALUES(?,?,?,?)
+    """, (effective_from, json.dumps(snapshot, ensure_ascii=False), created_by, datetime.utcnow().isoformat()))
+    db.commit()
+    return cur.lastrowid
+
+
+def list_tariff_versions(db, limit=20):
+    return db.execute("""
+        SELECT t.id, t.effective_from, t.tariff_json, t.created_at, u.username AS created_by
+        FROM tariff_versions t LEFT JOIN users u ON u.id = t.created_by
+        ORDER BY t.effective_from DESC, t.id DESC LIMIT ?
+    """, (int(limit),)).fetchall()
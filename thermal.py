@@ -0,0 +1,80 @@
+import math
+from functools import lru_cache
+
+# ============================================================
+# Thermal AC: น้ำหนักรายชั่วโมงของการใช้ไฟแอร์ตามอุณหภูมิภายนอก
+# ============================================================
+# ค่าเฉลี่ยต่ำสุด/สูงสุดรายวันของแต่ละเดือน (°C, ประมาณจากค่าปกติภูมิอากาศ)
+# ตัวแทนภาค: กลาง=กรุงเทพฯ เหนือ=เชียงใหม่ อีสาน=ขอนแก่น ใต้=หาดใหญ่
+REGION_MONTHLY_MIN_MAX = {
+    "central": [(22.6, 32.5), (24.6, 33.3), (26.2, 34.3), (27.3, 35.4), (26.8, 34.4), (26.4, 33.6),
+                (26.0, 33.2), (25.8, 33.0), (25.3, 32.6), (24.9, 32.4), (23.9, 32.2), (22.1, 31.8)],
+    "north": [(14.6, 29.4), (15.9, 32.3), (19.2, 34.9), (22.6, 36.4), (23.7, 34.0), (23.9, 32.1),
+              (23.7, 31.3), (23.5, 30.8), (23.0, 31.3), (21.6, 31.0), (18.7, 30.0), (15.3, 28.6)],
+    "northeast": [(17.5, 30.7), (20.3, 33.0), (23.0, 35.0), (24.9, 35.8), (25.0, 34.3), (25.0, 33.3),
+                  (24.7, 32.6), (24.4, 31.9), (24.0, 31.7), (22.8, 31.3), (20.2, 30.6), (17.4, 29.8)],
+    "south": [(23.3, 31.3), (23.1, 33.1), (23.5, 34.6), (24.2, 35.1), (24.4, 34.0), (24.2, 33.5),
+              (23.9, 33.2), (23.9, 33.1), (23.6, 32.8), (23.5, 32.1), (23.4, 30.6), (23.3, 30.2)],
+}
+REGIONS = tuple(REGION_MONTHLY_MIN_MAX)
+DEFAULT_REGION = "central"
+
+# รูปทรงรายวัน: ต่ำสุดตอน 06:00 สูงสุดตอน 15:00
+T_MIN_HOUR = 6
+T_MAX_HOUR = 15
+
+# โมเดลห้อง (หน่วยเป็นสัดส่วนของขนาดแอร์): ภาระ = ความร้อนภายใน + UA × (T นอก - T ตั้ง)
+INTERNAL_LOAD = 0.45
+ENVELOPE_UA = 0.055
+MIN_PART_LOAD = 0.2
+# COP ลดลงเมื่อข้างนอกร้อน (เทียบกับที่ 35°C)
+COP_DROP_PER_K = 0.025
+COP_REF_OUT = 35.0
+# อุณหภูมิภายนอกที่ calc_ac_kwh() เดิม (ไม่ขึ้นกับเวลา) ถือว่าเป็นค่าเฉลี่ย: น้ำหนัก = 1
+T_REF_OUT = 30.0
+
+
+def _diurnal_shape(hour):
+    """0 ที่อุณหภูมิต่ำสุด, 1 ที่สูงสุด"""
+    if T_MIN_HOUR <= hour <= T_MAX_HOUR:
+        return 0.5 - 0.5 * math.cos(math.pi * (hour - T_MIN_HOUR) / (T_MAX_HOUR - T_MIN_HOUR))
+    since_max = (hour - T_MAX_HOUR) % 24
+    return 0.5 + 0.5 * math.cos(math.pi * since_max / (24 - (T_MAX_HOUR - T_MIN_HOUR)))
+
+
+_SHAPE = tuple(_diurnal_shape(h) for h in range(24))
+
+
+@lru_cache(maxsize=64)
+def outdoor_profile(region, month):
+    """อุณหภูมิภายนอก 24 ชั่วโมงของเดือนนั้น"""
+    t_min, t_max = REGION_MONTHLY_MIN_MAX.get(region, REGION_MONTHLY_MIN_MAX[DEFAULT_REGION])[int(month) - 1]
+    return tuple(t_min + (t_max - t_min) * s for s in _SHAPE)
+
+
+def _electric_rel(t_out, t_set):
+    load = INTERNAL_LOAD + ENVELOPE_UA * max(0.0, t_out - t_set)
+    load = min(1.0, max(MIN_PART_LOAD, load))
+    cop = max(0.5, 1.0 - COP_DROP_PER_K * (t_out - COP_REF_OUT))
+    return load / cop
+
+
+@lru_cache(maxsize=4096)
+def ac_hour_weights(region, month, set_temp, hours):
+    """น้ำหนักต่อชั่วโมงของช่วงที่เปิดแอร์ (tuple ของชั่วโมง) — ค่าเฉลี่ย 1 = เท่ากับโมเดลเดิม"""
+    profile = outdoor_profile(region, month)
+    ref = _electric_rel(T_REF_OUT, set_temp)
+    return tuple(_electric_rel(profile[h], set_temp) / ref for h in hours)
+
+
+def ac_window_factor(region, month, set_temp, hours, on_hours=frozenset()):
+    """คืน (ตัวคูณ kWh ของช่วงเวลานี้, สัดส่วนที่ตกช่วง On-Peak)
+
+    hours: ชั่วโมงที่เปิดแอร์ (ว่าง = ไม่รู้ช่วงเวลา ใช้โมเดลเดิม)
+    """
+    if not hours:
+        return 1.0, 0.0
+    weights = ac_hour_weights(region, int(month), float(set_temp), tuple(hours))
+    total = sum(weights)
+    on = sum(w for h, w in zip(hours, weights) if h in on_hours)
+    return total / len(weights), (on / total if total > 0 else 0.0)
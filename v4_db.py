@@ -4,6 +4,11 @@ from pathlib import Path
 
 DB_PATH = Path("v4_data.db")
 
+def configure(path):
+    """ตั้งไฟล์ฐานข้อมูล (create_app() เรียกจาก config — import โมดูลนี้ไม่แตะดิสก์)"""
+    global DB_PATH
+    DB_PATH = Path(path)
+
 def get_conn():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row